@@ -1,3 +1,39 @@
 from django.contrib import admin
+from django.utils.html import format_html
 
-# Register your models here.
+from api import profiling
+from api.models import ProfileCapture
+
+
+class ProfileCaptureAdmin(admin.ModelAdmin):
+    list_display = (
+        "created_at", "method", "path", "view_name", "kind", "duration_ms",
+        "status_code", "user", "hostname",
+    )
+    list_filter = ("kind", "view_name", "hostname")
+    search_fields = ["path"]
+    list_select_related = ("user",)
+    fields = (
+        "created_at", "method", "path", "view_name", "kind", "duration_ms",
+        "status_code", "user", "hostname", "file_name", "report",
+    )
+    readonly_fields = fields
+
+    class Meta:
+        model = ProfileCapture
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description="Report")
+    def report(self, obj):
+        return format_html(
+            '<pre style="white-space: pre; overflow-x: auto">{}</pre>',
+            profiling.render(obj.file_name),
+        )
+
+
+admin.site.register(ProfileCapture, ProfileCaptureAdmin)
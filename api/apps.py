@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.conf import settings
+
+        from api.db import querycheck
+        from api.db.sharding import delete_sharded_rows
+        from api.logging import install_queue_targets
+        from api.metrics import install_query_wrapper
+
+        install_queue_targets(settings.LOG_FORMAT)
+
+        post_delete.connect(delete_sharded_rows, sender=settings.AUTH_USER_MODEL)
+        connection_created.connect(install_query_wrapper)
+        connection_created.connect(querycheck.install_query_wrapper)
@@ -0,0 +1,19 @@
+"""Helpers shared by the benchmark and load test management commands."""
+from django.conf import settings
+from django.test import override_settings
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def without_throttling(**overrides):
+    """override_settings() that also sets every throttle rate to None (no limit)."""
+    rates = dict.fromkeys(settings.REST_FRAMEWORK.get("DEFAULT_THROTTLE_RATES", {}))
+    return override_settings(
+        REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates},
+        **overrides,
+    )
@@ -0,0 +1,251 @@
+"""
+Two-tier cache: a bounded in-process LRU in front of the shared Django cache.
+
+Values live in named namespaces::
+
+    allergens = cache_namespace("allergens", timeout=3600)
+    ids = allergens.get_or_set("ids_by_name", load_allergen_ids)
+    allergens.invalidate()  # after an Allergen changed
+
+Keys are versioned per namespace, so ``invalidate()`` drops every entry at
+once by bumping the version stored in the shared cache. Other processes see
+the new version after at most ``local_timeout`` seconds, which also bounds
+how stale their in-process copies can get.
+
+``get_or_set`` recomputes a missing value once: concurrent callers in the
+process wait on a lock and callers in other processes wait for the value
+to show up in the shared cache while one ``cache.add`` lock holder computes
+it. Values handed out from the local tier are shared between callers and
+must be treated as read-only.
+"""
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+MISSING = object()
+
+# Threads computing the same key serialize on one of these locks.
+_compute_locks = [threading.Lock() for _ in range(64)]
+
+
+class LocalLRU:
+    """Thread-safe bounded LRU with per-entry expiry."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        """Stores ``value``; returns how many entries were evicted."""
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            evicted = 0
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CacheNamespace:
+    def __init__(self, name, timeout=300, local_timeout=None, max_entries=None,
+                 alias="default", lock_timeout=10.0):
+        self.name = name
+        self.timeout = timeout
+        self.local_timeout = (
+            settings.CACHE_LOCAL_TIMEOUT if local_timeout is None else local_timeout
+        )
+        self.lock_timeout = lock_timeout
+        self.alias = alias
+        self.local = LocalLRU(
+            settings.CACHE_LOCAL_MAX_ENTRIES if max_entries is None else max_entries
+        )
+        self._version_key = "ns:%s:version" % name
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "local_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "computes": 0,
+            "compute_waits": 0,
+        }
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def _count(self, stat, n=1):
+        with self._stats_lock:
+            self.stats[stat] += n
+
+    def version(self):
+        version = self.local.get(self._version_key)
+        if version is MISSING:
+            version = self.shared.get(self._version_key)
+            if version is None:
+                self.shared.add(self._version_key, 1, timeout=None)
+                version = self.shared.get(self._version_key, 1)
+            self.local.set(self._version_key, version, self.local_timeout)
+        return version
+
+    def make_key(self, key):
+        return "ns:%s:%s:%s" % (self.name, self.version(), key)
+
+    def _set_local(self, full_key, value, timeout):
+        local_timeout = min(self.local_timeout, timeout or self.local_timeout)
+        evicted = self.local.set(full_key, value, local_timeout)
+        if evicted:
+            self._count("evictions", evicted)
+
+    def _get(self, full_key):
+        value = self.local.get(full_key)
+        if value is not MISSING:
+            self._count("local_hits")
+            return value
+        value = self.shared.get(full_key, MISSING)
+        if value is not MISSING:
+            self._count("shared_hits")
+            self._set_local(full_key, value, self.timeout)
+        return value
+
+    def get(self, key, default=None):
+        value = self._get(self.make_key(key))
+        if value is MISSING:
+            self._count("misses")
+            return default
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        full_key = self.make_key(key)
+        self.shared.set(full_key, value, timeout)
+        self._set_local(full_key, value, timeout)
+
+    def delete(self, key):
+        full_key = self.make_key(key)
+        self.shared.delete(full_key)
+        self.local.delete(full_key)
+
+    def invalidate(self):
+        """Drops every entry of the namespace, in all processes."""
+        try:
+            version = self.shared.incr(self._version_key)
+        except ValueError:
+            version = 2
+            self.shared.set(self._version_key, version, timeout=None)
+        self.local.clear()
+        self.local.set(self._version_key, version, self.local_timeout)
+
+    def get_or_set(self, key, compute, timeout=None):
+        """
+        Returns the cached value of ``key``, computing and storing it with
+        ``compute()`` when missing. ``None`` results are returned but not
+        cached.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        full_key = self.make_key(key)
+        value = self._get(full_key)
+        if value is not MISSING:
+            return value
+
+        stripe = _compute_locks[zlib.crc32(full_key.encode()) % len(_compute_locks)]
+        with stripe:
+            # Another thread may have filled it while this one waited.
+            value = self._get(full_key)
+            if value is not MISSING:
+                return value
+            self._count("misses")
+
+            lock_key = full_key + ":lock"
+            if self.shared.add(lock_key, 1, timeout=self.lock_timeout):
+                return self._compute(full_key, compute, timeout, lock_key)
+
+        # Another process computes it. Wait without the stripe lock, which
+        # threads computing other keys need.
+        value = self._wait_for(full_key)
+        if value is not MISSING:
+            return value
+        with stripe:
+            value = self._get(full_key)
+            if value is not MISSING:
+                return value
+            return self._compute(full_key, compute, timeout)
+
+    def _compute(self, full_key, compute, timeout, lock_key=None):
+        try:
+            self._count("computes")
+            value = compute()
+            if value is not None:
+                self.shared.set(full_key, value, timeout)
+                self._set_local(full_key, value, timeout)
+        finally:
+            if lock_key is not None:
+                self.shared.delete(lock_key)
+        return value
+
+    def _wait_for(self, full_key):
+        """Polls the shared cache while another process computes the value."""
+        self._count("compute_waits")
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.01
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+            value = self.shared.get(full_key, MISSING)
+            if value is not MISSING:
+                self._set_local(full_key, value, self.timeout)
+                return value
+        return MISSING
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["local_entries"] = len(self.local)
+        return stats
+
+
+_namespaces = {}
+_namespaces_lock = threading.Lock()
+
+
+def cache_namespace(name, **options):
+    """Returns the process-wide namespace ``name``, creating it on first use."""
+    namespace = _namespaces.get(name)
+    if namespace is None:
+        with _namespaces_lock:
+            namespace = _namespaces.get(name)
+            if namespace is None:
+                namespace = _namespaces[name] = CacheNamespace(name, **options)
+    return namespace
+
+
+def cache_stats():
+    return {name: namespace.snapshot() for name, namespace in _namespaces.items()}
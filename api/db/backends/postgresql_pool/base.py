@@ -0,0 +1,39 @@
+"""
+PostgreSQL engine that checks connections out of an in-process pool
+(see ``api.db.pool``) instead of opening and closing them.
+
+Pool options are read from the ``POOL`` key of the database settings::
+
+    "POOL": {"min_size": 2, "max_size": 10, "timeout": 5,
+             "max_idle": 300, "health_check_interval": 30}
+"""
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+from api.db.pool import find_pool, get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        pool = get_pool(
+            self.alias,
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params),
+            self.settings_dict.get("POOL", {}),
+        )
+        connection = pool.getconn()
+        # A pooled connection may have been opened by another thread's wrapper.
+        self.isolation_level = IsolationLevel(
+            self.settings_dict["OPTIONS"].get(
+                "isolation_level", IsolationLevel.READ_COMMITTED
+            )
+        )
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                pool = find_pool(self.alias)
+                if pool is None:
+                    # Connection inherited across fork(); not ours to reuse.
+                    return self.connection.close()
+                pool.putconn(self.connection)
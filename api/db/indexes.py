@@ -0,0 +1,44 @@
+"""
+Index builds for migrations that must not block writes.
+
+On PostgreSQL ``create_index`` builds with CREATE INDEX CONCURRENTLY, which
+cannot run inside a transaction: migrations using it set ``atomic = False``.
+A concurrent build that failed (for a unique index: on a duplicate written
+during the build) leaves an INVALID index behind, which is dropped and
+rebuilt instead of being skipped by IF NOT EXISTS. Other
+databases get a plain CREATE INDEX.
+"""
+
+
+def _invalid_index(schema_editor, name):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = %s AND NOT pg_index.indisvalid",
+            [name],
+        )
+        return cursor.fetchone() is not None
+
+
+def create_index(schema_editor, name, table, expression, method=None, unique=False):
+    """Creates index ``name`` on ``table (expression)`` unless it exists."""
+    quote = schema_editor.quote_name
+    concurrently = ""
+    if schema_editor.connection.vendor == "postgresql":
+        concurrently = "CONCURRENTLY "
+        if _invalid_index(schema_editor, name):
+            drop_index(schema_editor, name)
+    schema_editor.execute(
+        "CREATE %sINDEX %sIF NOT EXISTS %s ON %s %s(%s)"
+        % (
+            "UNIQUE " if unique else "", concurrently, quote(name), quote(table),
+            "USING %s " % method if method else "", expression,
+        )
+    )
+
+
+def drop_index(schema_editor, name):
+    concurrently = "CONCURRENTLY " if schema_editor.connection.vendor == "postgresql" else ""
+    schema_editor.execute(
+        "DROP INDEX %sIF EXISTS %s" % (concurrently, schema_editor.quote_name(name))
+    )
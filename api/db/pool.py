@@ -0,0 +1,202 @@
+"""
+Application-side PostgreSQL connection pool used by the
+``api.db.backends.postgresql_pool`` database engine.
+
+One pool is kept per database alias and process. Django checks a connection
+out when it opens one and hands it back instead of closing it, so with
+``CONN_MAX_AGE = 0`` every request still releases its connection but nobody
+pays for a new TCP/auth handshake.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    """Raised when no connection became available within the wait timeout."""
+
+
+class ConnectionPool:
+    def __init__(self, connect, min_size=0, max_size=10, timeout=5.0,
+                 max_idle=300.0, health_check_interval=30.0):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min=%s max=%s" % (min_size, max_size))
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+
+        self._idle = deque()  # (connection, returned_at)
+        self._size = 0
+        self._cond = threading.Condition()
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "health_checks_failed": 0,
+        }
+
+    def getconn(self):
+        with self._cond:
+            self._reap()
+            if self._size < self.min_size:
+                self._fill()
+            started = None
+            while True:
+                while self._idle:
+                    conn, returned_at = self._idle.pop()
+                    if self._is_healthy(conn, returned_at):
+                        return self._checked_out(conn, started)
+                    self._discard(conn)
+                if self._size < self.max_size:
+                    # Reserve the slot before connecting outside the lock.
+                    self._size += 1
+                    break
+                if started is None:
+                    started = time.monotonic()
+                    self.stats["waits"] += 1
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    self.stats["wait_seconds"] += time.monotonic() - started
+                    raise PoolTimeout(
+                        "No database connection available after %.1fs "
+                        "(max_size=%s)" % (self.timeout, self.max_size)
+                    )
+                self._cond.wait(remaining)
+
+        try:
+            conn = self.connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats["connections_created"] += 1
+            return self._checked_out(conn, started)
+
+    def putconn(self, conn):
+        reusable = not conn.closed
+        if reusable:
+            try:
+                status = conn.get_transaction_status()
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    reusable = False
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                reusable = False
+        with self._cond:
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+            self._reap()
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                **self.stats,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+            }
+
+    def _checked_out(self, conn, started):
+        self.stats["checkouts"] += 1
+        if started is not None:
+            self.stats["wait_seconds"] += time.monotonic() - started
+        return conn
+
+    def _fill(self):
+        while self._size < self.min_size:
+            self._idle.appendleft((self.connect(), time.monotonic()))
+            self._size += 1
+            self.stats["connections_created"] += 1
+
+    def _reap(self):
+        """
+        Closes connections idle for more than max_idle, down to min_size.
+        Checkouts take the most recently returned connection, so the stale
+        ones collect at the left end of the deque.
+        """
+        if not self.max_idle:
+            return
+        cutoff = time.monotonic() - self.max_idle
+        while self._idle and self._size > self.min_size and self._idle[0][1] < cutoff:
+            self._discard(self._idle.popleft()[0])
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        idle_for = time.monotonic() - returned_at
+        if self.max_idle and idle_for > self.max_idle:
+            return False
+        if idle_for > self.health_check_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except psycopg2.Error:
+                self.stats["health_checks_failed"] += 1
+                return False
+        return True
+
+    def _discard(self, conn):
+        self._size -= 1
+        self.stats["connections_discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, connect, options):
+    """
+    Returns the pool for ``alias`` in this process, creating it on first use.
+    Pools inherited across fork() are dropped, never shared with the parent.
+    """
+    pool = _pools.get(alias)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[alias] = ConnectionPool(connect, **options)
+        return pool
+
+
+def find_pool(alias):
+    """Returns this process's pool for ``alias``, or None."""
+    pool = _pools.get(alias)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    return None
+
+
+def pool_stats():
+    """Returns ``{alias: stats}`` for the pools of the current process."""
+    pid = os.getpid()
+    return {alias: pool.snapshot() for alias, pool in _pools.items() if pool.pid == pid}
@@ -0,0 +1,150 @@
+"""
+N+1 and slow query detection.
+
+While a check is active, every SQL statement is reduced to its shape
+(literals, parameters and ``IN (...)`` lists collapsed) and counted. A shape
+issued more than QUERY_CHECK_REPEAT_THRESHOLD times, or a statement slower
+than QUERY_CHECK_SLOW_MS, is reported with the line of project code that
+issued it::
+
+    with check_queries():  # raises QueryProblems, e.g. in tests
+        client.post("/api/users/update/", ...)
+
+``QueryCheckMiddleware`` runs a check around every request and logs the
+problems (QUERY_CHECK=log) or fails the request (QUERY_CHECK=raise).
+"""
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+_checker = ContextVar("query_checker", default=None)
+
+_NORMALIZERS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s|\?"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+# Transaction control repeats by design (one savepoint per atomic block).
+_IGNORED = re.compile(r"^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT|BEGIN|COMMIT)\b", re.I)
+
+# Query plumbing that sits between project code and the database.
+_SKIPPED = ("api/db/", "api/metrics.py", "api/middleware.py")
+
+
+def normalize(sql):
+    """The shape of ``sql``: the statement with every value replaced by ``?``."""
+    for pattern, replacement in _NORMALIZERS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def is_transaction_control(sql):
+    return _IGNORED.match(sql) is not None
+
+
+def origin():
+    """``path:line in function`` of the innermost project frame on the stack."""
+    base_dir = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(base_dir) and "site-packages" not in filename:
+            path = os.path.relpath(filename, base_dir).replace(os.sep, "/")
+            if not path.startswith(_SKIPPED):
+                return "%s:%d in %s" % (path, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+
+class QueryProblems(AssertionError):
+    def __init__(self, label, problems):
+        self.problems = problems
+        super().__init__(
+            "%s:\n%s" % (label, "\n".join("  " + problem for problem in problems))
+        )
+
+
+class QueryChecker:
+    def __init__(self, threshold=None, slow_ms=None):
+        self.threshold = (
+            settings.QUERY_CHECK_REPEAT_THRESHOLD if threshold is None else threshold
+        )
+        self.slow_ms = settings.QUERY_CHECK_SLOW_MS if slow_ms is None else slow_ms
+        self.shapes = {}  # (alias, shape) -> [count, origin of the first one]
+        self.slow = []  # (milliseconds, alias, sql, origin)
+        self.queries = []  # (alias, sql, params) of every statement
+
+    def record(self, alias, sql, params, milliseconds):
+        self.queries.append((alias, sql, params))
+        if is_transaction_control(sql):
+            return
+        key = (alias, normalize(sql))
+        stats = self.shapes.get(key)
+        if stats is None:
+            self.shapes[key] = [1, origin()]
+        else:
+            stats[0] += 1
+        if milliseconds >= self.slow_ms:
+            self.slow.append((milliseconds, alias, sql, origin()))
+
+    def problems(self):
+        problems = [
+            "%d x %s [%s] from %s" % (count, shape, alias, where)
+            for (alias, shape), (count, where) in self.shapes.items()
+            if count > self.threshold
+        ]
+        problems += [
+            "slow (%.0f ms) %s [%s] from %s" % (milliseconds, sql, alias, where)
+            for milliseconds, alias, sql, where in self.slow
+        ]
+        return problems
+
+
+def query_wrapper(execute, sql, params, many, context):
+    checker = _checker.get()
+    if checker is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        checker.record(
+            context["connection"].alias, sql, params,
+            (time.perf_counter() - started) * 1000,
+        )
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """connection_created receiver, see api.metrics.install_query_wrapper()."""
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+def start_check(threshold=None, slow_ms=None):
+    checker = QueryChecker(threshold, slow_ms)
+    return checker, _checker.set(checker)
+
+
+def finish_check(token):
+    _checker.reset(token)
+
+
+@contextmanager
+def check_queries(threshold=None, slow_ms=None, label="Query problems"):
+    """Raises QueryProblems if the block repeats a query shape or runs a slow one."""
+    checker, token = start_check(threshold, slow_ms)
+    try:
+        yield checker
+    finally:
+        finish_check(token)
+    problems = checker.problems()
+    if problems:
+        raise QueryProblems(label, problems)
@@ -0,0 +1,64 @@
+"""
+Read-replica switching and read-your-writes pinning.
+
+Replica reads are opt-in per context: views mark themselves with
+``replica_reads = True`` and ``ReplicaRoutingMiddleware`` turns replica reads
+on around them, unless the caller was recently pinned to the primary with
+``pin_to_primary()`` after a write.
+"""
+import hashlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+def replica_reads_enabled():
+    return _replica_reads.get()
+
+
+def set_replica_reads(enabled):
+    """Switches replica reads for the rest of the current context."""
+    _replica_reads.set(enabled)
+
+
+@contextmanager
+def use_replicas(enabled=True):
+    """Routes reads in the block to replicas (or back to the primary)."""
+    token = _replica_reads.set(enabled)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def use_primary():
+    return use_replicas(enabled=False)
+
+
+def _pin_cache_key(key):
+    return "db-pin:" + hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def pin_to_primary(key):
+    """
+    Keeps reads for ``key`` (an API token or session key) on the primary for
+    ``DATABASE_PIN_SECONDS`` so the caller sees its own writes.
+    """
+    if settings.DATABASE_REPLICAS and key:
+        cache.set(_pin_cache_key(key), 1, settings.DATABASE_PIN_SECONDS)
+
+
+def is_pinned(key):
+    return bool(key) and cache.get(_pin_cache_key(key)) is not None
+
+
+def request_pin_key(request):
+    """The API token of the request, or its session key for browser requests."""
+    auth = request.META.get("HTTP_AUTHORIZATION", "")
+    if auth.startswith("Token "):
+        return auth[len("Token "):].strip()
+    return request.COOKIES.get(settings.SESSION_COOKIE_NAME)
@@ -0,0 +1,77 @@
+"""
+Database routers.
+
+``ShardRouter`` places the per-user models of ``settings.SHARDED_MODELS`` on
+the shard of their user and keeps everything else off the shards.
+``PrimaryReplicaRouter`` sends reads to one of ``settings.DATABASE_REPLICAS``
+only while replica reads are switched on for the current context (see
+``api.db.replicas``); everything else, and every write, goes to ``default``.
+"""
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from api.db.replicas import replica_reads_enabled
+from api.db.sharding import is_sharded, shard_for_user, user_id_from_instance
+
+
+class ShardRouter:
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def _route(self, model, hints):
+        if not settings.DATABASE_SHARDS:
+            return None
+        instance = hints.get("instance")
+        if is_sharded(model):
+            if instance is None:
+                return None
+            return shard_for_user(user_id_from_instance(instance))
+        # e.g. weight.user: Django would otherwise look the user up on the
+        # shard the weight came from.
+        if instance is not None and instance._state.db in settings.DATABASE_SHARDS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not settings.DATABASE_SHARDS:
+            return None
+        databases = {
+            DEFAULT_DB_ALIAS,
+            *settings.DATABASE_SHARDS,
+            *settings.DATABASE_REPLICAS,
+        }
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if settings.DATABASE_REPLICAS and replica_reads_enabled():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Objects read from a replica must still be saved to the primary;
+        # Django would otherwise fall back to the instance's own database.
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema through replication.
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
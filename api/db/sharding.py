@@ -0,0 +1,87 @@
+"""
+Optional horizontal sharding of per-user tables.
+
+Rows of the models listed in ``settings.SHARDED_MODELS`` live in one of
+``settings.DATABASE_SHARDS``, chosen from the owning user's id with a jump
+consistent hash, so adding a shard only moves about 1/N of the users (see the
+``rebalance_shards`` command). With no shards configured everything stays on
+``default``.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models
+
+_USER_LOOKUPS = ("user", "user_id", "user__id", "user__pk")
+
+
+def jump_hash(key, num_buckets):
+    """Lamping & Veach jump consistent hash of an integer key."""
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for_user(user_id):
+    shards = settings.DATABASE_SHARDS
+    if not shards or user_id is None:
+        return DEFAULT_DB_ALIAS
+    return shards[jump_hash(int(user_id), len(shards))]
+
+
+def is_sharded(model):
+    return model._meta.label_lower in settings.SHARDED_MODELS
+
+
+def user_id_from_instance(instance):
+    if instance._meta.label_lower == settings.AUTH_USER_MODEL.lower():
+        return instance.pk
+    return getattr(instance, "user_id", None)
+
+
+class ShardedQuerySet(models.QuerySet):
+    """Picks the shard from ``user=``/``user_id=`` filters and per object on bulk_create."""
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        clone = super()._filter_or_exclude(negate, args, kwargs)
+        if not negate and clone._db is None and settings.DATABASE_SHARDS:
+            for lookup in _USER_LOOKUPS:
+                if lookup in kwargs:
+                    value = kwargs[lookup]
+                    clone._db = shard_for_user(getattr(value, "pk", value))
+                    break
+        return clone
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None or not settings.DATABASE_SHARDS:
+            return super().bulk_create(objs, *args, **kwargs)
+        by_shard = {}
+        for obj in objs:
+            by_shard.setdefault(shard_for_user(obj.user_id), []).append(obj)
+        created = []
+        for alias, shard_objs in by_shard.items():
+            created.extend(
+                super(ShardedQuerySet, self.using(alias)).bulk_create(
+                    shard_objs, *args, **kwargs
+                )
+            )
+        return created
+
+
+ShardedManager = models.Manager.from_queryset(ShardedQuerySet)
+
+
+def delete_sharded_rows(sender, instance, **kwargs):
+    """
+    post_delete receiver for the user model. Django's cascade only looks at
+    the user's own database, so remove the user's rows from its shard too.
+    """
+    if not settings.DATABASE_SHARDS:
+        return
+    from django.apps import apps
+
+    alias = shard_for_user(instance.pk)
+    for label in settings.SHARDED_MODELS:
+        model = apps.get_model(label)
+        model._base_manager.using(alias).filter(user_id=instance.pk).delete()
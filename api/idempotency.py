@@ -0,0 +1,140 @@
+"""
+Idempotency keys for write endpoints.
+
+A client that may retry a request sends the same ``Idempotency-Key`` header
+with every attempt. The first attempt claims the key in the
+``api_idempotencyrecord`` table and stores its response there; retries within
+IDEMPOTENCY_KEY_TTL_SECONDS get that response back (with an
+``Idempotent-Replayed: true`` header) without running the view. A retry that
+arrives while the first attempt is still running waits up to
+IDEMPOTENCY_WAIT_SECONDS for it, then gets 409. Keys are scoped to the view
+and the authenticated user; reusing one for a different request body is
+answered with 422::
+
+    class UpdateUserView(APIView):
+        @idempotent
+        def post(self, request):
+            ...
+
+Server errors are not stored, so a retry after one runs the view again.
+"""
+import functools
+import hashlib
+import itertools
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.models import IdempotencyRecord
+
+HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.05
+# A claim whose request died is given up after this long; longer than any
+# request may run (gunicorn's timeout is 30 seconds).
+CLAIM_SECONDS = 60
+
+# Expired records are deleted once every this many claims per process.
+PURGE_EVERY = 1000
+_claims = itertools.count(1)
+
+
+def record_key(view, request, key):
+    scope = "%s.%s:%s" % (
+        type(view).__module__, type(view).__name__, request.user.pk or "",
+    )
+    return hashlib.sha256(("%s:%s" % (scope, key)).encode()).hexdigest()
+
+
+def fingerprint(request):
+    data = json.dumps(request.data, sort_keys=True, cls=JSONEncoder)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def claim(key, fingerprint):
+    """Inserts an in-progress record; False if one exists for ``key``."""
+    now = timezone.now()
+    if next(_claims) % PURGE_EVERY == 0:
+        IdempotencyRecord.objects.filter(expires_at__lt=now).delete()
+    try:
+        with transaction.atomic():
+            IdempotencyRecord.objects.create(
+                key=key,
+                fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=CLAIM_SECONDS),
+            )
+    except IntegrityError:
+        return False
+    return True
+
+
+def release(key):
+    IdempotencyRecord.objects.filter(key=key).delete()
+
+
+def idempotent(handler):
+    """Decorates an APIView handler to honour the Idempotency-Key header."""
+
+    @functools.wraps(handler)
+    def wrapper(view, request, *args, **kwargs):
+        client_key = request.headers.get(HEADER)
+        if client_key is None:
+            return handler(view, request, *args, **kwargs)
+        if not client_key or len(client_key) > MAX_KEY_LENGTH:
+            return Response("Invalid %s header" % HEADER, status=400)
+
+        key = record_key(view, request, client_key)
+        digest = fingerprint(request)
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_SECONDS
+        while not claim(key, digest):
+            record = IdempotencyRecord.objects.filter(key=key).first()
+            if record is None:
+                # The other request failed in the meantime; claim again.
+                continue
+            if record.expires_at <= timezone.now():
+                IdempotencyRecord.objects.filter(
+                    key=key, expires_at=record.expires_at
+                ).delete()
+                continue
+            if record.fingerprint != digest:
+                return Response(
+                    "%s was already used for a different request" % HEADER, status=422
+                )
+            if record.status_code is not None:
+                return Response(
+                    record.response,
+                    status=record.status_code,
+                    headers={REPLAY_HEADER: "true"},
+                )
+            if time.monotonic() >= deadline:
+                return Response(
+                    "A request with this %s is still in progress" % HEADER,
+                    status=409,
+                    headers={"Retry-After": "1"},
+                )
+            time.sleep(POLL_SECONDS)
+
+        try:
+            response = handler(view, request, *args, **kwargs)
+        except BaseException:
+            release(key)
+            raise
+        if response.status_code >= 500:
+            release(key)
+        else:
+            IdempotencyRecord.objects.filter(key=key).update(
+                status_code=response.status_code,
+                response=response.data,
+                expires_at=timezone.now()
+                + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL_SECONDS),
+            )
+        return response
+
+    return wrapper
@@ -0,0 +1,195 @@
+"""
+Logging pipeline that keeps I/O off the request threads.
+
+``QueueHandler`` only puts records on a bounded in-memory queue; a
+``QueueListener`` thread per process hands them to the real handlers
+(console, files...). ``JsonFormatter`` writes one JSON object per line, and
+``SamplingFilter`` / ``RateLimitFilter`` thin out chatty loggers before a
+record is even queued. The queue and filters are wired up in
+settings.LOGGING, the listener's handlers by ``install_queue_targets()``.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+_exception_formatter = logging.Formatter()
+
+# Attributes every LogRecord has; anything else was passed with ``extra=``.
+RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for ``handlers``, which are written by a background
+    QueueListener. Logging never blocks: when the queue is full the record is
+    dropped and counted in ``dropped``.
+
+    ApiConfig.ready() gives the handler its targets (install_queue_targets);
+    records logged before that wait on the queue. Configure it with the
+    ``"()"`` factory key rather than ``"class"``: Python 3.12's dictConfig
+    special-cases QueueHandler subclasses given with ``"class"`` and would
+    not pass these arguments.
+    """
+
+    def __init__(self, queue_size=10000, respect_handler_level=True):
+        self.queue_size = queue_size
+        super().__init__(queue.Queue(queue_size))
+        self.handlers = []
+        self.respect_handler_level = respect_handler_level
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self._start_lock = threading.Lock()
+
+    def set_handlers(self, handlers):
+        """Makes ``handlers`` the targets; the listener restarts with them."""
+        with self._start_lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+                self.pid = None
+            self.listener = None
+            # Keeps strong references: the logging module only holds weak
+            # ones to handlers no logger uses directly.
+            self.handlers = list(handlers)
+
+    def start(self):
+        # The listener thread starts with the first record of each process,
+        # so a gunicorn master that preloads the app forks no running thread.
+        if self.pid is not None:
+            # Forked child: the parent's listener thread does not exist here
+            # and its queue may hold locks taken at fork time.
+            self.queue = queue.Queue(self.queue_size)
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *self.handlers, respect_handler_level=self.respect_handler_level
+        )
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def emit(self, record):
+        if self.pid != os.getpid() and self.handlers:
+            with self._start_lock:
+                if self.pid != os.getpid() and self.handlers:
+                    self.start()
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Unlike the base class, keep the record unformatted so the target
+        # handler's formatter (e.g. JsonFormatter) sees the real fields.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        # Flushes the queue into the target handlers before they are closed.
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, including ``extra=`` fields."""
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_info"] = record.exc_text
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+def console_handler(log_format="json"):
+    """INFO and above to stderr, as JSON lines or in the plain text format."""
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO)
+    if log_format == "text":
+        handler.setFormatter(
+            logging.Formatter("{levelname} {asctime} {module} {message}", style="{")
+        )
+    else:
+        handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def install_queue_targets(log_format="json"):
+    """Points the root logger's QueueHandlers at a console handler."""
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler) and not handler.handlers:
+            handler.set_handlers([console_handler(log_format)])
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a ``rate`` fraction of the records below ``level``, and all others."""
+
+    def __init__(self, rate=1.0, level="WARNING", name=""):
+        super().__init__(name)
+        self.rate = float(rate)
+        self.level = logging._checkLevel(level)
+
+    def filter(self, record):
+        if record.levelno >= self.level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most ``rate`` records per ``per`` seconds for each logger
+    and message template (token bucket). The first record let through after
+    a burst carries the number of suppressed ones as ``suppressed``.
+    """
+
+    def __init__(self, rate=10, per=1.0, name=""):
+        super().__init__(name)
+        self.rate = float(rate)
+        self.per = float(per)
+        self._buckets = {}  # (logger, template) -> [tokens, updated_at, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg if isinstance(record.msg, str) else None)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.rate, now, 0]
+            tokens = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate / self.per)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+            bucket[0] = tokens - 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
@@ -0,0 +1,167 @@
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+
+from api.benchmark import percentile, without_throttling
+from api.db.pool import pool_stats
+from users.models import HeightModel, User, WeightModel
+from users.views import PROFILE_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures in-process latency of the login and profile endpoints and how "
+        "many database connections they open. Run once with the default settings "
+        "and once with DB_POOL=1 or DB_CONN_MAX_AGE=60 to compare. Password hashing, "
+        "throttling and the cycle predictor are excluded so that request and "
+        "connection overhead dominate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--endpoints", default="login,profile")
+        parser.add_argument(
+            "--no-api-fast-path", action="store_true",
+            help="Run session, CSRF, auth, messages and clickjacking middleware "
+            "on API requests too, to measure what the fast path saves.",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON only.")
+
+    def handle(self, *args, **options):
+        overrides = {
+            "PASSWORD_HASHERS": ["django.contrib.auth.hashers.MD5PasswordHasher"],
+            # The hashing processes would not see the hasher override.
+            "PASSWORD_HASH_WORKERS": 0,
+        }
+        if options["no_api_fast_path"]:
+            overrides["API_PATH_PREFIXES"] = []
+        with without_throttling(**overrides):
+            results = self.run(options)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            "engine: %s api_fast_path: %s"
+            % (results["engine"], results["api_fast_path"])
+        )
+        for name, row in results["endpoints"].items():
+            self.stdout.write(
+                "%-8s n=%-5d mean=%.2fms p50=%.2fms p95=%.2fms p99=%.2fms "
+                "rps=%.1f connections_opened=%d"
+                % (
+                    name,
+                    row["requests"],
+                    row["mean_ms"],
+                    row["p50_ms"],
+                    row["p95_ms"],
+                    row["p99_ms"],
+                    row["rps"],
+                    row["connections_opened"],
+                )
+            )
+        if results["pool"]:
+            self.stdout.write("pool: %s" % json.dumps(results["pool"]))
+
+    def run(self, options):
+        email = "bench-%s@example.com" % uuid.uuid4().hex[:12]
+        password = uuid.uuid4().hex
+        user = User.objects.create(
+            username=email, email=email, gender=User.MAN, goal=User.MAINTENANCE,
+            activity_level=User.MODERATE, target_weight=75,
+        )
+        user.height = HeightModel.objects.create(user=user, height=180)
+        user.weight = WeightModel.objects.create(user=user, weight=80)
+        user.set_password(password)
+        user.save()
+
+        client = Client()
+        login_body = json.dumps({"email": email, "password": password})
+        token = {}
+
+        def login():
+            response = client.post(
+                "/api/users/login/", login_body, content_type="application/json"
+            )
+            token["key"] = response.json()["token"]
+            return response
+
+        profile_fields = ",".join(f for f in PROFILE_FIELDS if f != "menstrualPhase")
+
+        def profile():
+            return client.post(
+                "/api/users/profile/?fields=" + profile_fields,
+                HTTP_AUTHORIZATION="Token " + token["key"],
+            )
+
+        def timed(send):
+            # The test client disconnects close_old_connections from the request
+            # signals; call it the way the real handlers do so that connection
+            # setup and teardown are part of every measured request.
+            def wrapper():
+                close_old_connections()
+                try:
+                    return send()
+                finally:
+                    close_old_connections()
+
+            return wrapper
+
+        requests = {"login": timed(login), "profile": timed(profile)}
+        selected = [name.strip() for name in options["endpoints"].split(",")]
+        login()
+
+        opened = []
+        counter = lambda **kwargs: opened.append(1)  # noqa: E731
+        connection_created.connect(counter)
+        results = {
+            "engine": connections["default"].settings_dict["ENGINE"],
+            "api_fast_path": bool(settings.API_PATH_PREFIXES),
+            "endpoints": {},
+        }
+        try:
+            for name in selected:
+                send = requests[name]
+                for _ in range(options["warmup"]):
+                    send()
+                created_before = self.pool_created()
+                opened.clear()
+                timings = []
+                started = time.perf_counter()
+                for _ in range(options["iterations"]):
+                    t0 = time.perf_counter()
+                    response = send()
+                    timings.append((time.perf_counter() - t0) * 1000)
+                    if response.status_code != 200:
+                        raise RuntimeError(
+                            "%s returned %s" % (name, response.status_code)
+                        )
+                elapsed = time.perf_counter() - started
+                timings.sort()
+                created = self.pool_created() - created_before
+                results["endpoints"][name] = {
+                    "requests": len(timings),
+                    "mean_ms": sum(timings) / len(timings),
+                    "p50_ms": percentile(timings, 50),
+                    "p95_ms": percentile(timings, 95),
+                    "p99_ms": percentile(timings, 99),
+                    "rps": len(timings) / elapsed,
+                    # With the pooled engine connection_created fires on every
+                    # checkout, so the pool's own counter is the real figure.
+                    "connections_opened": created if settings.DB_POOL else len(opened),
+                }
+        finally:
+            connection_created.disconnect(counter)
+            User.objects.filter(pk=user.pk).delete()
+        results["pool"] = pool_stats()
+        return results
+
+    def pool_created(self):
+        return sum(p["connections_created"] for p in pool_stats().values())
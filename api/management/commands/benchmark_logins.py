@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.contrib.auth import hashers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from api import passwords
+from api.benchmark import percentile, without_throttling
+from users.models import HeightModel, User, WeightModel
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures login throughput with the configured password hasher, once "
+        "per PASSWORD_HASH_WORKERS value in --workers, from --threads "
+        "concurrent in-process clients. Reports logins per second in total and "
+        "per available core next to the ceiling a single core reaches hashing "
+        "alone. Throttling is disabled; failure counters are not involved."
+    )
+
+    def add_arguments(self, parser):
+        cores = available_cores()
+        parser.add_argument("--threads", type=int, default=2 * cores)
+        parser.add_argument("--duration", type=float, default=10, help="Seconds per run.")
+        parser.add_argument(
+            "--workers", default="0,%d" % cores,
+            help="Comma separated PASSWORD_HASH_WORKERS values to compare; 0 "
+            "hashes on the request threads (default: 0,%d)." % cores,
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON only.")
+
+    def handle(self, *args, **options):
+        try:
+            workers = [int(value) for value in options["workers"].split(",")]
+        except ValueError:
+            raise CommandError("--workers takes comma separated integers.")
+        if options["threads"] < 1 or min(workers) < 0:
+            raise CommandError("--threads must be positive and --workers not negative.")
+
+        with without_throttling():
+            results = self.run(options, workers)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            "hasher: %s hash=%.1fms cores=%d threads=%d ceiling=%.1f logins/s/core"
+            % (
+                results["hasher"], results["hash_ms"], results["cores"],
+                results["threads"], results["ceiling_per_core"],
+            )
+        )
+        for row in results["runs"]:
+            self.stdout.write(
+                "workers=%-3d n=%-6d rps=%.1f per_core=%.1f p50=%.1fms p95=%.1fms errors=%d"
+                % (
+                    row["workers"], row["logins"], row["rps"], row["rps_per_core"],
+                    row["p50_ms"], row["p95_ms"], row["errors"],
+                )
+            )
+
+    def run(self, options, workers):
+        password = uuid.uuid4().hex
+        encoded = hashers.make_password(password)
+        prefix = "bench-login-%s-" % uuid.uuid4().hex[:8]
+        # One user per thread: a login may replace the user's token.
+        emails = []
+        for index in range(options["threads"]):
+            email = "%s%d@example.com" % (prefix, index)
+            user = User.objects.create(
+                username=email, email=email, password=encoded, gender=User.MAN,
+                goal=User.MAINTENANCE, activity_level=User.MODERATE, target_weight=75,
+            )
+            user.height = HeightModel.objects.create(user=user, height=180)
+            user.weight = WeightModel.objects.create(user=user, weight=80)
+            user.save()
+            emails.append(email)
+
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            hashers.check_password(password, encoded)
+            timings.append((time.perf_counter() - started) * 1000)
+        hash_ms = sorted(timings)[2]
+        cores = available_cores()
+        results = {
+            "engine": connection.settings_dict["ENGINE"],
+            "hasher": hashers.identify_hasher(encoded).algorithm,
+            "hash_ms": hash_ms,
+            "cores": cores,
+            "threads": options["threads"],
+            "duration_s": options["duration"],
+            "ceiling_per_core": 1000 / hash_ms,
+            "runs": [],
+        }
+        try:
+            for count in workers:
+                with override_settings(PASSWORD_HASH_WORKERS=count):
+                    passwords.shutdown_pool()
+                    try:
+                        row = self.measure(emails, password, options["duration"])
+                    finally:
+                        passwords.shutdown_pool()
+                row["workers"] = count
+                row["rps_per_core"] = row["rps"] / cores
+                results["runs"].append(row)
+        finally:
+            User.objects.filter(email__startswith=prefix).delete()
+        return results
+
+    def measure(self, emails, password, duration):
+        bodies = [json.dumps({"email": email, "password": password}) for email in emails]
+        # Starts the pool's processes before the clock runs.
+        self.login(Client(), bodies[0])
+        timings, errors = [], []
+        barrier = threading.Barrier(len(bodies) + 1)
+        stop_at = []
+
+        def client(body):
+            local, failed = [], 0
+            client = Client()
+            try:
+                barrier.wait()
+                while time.perf_counter() < stop_at[0]:
+                    started = time.perf_counter()
+                    if self.login(client, body):
+                        local.append((time.perf_counter() - started) * 1000)
+                    else:
+                        failed += 1
+            finally:
+                connection.close()
+                timings.extend(local)
+                errors.append(failed)
+
+        threads = [threading.Thread(target=client, args=(body,)) for body in bodies]
+        for thread in threads:
+            thread.start()
+        stop_at.append(time.perf_counter() + duration)
+        barrier.wait()
+        for thread in threads:
+            thread.join()
+
+        timings.sort()
+        return {
+            "logins": len(timings),
+            "errors": sum(errors),
+            "rps": len(timings) / duration,
+            "p50_ms": percentile(timings, 50),
+            "p95_ms": percentile(timings, 95),
+        }
+
+    @staticmethod
+    def login(client, body):
+        try:
+            response = client.post(
+                "/api/users/login/?fields=username", body, content_type="application/json"
+            )
+        except Exception:
+            return False
+        return response.status_code == 200 and "token" in response.json()
@@ -0,0 +1,351 @@
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmark import percentile
+from users.models import User
+
+ENDPOINTS = ("register", "login", "profile", "update", "weights")
+DEFAULT_MIX = "register=1,login=2,profile=6,update=1,weights=2"
+PHASES = ("menstrual", "follicular", "ovulation", "luteal")
+
+
+def parse_mix(value):
+    """``"profile=6,login=2"`` -> ``{"profile": 6, "login": 2}``."""
+    mix = {}
+    for part in filter(None, (part.strip() for part in value.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise CommandError(
+                "Unknown endpoint %r in --mix (expected %s)." % (name, ", ".join(ENDPOINTS))
+            )
+        try:
+            mix[name] = float(weight or 1)
+        except ValueError:
+            raise CommandError("Invalid weight %r for %s in --mix." % (weight, name))
+    if not mix or sum(mix.values()) <= 0:
+        raise CommandError("--mix selects no endpoint.")
+    return mix
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_predictor(latency_ms):
+    """
+    Serves POST /phase/predict on a random local port, answering after
+    ``latency_ms`` with a phase derived from the payload. Returns the server;
+    call shutdown() on it when done.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency_ms / 1000)
+            phase = PHASES[sum(payload) % len(PHASES)]
+            body = json.dumps({"predicted_phase": phase}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Client(threading.Thread):
+    """
+    One simulated client: registers its own users, then sends a weighted
+    random mix of requests until ``stop_at``. Users are not shared between
+    clients, so a login (which may replace the user's token) never
+    invalidates another client's token.
+    """
+
+    def __init__(self, command, index, options, mix):
+        super().__init__(daemon=True)
+        self.command = command
+        self.index = index
+        self.options = options
+        self.random = random.Random(options["seed"] * 100003 + index)
+        self.names = list(mix)
+        self.shares = [mix[name] for name in self.names]
+        self.session = requests.Session()
+        self.users = []  # [email, token]
+        self.registered = 0
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.stop_at = self.measure_from = None
+
+    def post(self, path, body=None, token=None):
+        headers = {"Authorization": "Token " + token} if token else {}
+        response = self.session.post(
+            self.command.url + path, json=body or {}, headers=headers,
+            timeout=self.options["timeout"],
+        )
+        if response.status_code != 200:
+            raise RuntimeError("%s returned %s" % (path, response.status_code))
+        return response
+
+    def register(self):
+        self.registered += 1
+        email = "%s%d-%d@example.com" % (self.command.prefix, self.index, self.registered)
+        woman = self.random.random() < 0.6
+        body = {
+            "username": email,
+            "password": self.command.password,
+            "email": email,
+            "birthDate": "%d-%02d-%02d" % (
+                self.random.randint(1960, 2005), self.random.randint(1, 12),
+                self.random.randint(1, 28),
+            ),
+            "gender": "female" if woman else "male",
+            "height": self.random.randint(150, 195),
+            "weight": round(self.random.uniform(45, 110), 1),
+            "targetWeight": self.random.randint(50, 90),
+            "activityLevel": self.random.choice(
+                ["sedentary", "light", "moderate", "high", "extreme"]
+            ),
+        }
+        if woman:
+            body.update(cycleDay=self.random.randint(1, 28), cycleLength=28)
+        response = self.post("/api/users/create/", body)
+        self.users.append([email, response.json()["token"]])
+
+    def login(self):
+        user = self.random.choice(self.users)
+        response = self.post(
+            "/api/users/login/", {"email": user[0], "password": self.command.password}
+        )
+        user[1] = response.json()["token"]
+
+    def profile(self):
+        self.post("/api/users/profile/", token=self.random.choice(self.users)[1])
+
+    def update(self):
+        body = {
+            "weight": round(self.random.uniform(45, 110), 1),
+            "targetWeight": self.random.randint(50, 90),
+            "password": self.command.password,
+        }
+        self.post("/api/users/update/", body, token=self.random.choice(self.users)[1])
+
+    def weights(self):
+        self.post("/api/users/weights/", token=self.random.choice(self.users)[1])
+
+    def setup(self):
+        for _ in range(self.options["users_per_client"]):
+            self.register()
+
+    def run(self):
+        while True:
+            name = self.random.choices(self.names, self.shares)[0]
+            started = time.perf_counter()
+            if started >= self.stop_at:
+                return
+            try:
+                getattr(self, name)()
+                failed = False
+            except Exception:
+                failed = True
+            if started >= self.measure_from:
+                if failed:
+                    self.errors[name] += 1
+                else:
+                    self.timings[name].append((time.perf_counter() - started) * 1000)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test over HTTP: boots the app (gunicorn or runserver) against the "
+        "configured database with a local stub of the cycle predictor, registers "
+        "synthetic users and drives a weighted mix of register, login, profile, "
+        "update and weights requests from concurrent clients. Prints latency "
+        "percentiles, RPS and errors per endpoint as JSON. Synthetic users are "
+        "deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=32)
+        parser.add_argument("--duration", type=float, default=30, help="Seconds measured.")
+        parser.add_argument(
+            "--warmup", type=float, default=5,
+            help="Seconds of load before measuring starts.",
+        )
+        parser.add_argument(
+            "--mix", default=DEFAULT_MIX,
+            help="Relative weight of each endpoint (default: %s)." % DEFAULT_MIX,
+        )
+        parser.add_argument(
+            "--users-per-client", type=int, default=2,
+            help="Users each client registers before the run.",
+        )
+        parser.add_argument("--predictor-latency-ms", type=float, default=50)
+        parser.add_argument(
+            "--server", choices=["gunicorn", "runserver"], default="gunicorn",
+            help="How to boot the app; gunicorn reads fitness_django.gunicorn_conf "
+            "and the GUNICORN_* variables.",
+        )
+        parser.add_argument(
+            "--url",
+            help="Load an already running server instead of booting one. Its "
+            "CYCLE_PREDICTOR_URL should point at a predictor of its own.",
+        )
+        parser.add_argument(
+            "--throttle-rate", default="1000000/second",
+            help="THROTTLE_USER_RATE of the booted server; the default keeps "
+            "throttling in the request path without rejecting anything.",
+        )
+        parser.add_argument("--timeout", type=float, default=30, help="Per request.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Also write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options["mix"])
+        if options["clients"] < 1 or options["users_per_client"] < 1:
+            raise CommandError("--clients and --users-per-client must be positive.")
+
+        self.prefix = "load-%s-" % uuid.uuid4().hex[:8]
+        self.password = uuid.uuid4().hex
+        predictor = start_stub_predictor(options["predictor_latency_ms"])
+        server = None
+        try:
+            if options["url"]:
+                self.url = options["url"].rstrip("/")
+            else:
+                server = self.boot(options, predictor)
+            results = self.run(options, mix)
+        finally:
+            if server is not None:
+                server.terminate()
+                try:
+                    server.wait(10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+            predictor.shutdown()
+            User.objects.filter(email__startswith=self.prefix).delete()
+
+        report = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report + "\n")
+        self.stdout.write(report)
+
+    def boot(self, options, predictor):
+        port = free_port()
+        env = {
+            **os.environ,
+            "CYCLE_PREDICTOR_URL": "http://127.0.0.1:%d/phase/predict"
+            % predictor.server_address[1],
+            "THROTTLE_USER_RATE": options["throttle_rate"],
+            "GUNICORN_BIND": "127.0.0.1:%d" % port,
+        }
+        if options["server"] == "gunicorn":
+            argv = [sys.executable, "-m", "gunicorn", "-c", "python:fitness_django.gunicorn_conf"]
+        else:
+            argv = [
+                sys.executable, os.path.join(settings.BASE_DIR, "manage.py"),
+                "runserver", "--noreload", "127.0.0.1:%d" % port,
+            ]
+        # The server's access log would drown the report.
+        output = None if options["verbosity"] >= 2 else subprocess.DEVNULL
+        server = subprocess.Popen(
+            argv, cwd=settings.BASE_DIR, env=env, stdout=output, stderr=output
+        )
+        self.url = "http://127.0.0.1:%d" % port
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(
+                    "%s exited with %s; rerun with -v 2 to see its output."
+                    % (options["server"], server.returncode)
+                )
+            try:
+                requests.get(self.url + "/metrics", timeout=1)
+                return server
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        server.kill()
+        raise CommandError("%s did not start within 60 seconds." % options["server"])
+
+    def run(self, options, mix):
+        clients = [Client(self, index, options, mix) for index in range(options["clients"])]
+        failures = []
+        setup = [
+            threading.Thread(target=self.collect_failure(client.setup, failures))
+            for client in clients
+        ]
+        for thread in setup:
+            thread.start()
+        for thread in setup:
+            thread.join()
+        if failures:
+            raise CommandError("Registering the synthetic users failed: %s" % failures[0])
+
+        now = time.perf_counter()
+        for client in clients:
+            client.measure_from = now + options["warmup"]
+            client.stop_at = client.measure_from + options["duration"]
+            client.start()
+        for client in clients:
+            client.join()
+
+        endpoints = {}
+        for name in mix:
+            timings = sorted(t for client in clients for t in client.timings[name])
+            errors = sum(client.errors[name] for client in clients)
+            endpoints[name] = {
+                "requests": len(timings),
+                "errors": errors,
+                "mean_ms": sum(timings) / len(timings) if timings else 0.0,
+                "p50_ms": percentile(timings, 50),
+                "p95_ms": percentile(timings, 95),
+                "p99_ms": percentile(timings, 99),
+                "rps": len(timings) / options["duration"],
+            }
+        return {
+            "server": "external" if options["url"] else options["server"],
+            "engine": settings.DATABASES["default"]["ENGINE"],
+            "clients": options["clients"],
+            "users": options["clients"] * options["users_per_client"],
+            "duration_s": options["duration"],
+            "warmup_s": options["warmup"],
+            "mix": mix,
+            "predictor_latency_ms": options["predictor_latency_ms"],
+            "seed": options["seed"],
+            "total_rps": sum(row["requests"] for row in endpoints.values())
+            / options["duration"],
+            "endpoints": endpoints,
+        }
+
+    @staticmethod
+    def collect_failure(function, failures):
+        def wrapper():
+            try:
+                function()
+            except Exception as e:
+                failures.append(e)
+
+        return wrapper
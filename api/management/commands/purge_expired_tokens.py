@@ -0,0 +1,59 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes API tokens that expired TOKEN_TTL_SECONDS after their last "
+        "renewal, one chunk per statement so that no long lock or transaction "
+        "is held. Safe to run while serving; schedule it e.g. hourly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Seconds to pause between chunks, to spread the load.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Count the expired tokens without deleting them.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.TOKEN_TTL_SECONDS:
+            raise CommandError("Tokens do not expire (TOKEN_TTL_SECONDS is 0).")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive.")
+
+        cutoff = timezone.now() - timedelta(seconds=settings.TOKEN_TTL_SECONDS)
+        # Served by the authtoken_token_created_idx index.
+        expired = Token.objects.filter(created__lte=cutoff)
+        if options["dry_run"]:
+            self.stdout.write("%d expired tokens" % expired.count())
+            return
+
+        deleted = 0
+        while True:
+            keys = list(
+                expired.order_by("created").values_list("key", flat=True)[
+                    : options["chunk_size"]
+                ]
+            )
+            if not keys:
+                break
+            # A token renewed since it was selected is kept.
+            count, _ = Token.objects.filter(key__in=keys, created__lte=cutoff).delete()
+            deleted += count
+            if options["verbosity"] >= 2:
+                self.stdout.write("deleted %d tokens" % count)
+            if len(keys) < options["chunk_size"]:
+                break
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        self.stdout.write("Deleted %d expired tokens" % deleted)
@@ -0,0 +1,131 @@
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from api.db.sharding import shard_for_user
+
+
+@contextmanager
+def preserve_timestamps(model):
+    """Stops auto_now/auto_now_add from rewriting dates of copied rows."""
+    fields = [
+        field
+        for field in model._meta.concrete_fields
+        if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves rows of the sharded models to the shard their user hashes to, "
+        "one chunk per transaction. Run after changing DB_SHARD_HOSTS or when "
+        "enabling sharding on a database that already holds measurements."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user", type=int, action="append", dest="users",
+            help="Only rebalance this user id (repeatable).",
+        )
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Report misplaced rows without moving them.",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_SHARDS:
+            raise CommandError("Sharding is not enabled (DB_SHARD_HOSTS is empty).")
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive.")
+
+        sources = [DEFAULT_DB_ALIAS, *settings.DATABASE_SHARDS]
+        for label in settings.SHARDED_MODELS:
+            model = apps.get_model(label)
+            moved = 0
+            for source in sources:
+                for user_id in self.misplaced_users(model, source, options["users"]):
+                    target = shard_for_user(user_id)
+                    if options["dry_run"]:
+                        count = model._base_manager.using(source).filter(
+                            user_id=user_id
+                        ).count()
+                        self.stdout.write(
+                            "%s: user %s has %d rows on %s, belongs on %s"
+                            % (label, user_id, count, source, target)
+                        )
+                        continue
+                    moved += self.move_user(
+                        model, user_id, source, target, options["chunk_size"]
+                    )
+            if not options["dry_run"]:
+                self.stdout.write("%s: moved %d rows" % (label, moved))
+
+    def misplaced_users(self, model, source, only_users):
+        queryset = model._base_manager.using(source).exclude(user_id=None)
+        if only_users:
+            queryset = queryset.filter(user_id__in=only_users)
+        user_ids = queryset.values_list("user_id", flat=True).distinct().iterator()
+        return [user_id for user_id in user_ids if shard_for_user(user_id) != source]
+
+    def move_user(self, model, user_id, source, target, chunk_size):
+        User = get_user_model()
+        manager = model._base_manager
+        # User columns pointing at this model (User.height / User.weight).
+        user_fks = [
+            field.attname
+            for field in User._meta.concrete_fields
+            if field.is_relation and field.related_model is model
+        ]
+        moved = 0
+        while True:
+            rows = list(
+                manager.using(source).filter(user_id=user_id).order_by("pk")[:chunk_size]
+            )
+            if not rows:
+                return moved
+            old_pks = [row.pk for row in rows]
+            for row in rows:
+                row.pk = None
+                row._state.adding = True
+
+            # The target commits first; a crash before the source commits
+            # leaves this one chunk duplicated, never lost.
+            with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(
+                using=source
+            ), transaction.atomic(using=target), preserve_timestamps(model):
+                manager.using(target).bulk_create(rows)
+                new_pks = dict(zip(old_pks, (row.pk for row in rows)))
+                if user_fks:
+                    current = (
+                        User._base_manager.using(DEFAULT_DB_ALIAS)
+                        .filter(pk=user_id)
+                        .values(*user_fks)
+                        .first()
+                    ) or {}
+                    updates = {
+                        attname: new_pks[value]
+                        for attname, value in current.items()
+                        if value in new_pks
+                    }
+                    if updates:
+                        User._base_manager.using(DEFAULT_DB_ALIAS).filter(
+                            pk=user_id
+                        ).update(**updates)
+                # Raw delete: ids are only unique per database, so Django's
+                # cascade through User.height/User.weight could hit users that
+                # point at the copies on the target.
+                manager.using(source).filter(pk__in=old_pks)._raw_delete(source)
+            moved += len(rows)
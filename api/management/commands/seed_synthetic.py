@@ -0,0 +1,324 @@
+import datetime
+import time
+from contextlib import ExitStack
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from rest_framework.authtoken.models import Token
+
+from api.db.sharding import shard_for_user
+from users.models import Allergen, HeightModel, User, WeightModel
+
+TIMESTAMP = "%04d-%02d-%02d %02d:%02d:%02d+00"
+DECIMAL = "%d.%02d"
+WOMEN_SHARE = 0.6
+# Rows formatted per % operation; bounds the memory of one COPY buffer.
+BLOCK_ROWS = 5000
+
+
+def timestamp_columns(days, seconds):
+    """TIMESTAMP columns for days since 1970-01-01 and seconds into the day."""
+    dates = days.astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    return [
+        months.astype("datetime64[Y]").astype(np.int64) + 1970,
+        months.astype(np.int64) % 12 + 1,
+        (dates - months).astype(np.int64) + 1,
+        seconds // 3600,
+        seconds // 60 % 60,
+        seconds % 60,
+    ]
+
+
+def decimal_columns(hundredths):
+    return [hundredths // 100, hundredths % 100]
+
+
+def format_rows(row_format, columns):
+    """
+    Yields COPY text for rows whose values are spread over ``columns`` (arrays
+    of equal length, or scalars repeated on every row). Each block is one
+    ``%`` operation instead of one per row.
+    """
+    count = max((len(c) for c in columns if isinstance(c, np.ndarray)), default=0)
+    for start in range(0, count, BLOCK_ROWS):
+        size = min(BLOCK_ROWS, count - start)
+        values = np.empty((size, len(columns)), dtype=object)
+        for index, column in enumerate(columns):
+            values[:, index] = (
+                column[start:start + size] if isinstance(column, np.ndarray) else column
+            )
+        yield ((row_format * size) % tuple(values.ravel().tolist())).encode()
+
+
+class CopyStream:
+    """File-like object over an iterator of bytes, for cursor.copy_expert()."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b""
+        self.position = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.position >= len(self.chunk):
+                self.chunk, self.position = next(self.chunks, b""), 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if size < 0 else self.position + size
+            part = self.chunk[self.position:end]
+            self.position += len(part)
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+        return b"".join(parts)
+
+
+def copy_rows(alias, model, fields):
+    """
+    COPYs rows into ``model``'s table. ``fields`` is a list of
+    ``(column, format, values)``; ``values`` is the list of arrays or scalars
+    that ``format`` consumes, and ``format`` may be ``\\N`` (NULL) with none.
+    """
+    connection = connections[alias]
+    quote = connection.ops.quote_name
+    sql = "COPY %s (%s) FROM STDIN" % (
+        quote(model._meta.db_table),
+        ", ".join(quote(column) for column, _, _ in fields),
+    )
+    row_format = "\t".join(fmt for _, fmt, _ in fields) + "\n"
+    columns = [value for _, _, values in fields for value in values]
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, CopyStream(format_rows(row_format, columns)), size=1 << 16)
+
+
+def reserve_ids(alias, model, count):
+    """First of ``count`` consecutive ids taken from the table's sequence."""
+    table = model._meta.db_table
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            "nextval(pg_get_serial_sequence(%s, 'id')) + %s - 1)",
+            [table, table, count],
+        )
+        return cursor.fetchone()[0] - count + 1
+
+
+def history(rng, start, per_user, step, low, high):
+    """Random walks of ``per_user`` hundredths per user, starting at ``start``."""
+    steps = rng.normal(0, step, (len(start), per_user))
+    steps[:, 0] = 0
+    return np.rint(np.clip(start[:, None] + steps.cumsum(axis=1), low, high) * 100).astype(
+        np.int64
+    )
+
+
+def history_days(joined, today, per_user):
+    """Measurement days spread evenly from the join day to today."""
+    span = (today - joined)[:, None]
+    return joined[:, None] + span * np.arange(per_user) // max(per_user - 1, 1)
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads deterministic synthetic users with height and weight histories, "
+        "allergen links and tokens through PostgreSQL COPY, chunk by chunk. "
+        "Bypasses User.save(): age, BMI and BFP are computed here the same way. "
+        "All users share one password. The same --seed and --chunk-size give "
+        "the same data; ids come from the table sequences."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000000)
+        parser.add_argument("--weights-per-user", type=int, default=100)
+        parser.add_argument("--heights-per-user", type=int, default=1)
+        parser.add_argument(
+            "--max-allergens", type=int, default=3,
+            help="Each user is linked to 0..N of the existing allergens.",
+        )
+        parser.add_argument("--no-tokens", action="store_true")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="Users per chunk.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--email-prefix", default="synthetic-")
+        parser.add_argument("--password", default="synthetic")
+
+    def handle(self, *args, **options):
+        if connections[DEFAULT_DB_ALIAS].vendor != "postgresql":
+            raise CommandError("seed_synthetic loads with COPY and needs PostgreSQL.")
+        if options["chunk_size"] < 1 or options["users"] < 0:
+            raise CommandError("--chunk-size must be positive and --users not negative.")
+        if options["weights_per_user"] < 1 or options["heights_per_user"] < 1:
+            raise CommandError("Every user needs at least one height and one weight.")
+        if "%" in options["email_prefix"] or "\t" in options["email_prefix"]:
+            raise CommandError("--email-prefix may not contain % or tabs.")
+
+        self.password = make_password(options["password"])
+        self.allergen_ids = np.array(
+            Allergen.objects.order_by("pk").values_list("pk", flat=True), dtype=np.int64
+        )
+        if options["max_allergens"] and not len(self.allergen_ids):
+            self.stderr.write("No allergens exist; users are created without any.")
+        self.today_date = datetime.date.today()
+        self.today = np.int64((self.today_date - datetime.date(1970, 1, 1)).days)
+        self.now = np.int64(time.time())
+
+        total = options["users"]
+        started = time.perf_counter()
+        aliases = set()
+        for number, first in enumerate(range(0, total, options["chunk_size"])):
+            count = min(options["chunk_size"], total - first)
+            rng = np.random.default_rng([options["seed"], number])
+            aliases |= self.load_chunk(rng, count, options)
+            if options["verbosity"] >= 1:
+                done = first + count
+                self.stdout.write(
+                    "%d/%d users (%.0f users/s)"
+                    % (done, total, done / (time.perf_counter() - started))
+                )
+
+        # Fresh planner statistics; autovacuum may take a while to notice.
+        for alias in aliases:
+            with connections[alias].cursor() as cursor:
+                models = [HeightModel, WeightModel]
+                if alias == DEFAULT_DB_ALIAS:
+                    models += [User, User.allergens.through, Token]
+                for model in models:
+                    cursor.execute("ANALYZE %s" % connections[alias].ops.quote_name(
+                        model._meta.db_table
+                    ))
+        self.stdout.write(
+            "Loaded %d users in %.1fs." % (total, time.perf_counter() - started)
+        )
+
+    def load_chunk(self, rng, count, options):
+        today = self.today
+        women = rng.random(count) < WOMEN_SHARE
+        gender = np.where(women, User.WOMAN, User.MAN)
+        birth = today - rng.integers(18 * 365, 70 * 365, count)
+        joined = today - rng.integers(0, 3 * 365, count)
+        joined_seconds = rng.integers(0, 86400, count)
+
+        heights = history(
+            rng, rng.normal(np.where(women, 164, 178), 7), options["heights_per_user"],
+            0.1, 140, 210,
+        )
+        weights = history(
+            rng, rng.normal(np.where(women, 66, 82), 12), options["weights_per_user"],
+            0.4, 40, 180,
+        )
+        target_weight = np.rint(weights[:, 0] / 100 * rng.uniform(0.85, 1.05, count)) * 100
+
+        # Same derivations as User.save(), from the latest measurements.
+        height_m = heights[:, -1] / 10000
+        bmi = np.round(weights[:, -1] / 100 / height_m**2, 2)
+        birth_year, birth_month, birth_day = timestamp_columns(birth, np.zeros_like(birth))[:3]
+        today_date = self.today_date
+        age = (
+            today_date.year
+            - birth_year
+            - (
+                (today_date.month < birth_month)
+                | ((today_date.month == birth_month) & (today_date.day < birth_day))
+            )
+        )
+        bfp = np.round(1.20 * bmi + 0.23 * age - np.where(women, 5.4, 16.2), 1)
+
+        user_ids = reserve_ids(DEFAULT_DB_ALIAS, User, count) + np.arange(count)
+        shards = np.array([shard_for_user(user_id) for user_id in user_ids.tolist()])
+        height_ids = np.empty(count, dtype=np.int64)
+        weight_ids = np.empty(count, dtype=np.int64)
+
+        aliases = {DEFAULT_DB_ALIAS, *shards.tolist()}
+        with ExitStack() as stack:
+            for alias in aliases:
+                stack.enter_context(transaction.atomic(using=alias))
+            for alias in set(shards.tolist()):
+                rows = shards == alias
+                for model, field, values, latest in (
+                    (HeightModel, "height", heights[rows], height_ids),
+                    (WeightModel, "weight", weights[rows], weight_ids),
+                ):
+                    users, per_user = values.shape
+                    ids = reserve_ids(alias, model, values.size) + np.arange(values.size)
+                    latest[rows] = ids.reshape(users, per_user)[:, -1]
+                    days = history_days(joined[rows], today, per_user).ravel()
+                    copy_rows(alias, model, [
+                        ("id", "%d", [ids]),
+                        ("user_id", "%d", [np.repeat(user_ids[rows], per_user)]),
+                        (field, DECIMAL, decimal_columns(values.ravel())),
+                        ("updated_at", TIMESTAMP, timestamp_columns(
+                            days, np.repeat(joined_seconds[rows], per_user)
+                        )),
+                    ])
+
+            cycle_day = rng.integers(1, 29, count)
+            cycle_length = rng.integers(24, 33, count)
+            for rows, woman in ((women, True), (~women, False)):
+                joined_at = timestamp_columns(joined[rows], joined_seconds[rows])
+                emails = ["%s%%d@example.com" % options["email_prefix"], [user_ids[rows]]]
+                copy_rows(DEFAULT_DB_ALIAS, User, [
+                    ("id", "%d", [user_ids[rows]]),
+                    ("password", "%s", [self.password]),
+                    ("is_superuser", "f", []),
+                    ("username", *emails),
+                    ("email", *emails),
+                    ("first_name", "", []),
+                    ("last_name", "", []),
+                    ("is_staff", "f", []),
+                    ("is_active", "t", []),
+                    ("date_joined", TIMESTAMP, joined_at),
+                    ("birth_date", TIMESTAMP, timestamp_columns(birth[rows], np.zeros(rows.sum(), np.int64))),
+                    ("age", "%d", [age[rows]]),
+                    ("gender", "%d", [gender[rows]]),
+                    ("height_id", "%d", [height_ids[rows]]),
+                    ("weight_id", "%d", [weight_ids[rows]]),
+                    ("target_weight", DECIMAL, decimal_columns(target_weight[rows].astype(np.int64))),
+                    ("goal", "%d", [rng.integers(1, 4, rows.sum())]),
+                    ("activity_level", "%d", [rng.integers(1, 6, rows.sum())]),
+                    ("cycle_record_json", "{}", []),
+                    ("cycle_length", *(("%d", [cycle_length[rows]]) if woman else (r"\N", []))),
+                    ("cycle_day", *(("%d", [cycle_day[rows]]) if woman else (r"\N", []))),
+                    ("last_period_date", *(
+                        (TIMESTAMP, timestamp_columns(
+                            today - cycle_day[rows] + 1, np.zeros(rows.sum(), np.int64)
+                        ))
+                        if woman else (r"\N", [])
+                    )),
+                    ("bmi", "%.2f", [bmi[rows]]),
+                    ("bfp", "%.1f", [bfp[rows]]),
+                    ("created_at", TIMESTAMP, joined_at),
+                    ("updated_at", TIMESTAMP, joined_at),
+                ])
+
+            links = min(options["max_allergens"], len(self.allergen_ids))
+            if links:
+                picked = np.argsort(rng.random((count, len(self.allergen_ids))), axis=1)[:, :links]
+                kept = np.arange(links) < rng.integers(0, links + 1, count)[:, None]
+                copy_rows(DEFAULT_DB_ALIAS, User.allergens.through, [
+                    ("user_id", "%d", [np.broadcast_to(user_ids[:, None], picked.shape)[kept]]),
+                    ("allergen_id", "%d", [self.allergen_ids[picked][kept]]),
+                ])
+
+            if not options["no_tokens"]:
+                # Issued within the last renewal interval: valid, and not all
+                # due for a renewal on the first request.
+                window = min(
+                    settings.TOKEN_RENEW_AFTER_SECONDS,
+                    settings.TOKEN_TTL_SECONDS or settings.TOKEN_RENEW_AFTER_SECONDS,
+                )
+                issued = self.now - rng.integers(0, max(1, window), count)
+                # The user id keeps keys unique across runs with the same seed.
+                copy_rows(DEFAULT_DB_ALIAS, Token, [
+                    ("key", "%016x%08x%016x", [
+                        user_ids,
+                        rng.integers(0, 1 << 32, count, dtype=np.uint64),
+                        rng.integers(0, 1 << 64, count, dtype=np.uint64),
+                    ]),
+                    ("user_id", "%d", [user_ids]),
+                    ("created", TIMESTAMP, timestamp_columns(issued // 86400, issued % 86400)),
+                ])
+        return aliases
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.utils import OperationalError
+
+STATIC_HASH_FILE = ".collectstatic.sha256"
+IGNORE_PATTERNS = ["CVS", ".*", "*~"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Container startup: waits for the databases, applies pending migrations, "
+        "collects static files when their content changed and creates the "
+        "DJANGO_SUPERUSER_* account. Prints the time spent in each phase."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--db-timeout", type=float, default=60,
+            help="Seconds to wait for the databases.",
+        )
+        parser.add_argument("--db-interval", type=float, default=0.5)
+        parser.add_argument("--json", action="store_true", help="Print timings as JSON.")
+
+    def handle(self, *args, **options):
+        self.timings = {}
+        self.quiet = options["json"]
+        started = time.perf_counter()
+        # Replicas are only read from; they are neither awaited nor migrated.
+        aliases = [DEFAULT_DB_ALIAS, *settings.DATABASE_SHARDS]
+
+        self.phase("wait_for_db", self.wait_for_db, aliases, options)
+        self.phase("migrate", self.migrate, aliases)
+        self.phase("collectstatic", self.collectstatic)
+        self.phase("superuser", self.create_superuser)
+        self.timings["total"] = round(time.perf_counter() - started, 3)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(self.timings))
+        else:
+            self.stdout.write(
+                "startup: "
+                + " ".join("%s=%.3fs" % item for item in self.timings.items())
+            )
+
+    def phase(self, name, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        self.timings[name] = round(time.perf_counter() - started, 3)
+        if result and not self.quiet:
+            self.stdout.write("%s: %s" % (name, result))
+
+    def wait_for_db(self, aliases, options):
+        deadline = time.monotonic() + options["db_timeout"]
+        for alias in aliases:
+            connection = connections[alias]
+            while True:
+                try:
+                    connection.ensure_connection()
+                    break
+                except OperationalError as e:
+                    if time.monotonic() > deadline:
+                        raise CommandError("Database %s is unavailable: %s" % (alias, e))
+                    self.stdout.write("Database %s is unavailable - waiting..." % alias)
+                    time.sleep(options["db_interval"])
+        return None
+
+    def migrate(self, aliases):
+        applied = []
+        for alias in aliases:
+            executor = MigrationExecutor(connections[alias])
+            plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+            if plan:
+                call_command("migrate", database=alias, interactive=False, verbosity=1)
+                applied.append("%s (%d)" % (alias, len(plan)))
+        return "applied on " + ", ".join(applied) if applied else "up to date"
+
+    def collectstatic(self):
+        digest = self.static_digest()
+        hash_path = os.path.join(settings.STATIC_ROOT, STATIC_HASH_FILE)
+        try:
+            with open(hash_path) as f:
+                if f.read().strip() == digest:
+                    return "unchanged, skipped"
+        except OSError:
+            pass
+        call_command("collectstatic", interactive=False, verbosity=0)
+        with open(hash_path, "w") as f:
+            f.write(digest)
+        return "collected"
+
+    def static_digest(self):
+        """Content hash of every source static file plus the storage settings."""
+        digest = hashlib.sha256()
+        digest.update(repr(getattr(settings, "STORAGES", None)).encode())
+        files = []
+        for finder in get_finders():
+            for path, storage in finder.list(IGNORE_PATTERNS):
+                files.append((getattr(storage, "prefix", None) or "", path, storage))
+        for prefix, path, storage in sorted(files, key=lambda item: item[:2]):
+            digest.update(os.path.join(prefix, path).encode())
+            with storage.open(path) as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def create_superuser(self):
+        email = os.environ.get("DJANGO_SUPERUSER_EMAIL")
+        if not (
+            email
+            and os.environ.get("DJANGO_SUPERUSER_USERNAME")
+            and os.environ.get("DJANGO_SUPERUSER_PASSWORD")
+        ):
+            return None
+        if get_user_model().objects.filter(email__iexact=email).exists():
+            return "exists"
+        call_command("createsuperuser", interactive=False, verbosity=0)
+        return "created"
@@ -0,0 +1,319 @@
+"""
+Per-process request metrics in the Prometheus text format.
+
+Every thread increments its own plain dict, so recording a value takes no
+lock; the per-thread dicts are only summed when metrics are collected.
+With METRICS_DIR set (gunicorn, see fitness_django/gunicorn_conf.py) each
+process also dumps its totals to ``METRICS_DIR/<pid>.json`` at most every
+METRICS_FLUSH_SECONDS, and ``/metrics`` adds up the files of all workers.
+The gunicorn master folds the file of each worker that exits into
+``METRICS_DIR/exited.json`` (fold_exited), so counters keep their totals
+while the directory holds one file per live worker.
+"""
+import atexit
+import contextvars
+import fcntl
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from api.cache import cache_stats
+from api.db.pool import pool_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "http_request_duration_seconds": (
+        "histogram", "Request latency by view.", LATENCY_BUCKETS,
+    ),
+    "http_response_size_bytes": (
+        "histogram", "Response body size by view.", SIZE_BUCKETS,
+    ),
+    "db_queries_total": ("counter", "SQL queries by view and database.", None),
+    "db_query_duration_seconds_total": (
+        "counter", "Time spent in SQL queries by view and database.", None,
+    ),
+    "predictor_request_duration_seconds": (
+        "histogram", "Cycle predictor call latency by status.", LATENCY_BUCKETS,
+    ),
+    "cache_operations_total": (
+        "counter", "api.cache operations by namespace and result.", None,
+    ),
+    "db_pool_checkouts_total": (
+        "counter", "Connections checked out of the DB_POOL pool by database.", None,
+    ),
+    "db_pool_waits_total": (
+        "counter", "Checkouts that waited for a free pooled connection.", None,
+    ),
+    "db_pool_wait_seconds_total": (
+        "counter", "Time spent waiting for a free pooled connection.", None,
+    ),
+    "db_pool_timeouts_total": (
+        "counter", "Checkouts that gave up waiting (PoolTimeout).", None,
+    ),
+    "db_pool_connections_created_total": (
+        "counter", "Connections opened by the pool.", None,
+    ),
+    "db_pool_connections": (
+        "gauge", "Pooled connections by database and state (idle or in_use).", None,
+    ),
+}
+
+# api.db.pool stats -> metric name.
+POOL_COUNTERS = {
+    "checkouts": "db_pool_checkouts_total",
+    "waits": "db_pool_waits_total",
+    "wait_seconds": "db_pool_wait_seconds_total",
+    "timeouts": "db_pool_timeouts_total",
+    "connections_created": "db_pool_connections_created_total",
+}
+
+# Query counters of the request being served, see query_wrapper().
+_request_queries = contextvars.ContextVar("request_queries", default=None)
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._flushed_at = 0.0
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._shards_lock:
+                self._shards.append(values)
+            return values
+
+    def inc(self, name, labels, amount=1):
+        values = self._values()
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        values = self._values()
+        key = (name, labels)
+        histogram = values.get(key)
+        if histogram is None:
+            # Per-bucket counts (the last one is +Inf), then the sum.
+            histogram = values[key] = [0] * (len(buckets) + 1) + [0.0]
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def collect(self):
+        """Totals of this process, as {(name, labels): value}."""
+        with self._shards_lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            merge(totals, dict(shard).items())
+        for namespace, stats in cache_stats().items():
+            for result, count in stats.items():
+                if result != "local_entries":
+                    key = (
+                        "cache_operations_total",
+                        (("namespace", namespace), ("result", result)),
+                    )
+                    totals[key] = count
+        for alias, stats in pool_stats().items():
+            labels = (("database", alias),)
+            for stat, name in POOL_COUNTERS.items():
+                totals[(name, labels)] = stats[stat]
+            for state in ("idle", "in_use"):
+                totals[("db_pool_connections", labels + (("state", state),))] = stats[state]
+        return totals
+
+    def flush(self, force=False):
+        """Writes this process' totals to METRICS_DIR (throttled unless forced)."""
+        directory = settings.METRICS_DIR
+        now = time.monotonic()
+        if not directory or (
+            not force and now - self._flushed_at < settings.METRICS_FLUSH_SECONDS
+        ):
+            return
+        self._flushed_at = now
+        os.makedirs(directory, exist_ok=True)
+        write_totals(os.path.join(directory, "%d.json" % os.getpid()), self.collect())
+
+
+def merge(totals, items):
+    for key, value in items:
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(value) if isinstance(value, list) else value
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            totals[key] = current + value
+
+
+registry = Registry()
+# Counts since the last throttled flush would be lost otherwise.
+atexit.register(registry.flush, force=True)
+
+
+EXITED_FILE = "exited.json"
+
+
+def read_totals(path):
+    """{(name, labels): value} from a file written by flush(), or None."""
+    try:
+        with open(path) as f:
+            rows = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {(name, tuple(map(tuple, labels))): value for name, labels, value in rows}
+
+
+def write_totals(path, totals):
+    rows = [[name, labels, value] for (name, labels), value in totals.items()]
+    with open(path + ".tmp", "w") as f:
+        json.dump(rows, f)
+    os.replace(path + ".tmp", path)
+
+
+def directory_lock(directory, exclusive):
+    """
+    flock on METRICS_DIR/.lock: shared while /metrics reads the files,
+    exclusive while a file is folded, so no total is read twice or missed.
+    """
+    lock = open(os.path.join(directory, ".lock"), "a")
+    fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return lock
+
+
+def fold_exited(directory, pid):
+    """
+    Adds the totals of the exited process ``pid`` to EXITED_FILE and removes
+    its file. Gauges are left out: they describe the process, not traffic.
+    Runs in the gunicorn master (``child_exit``), without Django settings.
+    """
+    path = os.path.join(directory, "%d.json" % pid)
+    if not os.path.exists(path):
+        return
+    with directory_lock(directory, exclusive=True):
+        totals = read_totals(path) or {}
+        exited_path = os.path.join(directory, EXITED_FILE)
+        exited = read_totals(exited_path) or {}
+        merge(
+            exited,
+            (
+                (key, value) for key, value in totals.items()
+                if key[0] in METRICS and METRICS[key[0]][0] != "gauge"
+            ),
+        )
+        write_totals(exited_path, exited)
+        os.unlink(path)
+
+
+def collect_all():
+    """Totals of every process that wrote to METRICS_DIR, or of this one."""
+    if not settings.METRICS_DIR:
+        return registry.collect()
+    registry.flush(force=True)
+    totals = {}
+    with directory_lock(settings.METRICS_DIR, exclusive=False):
+        for filename in os.listdir(settings.METRICS_DIR):
+            if not filename.endswith(".json"):
+                continue
+            process_totals = read_totals(os.path.join(settings.METRICS_DIR, filename))
+            if process_totals is not None:
+                merge(totals, process_totals.items())
+    return totals
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+
+
+def render(totals):
+    """Prometheus text exposition of ``totals``."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        rows = sorted(
+            (labels, value) for (metric, labels), value in totals.items() if metric == name
+        )
+        if not rows:
+            continue
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in rows:
+            if kind != "histogram":
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value[:-1]):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, format_labels(labels, [("le", bound)]), cumulative)
+                )
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), value[-1]))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+class RequestQueries:
+    __slots__ = ("by_alias",)
+
+    def __init__(self):
+        self.by_alias = {}  # alias -> [count, seconds]
+
+    def record(self, alias, seconds):
+        stats = self.by_alias.get(alias)
+        if stats is None:
+            stats = self.by_alias[alias] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+
+
+def query_wrapper(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.record(context["connection"].alias, time.perf_counter() - started)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    connection_created receiver: adds query_wrapper to every database
+    connection once, instead of entering execute_wrapper() for each alias
+    on every request. It does nothing outside of MetricsMiddleware.
+    """
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+def start_request():
+    queries = RequestQueries()
+    _request_queries.set(queries)
+    return queries
+
+
+def finish_request():
+    _request_queries.set(None)
+
+
+def observe_predictor_call(status, seconds):
+    registry.observe("predictor_request_duration_seconds", (("status", status),), seconds)
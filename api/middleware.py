@@ -0,0 +1,307 @@
+from asgiref.sync import iscoroutinefunction
+import logging
+import random
+import socket
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.messages.middleware import MessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+
+from api import metrics, profiling
+from api.db import querycheck
+from api.db.replicas import (
+    is_pinned,
+    pin_to_primary,
+    request_pin_key,
+    set_replica_reads,
+)
+from api.models import ProfileCapture
+from users.authentication import token_expired, token_queryset
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """
+    Serves reads of read-only views (``replica_reads = True``) and admin
+    changelists from the read replicas. Callers pinned after a write, and
+    admin users who just saved something, keep reading from the primary.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not settings.DATABASE_REPLICAS:
+            return None
+        view_class = getattr(view_func, "view_class", None)
+        if getattr(view_class, "replica_reads", False) or self.is_admin_changelist(
+            request
+        ):
+            if not is_pinned(request_pin_key(request)):
+                set_replica_reads(True)
+        return None
+
+    def process_response(self, request, response):
+        set_replica_reads(False)
+        if (
+            settings.DATABASE_REPLICAS
+            and request.method == "POST"
+            and request.path.startswith("/admin/")
+        ):
+            pin_to_primary(request_pin_key(request))
+        return response
+
+    def is_admin_changelist(self, request):
+        match = request.resolver_match
+        return (
+            request.method == "GET"
+            and match is not None
+            and match.app_name == "admin"
+            and match.url_name is not None
+            and match.url_name.endswith("_changelist")
+        )
+
+
+
+def is_api_fast_path(request):
+    """
+    True for requests under API_PATH_PREFIXES that cannot use a browser
+    session: they send a token or no session cookie at all.
+    """
+    fast_path = getattr(request, "_api_fast_path", None)
+    if fast_path is None:
+        fast_path = request._api_fast_path = request.path_info.startswith(
+            tuple(settings.API_PATH_PREFIXES)
+        ) and (
+            request.META.get("HTTP_AUTHORIZATION", "").startswith("Token ")
+            or settings.SESSION_COOKIE_NAME not in request.COOKIES
+        )
+    return fast_path
+
+
+class SkipForAPIMixin:
+    """
+    Makes a MiddlewareMixin middleware a no-op on the API fast path, so token
+    API calls skip session loading, messages and clickjacking headers. The
+    admin and requests carrying a session are processed as usual. CSRF stays
+    with Django's own middleware; the API views are csrf_exempt.
+    """
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if is_api_fast_path(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if is_api_fast_path(request):
+            return await self.get_response(request)
+        return await super().__acall__(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if is_api_fast_path(request) or not hasattr(super(), "process_view"):
+            return None
+        return super().process_view(request, view_func, view_args, view_kwargs)
+
+
+class APISessionMiddleware(SkipForAPIMixin, SessionMiddleware):
+    pass
+
+
+class APIAuthenticationMiddleware(SkipForAPIMixin, AuthenticationMiddleware):
+    pass
+
+
+class APIMessageMiddleware(SkipForAPIMixin, MessageMiddleware):
+    pass
+
+
+class APIXFrameOptionsMiddleware(SkipForAPIMixin, XFrameOptionsMiddleware):
+    pass
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Records latency, response size and SQL query count/time per view in
+    api.metrics. Put it first in MIDDLEWARE so the whole stack is timed.
+    """
+
+    def process_request(self, request):
+        request._metrics_started = time.perf_counter()
+        request._metrics_queries = metrics.start_request()
+
+    def process_response(self, request, response):
+        started = getattr(request, "_metrics_started", None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        metrics.finish_request()
+
+        match = request.resolver_match
+        view = (match.view_name if match else None) or "unmatched"
+        labels = (
+            ("view", view),
+            ("method", request.method),
+            ("status", str(response.status_code)),
+        )
+        registry = metrics.registry
+        registry.observe("http_request_duration_seconds", labels, elapsed)
+        if response.streaming:
+            size = int(response.get("Content-Length") or 0)
+        else:
+            size = len(response.content)
+        registry.observe("http_response_size_bytes", (("view", view),), size)
+        for alias, (count, seconds) in request._metrics_queries.by_alias.items():
+            db_labels = (("view", view), ("database", alias))
+            registry.inc("db_queries_total", db_labels, count)
+            registry.inc("db_query_duration_seconds_total", db_labels, seconds)
+        registry.flush()
+        return response
+
+
+class QueryCheckMiddleware(MiddlewareMixin):
+    """
+    Reports repeated query shapes (N+1 patterns) and slow queries of each
+    request with api.db.querycheck: QUERY_CHECK=log logs them as warnings,
+    QUERY_CHECK=raise turns them into a server error. The middleware removes
+    itself with QUERY_CHECK=off.
+    """
+
+    def __init__(self, get_response):
+        if settings.QUERY_CHECK not in ("log", "raise"):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_request(self, request):
+        request._query_check = querycheck.start_check()
+
+    def process_response(self, request, response):
+        check = getattr(request, "_query_check", None)
+        if check is None:
+            return response
+        checker, token = check
+        querycheck.finish_check(token)
+        problems = checker.problems()
+        if not problems:
+            return response
+        match = request.resolver_match
+        label = "Query problems in %s %s (%s)" % (
+            request.method, request.path, (match.view_name if match else None) or "unmatched"
+        )
+        if settings.QUERY_CHECK == "raise":
+            raise querycheck.QueryProblems(label, problems)
+        logger.warning(
+            "%s: %d", label, len(problems), extra={"query_problems": problems}
+        )
+        return response
+
+
+class ProfilerMiddleware(MiddlewareMixin):
+    """
+    Profiles single requests to the views in PROFILER_VIEW_MODULES: staff
+    users opt in with an ``X-Profile: cprofile`` or ``X-Profile: sample``
+    header, and PROFILER_SAMPLE_RATE of all other requests get the sampling
+    profiler. Profiles are written to PROFILER_DIR (the oldest beyond
+    PROFILER_MAX_FILES are deleted), listed in the admin as ProfileCapture
+    rows and named in the ``X-Profile-Id`` response header.
+
+    The middleware removes itself unless PROFILER_ENABLED is set. Put it last
+    in MIDDLEWARE so only the view is profiled.
+    """
+
+    def __init__(self, get_response):
+        if not settings.PROFILER_ENABLED:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.hostname = socket.gethostname()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            view_func.__module__ not in settings.PROFILER_VIEW_MODULES
+            or iscoroutinefunction(view_func)
+        ):
+            return None
+        requested = request.META.get("HTTP_X_PROFILE")
+        if requested:
+            user = self.get_staff_user(request)
+            if user is None or requested not in profiling.KINDS:
+                return None
+            kind = requested
+        elif settings.PROFILER_SAMPLE_RATE and random.random() < settings.PROFILER_SAMPLE_RATE:
+            user, kind = None, "sample"
+        else:
+            return None
+
+        profiler = profiling.RequestProfiler(kind)
+        started = time.perf_counter()
+        profiler.start()
+        response = None
+        try:
+            response = view_func(request, *view_args, **view_kwargs)
+            # DRF responses render their content after the middleware chain.
+            if hasattr(response, "render") and callable(response.render):
+                response = response.render()
+        finally:
+            profiler.stop()
+            duration_ms = (time.perf_counter() - started) * 1000
+            capture_id = self.save(
+                request, profiler, user, duration_ms,
+                response.status_code if response is not None else None,
+            )
+        if capture_id is not None:
+            response["X-Profile-Id"] = str(capture_id)
+        return response
+
+    def get_staff_user(self, request):
+        """The staff user sending the request (by token or session), or None."""
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            # API fast-path requests are only authenticated by the view.
+            header = request.META.get("HTTP_AUTHORIZATION", "")
+            if not header.startswith("Token "):
+                return None
+            # is_staff and is_active are among AUTH_USER_FIELDS.
+            token = (
+                token_queryset()
+                .filter(key=header[len("Token "):].strip())
+                .first()
+            )
+            if token is None or token_expired(token, timezone.now()):
+                return None
+            user = token.user
+        if user is None or not user.is_active or not user.is_staff:
+            return None
+        return user
+
+    def save(self, request, profiler, user, duration_ms, status_code):
+        try:
+            file_name = profiler.save(
+                "%s-%s" % (time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:12])
+            )
+            capture = ProfileCapture.objects.create(
+                path=request.path[:255],
+                view_name=request.resolver_match.view_name or "",
+                method=request.method,
+                user=user,
+                kind=profiler.kind,
+                duration_ms=duration_ms,
+                status_code=status_code,
+                hostname=self.hostname,
+                file_name=file_name,
+            )
+            removed = profiling.rotate()
+            if removed:
+                ProfileCapture.objects.filter(
+                    hostname=self.hostname, file_name__in=removed
+                ).delete()
+        except Exception:
+            # A failed capture must not fail the request being profiled.
+            logger.exception("Could not save the request profile")
+            return None
+        return capture.pk
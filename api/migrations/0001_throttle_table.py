@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from api.throttling import create_table_sql
+
+
+def create_throttle_table(apps, schema_editor):
+    # Counters are disposable: UNLOGGED skips the WAL on PostgreSQL.
+    unlogged = schema_editor.connection.vendor == "postgresql"
+    schema_editor.execute(create_table_sql(unlogged=unlogged))
+
+
+def drop_throttle_table(apps, schema_editor):
+    schema_editor.execute("DROP TABLE IF EXISTS api_throttle")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = []
+
+    operations = [
+        migrations.RunPython(create_throttle_table, drop_throttle_table),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.1 on 2026-10-19 17:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0001_throttle_table'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileCapture',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Captured')),
+                ('path', models.CharField(max_length=255)),
+                ('view_name', models.CharField(blank=True, max_length=255)),
+                ('method', models.CharField(max_length=10)),
+                ('kind', models.CharField(choices=[('cprofile', 'cProfile'), ('sample', 'Sampling')], max_length=10)),
+                ('duration_ms', models.FloatField()),
+                ('status_code', models.PositiveSmallIntegerField(null=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
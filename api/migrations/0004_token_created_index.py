@@ -0,0 +1,27 @@
+from django.db import migrations
+
+from api.db.indexes import create_index, drop_index
+
+
+def create_created_index(apps, schema_editor):
+    create_index(schema_editor, "authtoken_token_created_idx", "authtoken_token", "created")
+
+
+def drop_created_index(apps, schema_editor):
+    drop_index(schema_editor, "authtoken_token_created_idx")
+
+
+class Migration(migrations.Migration):
+    # authtoken_token belongs to DRF; the index serves the expiry sweep
+    # (purge_expired_tokens) on its created column. CREATE INDEX
+    # CONCURRENTLY cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ("api", "0003_idempotencyrecord"),
+        ("authtoken", "0003_tokenproxy"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_created_index, drop_created_index),
+    ]
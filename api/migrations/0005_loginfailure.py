@@ -0,0 +1,21 @@
+# Generated by Django 4.2.1 on 2026-10-19 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_token_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginFailure',
+            fields=[
+                ('user_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('failures', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,62 @@
+from django.conf import settings
 from django.db import models
+from rest_framework.utils.encoders import JSONEncoder
 
-# Create your models here.
+
+class ProfileCapture(models.Model):
+    """A request profiled by api.middleware.ProfilerMiddleware."""
+
+    KIND_CHOICES = [("cprofile", "cProfile"), ("sample", "Sampling")]
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Captured")
+    path = models.CharField(max_length=255)
+    view_name = models.CharField(max_length=255, blank=True)
+    method = models.CharField(max_length=10)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        db_constraint=False,
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    duration_ms = models.FloatField()
+    status_code = models.PositiveSmallIntegerField(null=True)
+    # Profiles are written to the PROFILER_DIR of the host that served the
+    # request.
+    hostname = models.CharField(max_length=255)
+    file_name = models.CharField(max_length=255)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return "%s %s (%s)" % (self.method, self.path, self.created_at)
+
+
+class IdempotencyRecord(models.Model):
+    """The response stored under an Idempotency-Key, see api.idempotency."""
+
+    # sha256 of the view, the user and the client's key.
+    key = models.CharField(max_length=64, primary_key=True)
+    # sha256 of the request data, to refuse a reused key.
+    fingerprint = models.CharField(max_length=64)
+    # Both empty while the first request with the key is running.
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True, encoder=JSONEncoder)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
+class LoginFailure(models.Model):
+    """Failed logins of a user without Redis, see api.passwords."""
+
+    user_id = models.BigIntegerField(primary_key=True)
+    failures = models.PositiveIntegerField()
+    # The end of the window opened by the first failure.
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "%s: %s" % (self.user_id, self.failures)
@@ -0,0 +1,78 @@
+"""
+Admin paginator for tables too large to count or to page through with OFFSET.
+
+``EstimatedCountPaginator`` answers ``count`` for an unfiltered queryset from
+PostgreSQL's planner statistics (``pg_class.reltuples``, refreshed by
+autovacuum/ANALYZE) once the table holds ESTIMATE_ABOVE rows or more; filtered
+querysets and small tables are counted exactly. Page numbers past the
+estimate show an empty page.
+
+Deep pages of a changelist ordered by primary key only (the admin default)
+seek: the first key of the page is read from the primary key index, then the
+page is read as a key range, instead of fetching and discarding every row
+before it::
+
+    class UserAdmin(admin.ModelAdmin):
+        paginator = EstimatedCountPaginator
+        show_full_result_count = False
+"""
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+
+def estimated_count(model, using):
+    """The planner's row estimate for ``model``'s table, or None."""
+    if connections[using].vendor != "postgresql":
+        return None
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [connections[using].ops.quote_name(model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    # -1 until the table is first analyzed.
+    if row is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    estimate_above = 100_000
+    seek_from_offset = 1000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not (
+            queryset.query.where or queryset.query.distinct
+        ):
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.estimate_above:
+                return estimate
+        return super().count
+
+    def seek_order(self):
+        """``"pk"``/``"-pk"`` when the queryset is ordered by primary key alone."""
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet) or len(queryset.query.order_by) != 1:
+            return None
+        name = queryset.query.order_by[0]
+        pk = queryset.model._meta.pk
+        if isinstance(name, str) and name.lstrip("-") in ("pk", pk.name, pk.attname):
+            return "-pk" if name.startswith("-") else "pk"
+        return None
+
+    def page(self, number):
+        number = self.validate_number(number)
+        offset = (number - 1) * self.per_page
+        order = self.seek_order()
+        if order is None or offset < self.seek_from_offset:
+            return super().page(number)
+        first = list(self.object_list.values_list("pk", flat=True)[offset : offset + 1])
+        if not first:
+            return self._get_page([], number, self)
+        lookup = "pk__lte" if order == "-pk" else "pk__gte"
+        rows = self.object_list.filter(**{lookup: first[0]})[: self.per_page]
+        return self._get_page(rows, number, self)
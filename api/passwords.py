@@ -0,0 +1,171 @@
+"""
+Password hashing off the request threads, and failed login counters.
+
+PBKDF2 keeps a core busy for tens of milliseconds per hash. ``check_password``
+and ``make_password`` hand the work to a pool of PASSWORD_HASH_WORKERS
+processes per server process, so a login spike queues on the pool instead of
+starving the worker's other threads (or the event loop, through
+``acheck_password``/``amake_password``). With PASSWORD_HASH_WORKERS=0 hashing
+runs on the calling thread.
+
+Failed logins are counted per account in LOGIN_FAILURE_CACHE (Redis, whose
+``incr`` is atomic) or, without it, in the ``api_loginfailure`` table with
+a single upsert per failure. Once an account has LOGIN_MAX_FAILURES failures
+within LOGIN_FAILURE_WINDOW_SECONDS of the first one, the login views reject
+further attempts without hashing.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.cache import caches
+from django.db import connections, router
+from django.utils import timezone
+
+# Counts a failure in a single statement; a row whose window is over starts
+# a new one.
+FAILURE_UPSERT_SQL = (
+    "INSERT INTO api_loginfailure (user_id, failures, expires_at) VALUES (%s, 1, %s) "
+    "ON CONFLICT (user_id) DO UPDATE SET "
+    "failures = CASE WHEN api_loginfailure.expires_at > %s "
+    "THEN api_loginfailure.failures + 1 ELSE 1 END, "
+    "expires_at = CASE WHEN api_loginfailure.expires_at > %s "
+    "THEN api_loginfailure.expires_at ELSE excluded.expires_at END"
+)
+# Expired failure rows are deleted once every this many failures per process.
+PURGE_EVERY = 1000
+_failures = itertools.count(1)
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _setup_worker():
+    # Spawned workers start without Django; they inherit
+    # DJANGO_SETTINGS_MODULE from the environment.
+    django.setup()
+
+
+def _check(password, encoded):
+    """(is the password correct, should ``encoded`` be rehashed)."""
+    rehash = []
+    correct = hashers.check_password(password, encoded, setter=rehash.append)
+    return correct, bool(rehash)
+
+
+def get_pool():
+    """The process's hashing pool, or None when hashing runs inline."""
+    global _pool, _pool_pid
+    if not settings.PASSWORD_HASH_WORKERS:
+        return None
+    # A forked child (e.g. a gunicorn worker of a preloaded app) cannot use
+    # its parent's pool.
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.PASSWORD_HASH_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_setup_worker,
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown()
+        _pool = None
+
+
+def check_password(password, encoded):
+    """Returns (correct, rehash); see django.contrib.auth.hashers.check_password."""
+    pool = get_pool()
+    if pool is None:
+        return _check(password, encoded)
+    return pool.submit(_check, password, encoded).result()
+
+
+def make_password(password):
+    pool = get_pool()
+    if pool is None:
+        return hashers.make_password(password)
+    return pool.submit(hashers.make_password, password).result()
+
+
+async def acheck_password(password, encoded):
+    pool = get_pool()
+    if pool is None:
+        return await sync_to_async(_check, thread_sensitive=False)(password, encoded)
+    return await asyncio.wrap_future(pool.submit(_check, password, encoded))
+
+
+async def amake_password(password):
+    pool = get_pool()
+    if pool is None:
+        return await sync_to_async(hashers.make_password, thread_sensitive=False)(
+            password
+        )
+    return await asyncio.wrap_future(pool.submit(hashers.make_password, password))
+
+
+def _failures_key(user_id):
+    return "login-failures:%s" % user_id
+
+
+def _failure_rows():
+    # Not imported at the top: the hashing processes import this module
+    # before django.setup().
+    from api.models import LoginFailure
+
+    return LoginFailure.objects
+
+
+def login_failures(user_id):
+    if settings.LOGIN_FAILURE_CACHE:
+        return caches[settings.LOGIN_FAILURE_CACHE].get(_failures_key(user_id), 0)
+    failures = _failure_rows().filter(user_id=user_id, expires_at__gt=timezone.now())
+    return failures.values_list("failures", flat=True).first() or 0
+
+
+def record_login_failure(user_id):
+    window = settings.LOGIN_FAILURE_WINDOW_SECONDS
+    if settings.LOGIN_FAILURE_CACHE:
+        cache = caches[settings.LOGIN_FAILURE_CACHE]
+        key = _failures_key(user_id)
+        cache.add(key, 0, timeout=window)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr().
+            cache.set(key, 1, timeout=window)
+        return
+
+    now = timezone.now()
+    if next(_failures) % PURGE_EVERY == 0:
+        _failure_rows().filter(expires_at__lt=now).delete()
+    connection = connections[router.db_for_write(_failure_rows().model)]
+    adapt = connection.ops.adapt_datetimefield_value
+    with connection.cursor() as cursor:
+        cursor.execute(
+            FAILURE_UPSERT_SQL,
+            [user_id, adapt(now + timedelta(seconds=window)), adapt(now), adapt(now)],
+        )
+
+
+def clear_login_failures(user_id):
+    if settings.LOGIN_FAILURE_CACHE:
+        caches[settings.LOGIN_FAILURE_CACHE].delete(_failures_key(user_id))
+    else:
+        _failure_rows().filter(user_id=user_id).delete()
@@ -0,0 +1,141 @@
+"""
+Profilers for single live requests, used by api.middleware.ProfilerMiddleware.
+
+``cprofile`` records every call with cProfile (exact, but slows the request
+down noticeably); ``sample`` walks the request thread's stack from a helper
+thread every PROFILER_SAMPLE_INTERVAL seconds and writes folded stacks
+(``frame;frame;frame count``, the input format of flamegraph tools) at a
+much smaller cost.
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+from django.conf import settings
+
+KINDS = ("cprofile", "sample")
+EXTENSIONS = {"cprofile": ".prof", "sample": ".folded"}
+
+
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+                )
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+
+class RequestProfiler:
+    def __init__(self, kind):
+        if kind not in KINDS:
+            raise ValueError("Unknown profiler %r" % kind)
+        self.kind = kind
+        if kind == "cprofile":
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = SamplingProfiler(settings.PROFILER_SAMPLE_INTERVAL)
+
+    def start(self):
+        if self.kind == "cprofile":
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        if self.kind == "cprofile":
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+
+    def save(self, name):
+        """Writes the profile to PROFILER_DIR; returns its file name."""
+        os.makedirs(settings.PROFILER_DIR, exist_ok=True)
+        file_name = name + EXTENSIONS[self.kind]
+        path = os.path.join(settings.PROFILER_DIR, file_name)
+        if self.kind == "cprofile":
+            self.profiler.dump_stats(path)
+        else:
+            self.profiler.dump(path)
+        return file_name
+
+
+def rotate():
+    """
+    Deletes the oldest profiles beyond PROFILER_MAX_FILES; returns the names
+    of the deleted files.
+    """
+    try:
+        names = sorted(
+            (entry.stat().st_mtime, entry.name)
+            for entry in os.scandir(settings.PROFILER_DIR)
+            if entry.is_file()
+        )
+    except FileNotFoundError:
+        return []
+    removed = []
+    for _, name in names[: max(0, len(names) - settings.PROFILER_MAX_FILES)]:
+        try:
+            os.remove(os.path.join(settings.PROFILER_DIR, name))
+        except FileNotFoundError:
+            pass
+        removed.append(name)
+    return removed
+
+
+def render(file_name, limit=40):
+    """Human-readable report of a saved profile, for the admin."""
+    path = os.path.join(settings.PROFILER_DIR, file_name)
+    if not os.path.exists(path):
+        return "The profile file is not available on this host."
+    if file_name.endswith(EXTENSIONS["cprofile"]):
+        out = io.StringIO()
+        stats = pstats.Stats(path, stream=out)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    stacks = Counter()
+    own = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            stacks[stack] = int(count)
+            own[stack.rsplit(";", 1)[-1]] += int(count)
+    total = sum(stacks.values()) or 1
+    lines = ["%d samples" % total, "", "Top frames (self):"]
+    for frame, count in own.most_common(limit):
+        lines.append("%6.1f%%  %s" % (100.0 * count / total, frame))
+    lines += ["", "Top stacks:"]
+    for stack, count in stacks.most_common(10):
+        lines.append("%6.1f%%  %s" % (100.0 * count / total, stack.replace(";", "\n         ")))
+    return "\n".join(lines)
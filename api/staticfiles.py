@@ -0,0 +1,58 @@
+"""
+Static files storage that writes content-hashed names and precompressed
+siblings, so nginx (``gzip_static``) or ``api.views.serve_static`` can serve
+every asset with far-future immutable caching.
+"""
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+# Formats that are already compressed gain nothing from gzip/brotli.
+COMPRESSIBLE_EXTENSIONS = {
+    ".css", ".js", ".mjs", ".map", ".json", ".svg", ".txt", ".html", ".xml",
+    ".ico", ".eot", ".ttf", ".otf",
+}
+# Don't bother for files that fit in a packet anyway.
+MIN_COMPRESS_SIZE = 256
+
+# Content-Encoding value -> file suffix, in order of preference.
+ENCODINGS = {"br": ".br", "gzip": ".gz"} if brotli else {"gzip": ".gz"}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    # Files referenced from templates but missing from the manifest fall back
+    # to their plain name instead of raising ValueError.
+    manifest_strict = False
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        # Only the hashed names are referenced by {% static %}, so only those
+        # need compressed siblings.
+        for name in self.hashed_files.values():
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                self.compress(name)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+        variants = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = brotli.compress(content, quality=11)
+        for suffix, compressed in variants.items():
+            compressed_name = name + suffix
+            if self.exists(compressed_name):
+                # Hashed names are immutable, an existing sibling is current.
+                continue
+            if len(compressed) < len(content):
+                self._save(compressed_name, ContentFile(compressed))
@@ -0,0 +1,136 @@
+"""
+Query and outbound-call budgets for endpoint tests.
+
+A budget lists the queries an endpoint is expected to issue, each one as
+``"<VERB> <table>"``::
+
+    with self.assertBudget(["SELECT authtoken_token", "INSERT api_throttle"]):
+        self.client.post("/api/users/profile/?fields=username", headers=auth)
+
+Any difference fails the test with a diff of the expected and the issued
+queries followed by their full SQL. The cycle predictor is replaced by a
+stand-in whose calls count against ``predictor_calls``.
+"""
+import difflib
+import math
+import re
+from contextlib import contextmanager
+from unittest import mock
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from api.cache import cache_namespace, cache_stats
+from api.db import querycheck
+
+_TABLE = re.compile(
+    r'^\s*(?:SELECT\b.*?\bFROM|INSERT(?: OR \w+)? INTO|UPDATE|DELETE FROM)\s+"?(\w+)"?',
+    re.I | re.S,
+)
+
+
+def describe(sql):
+    """``"<VERB> <table>"`` for a statement, or its first two words."""
+    words = sql.split()
+    verb = words[0].upper() if words else ""
+    match = _TABLE.match(sql)
+    if match:
+        return "%s %s" % (verb, match.group(1))
+    return " ".join(words[:2])
+
+
+class StandInResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class PredictorStandIn:
+    """Answers for users.predictor._post/_apost and counts the calls."""
+
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.calls = []
+
+    def post(self, payload):
+        self.calls.append(payload)
+        return StandInResponse(self.status_code, self.data)
+
+    async def apost(self, payload):
+        return self.post(payload)
+
+
+class BudgetMixin:
+    predictor_data = {"predicted_phase": "follicular"}
+
+    def setUp(self):
+        super().setUp()
+        # Cached allergens and predictions would hide queries and calls.
+        caches["default"].clear()
+        for name in cache_stats():
+            cache_namespace(name).local.clear()
+        self.predictor = PredictorStandIn(self.predictor_data)
+        for target, stand_in in (
+            ("users.predictor._post", self.predictor.post),
+            ("users.predictor._apost", self.predictor.apost),
+        ):
+            patcher = mock.patch(target, stand_in)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @contextmanager
+    def assertBudget(self, queries, predictor_calls=0):
+        calls = len(self.predictor.calls)
+        # Counts the queries of every thread the request runs on (async views
+        # query from sync_to_async threads).
+        checker, token = querycheck.start_check(threshold=math.inf, slow_ms=math.inf)
+        try:
+            yield checker
+        finally:
+            querycheck.finish_check(token)
+
+        # Backends differ in how they issue BEGIN and savepoints.
+        statements = [
+            (sql, params)
+            for alias, sql, params in checker.queries
+            if not querycheck.is_transaction_control(sql)
+        ]
+        issued = ["%s -- %r" % (sql, params) if params else sql for sql, params in statements]
+        described = [describe(sql) for sql, params in statements]
+        if described != list(queries):
+            diff = difflib.unified_diff(
+                list(queries),
+                described,
+                "budget (%d queries)" % len(queries),
+                "issued (%d queries)" % len(issued),
+                lineterm="",
+            )
+            self.fail(
+                "Query budget not met:\n%s\n\nIssued SQL:\n%s"
+                % (
+                    "\n".join(diff),
+                    "\n".join("%d. %s" % (i, sql) for i, sql in enumerate(issued, 1)),
+                )
+            )
+        self.assertEqual(
+            len(self.predictor.calls) - calls,
+            predictor_calls,
+            "Predictor call budget not met",
+        )
+
+
+BUDGET_SETTINGS = override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    # Spawned hashing processes would not see the overridden hashers.
+    PASSWORD_HASH_WORKERS=0,
+)
+
+
+@BUDGET_SETTINGS
+class BudgetTestCase(BudgetMixin, TestCase):
+    pass
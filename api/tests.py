@@ -1,3 +1,592 @@
-from django.test import TestCase
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from psycopg2 import extensions
+from django.db import connection, models
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api import cache, passwords
+from api.benchmark import without_throttling
+from api.db.pool import ConnectionPool
+from api.logging import JsonFormatter, QueueHandler, RateLimitFilter, SamplingFilter
+from api.db.routers import ShardRouter
+from api.db.sharding import jump_hash, shard_for_user
+from api import metrics
+from api.metrics import registry, render
+from api.models import LoginFailure
+from api.middleware import ProfilerMiddleware
+from api.pagination import EstimatedCountPaginator
+from api.throttling import (
+    CacheThrottleBackend,
+    SlidingWindowRateThrottle,
+    SQLiteThrottleBackend,
+    SQLThrottleBackend,
+    UserRateThrottle,
+)
+from api.testing import BudgetTestCase, describe
+from users import predictor
+from users.models import Allergen, CycleModel, HeightModel, User, WeightModel
+
+
+class APIEndpointBudgetTests(BudgetTestCase):
+    def test_metrics(self):
+        with self.assertBudget([]):
+            response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_ALLOWED_NETWORKS=["10.0.0.0/8"], METRICS_TOKEN="scrape")
+    def test_metrics_requires_allowed_network_or_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        response = self.client.get("/metrics", REMOTE_ADDR="10.1.2.3")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer scrape"})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(response.status_code, 403)
+
+    def test_admin_login_page(self):
+        with self.assertBudget([]):
+            response = self.client.get("/admin/login/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_index(self):
+        admin = User.objects.create_superuser("admin@example.com", "admin password")
+        self.client.force_login(admin)
+        budget = ["SELECT django_session", "SELECT users_user", "SELECT django_admin_log"]
+        with self.assertBudget(budget):
+            response = self.client.get("/admin/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_admin_user_changelist(self):
+        admin = User.objects.create_superuser("admin@example.com", "admin password")
+        self.client.force_login(admin)
+        budget = [
+            "SELECT django_session",
+            "SELECT users_user",
+            "SELECT users_user",  # count
+            "SELECT users_user",
+            "SELECT users_user",  # date hierarchy range
+            "SELECT users_user",  # date hierarchy days
+        ]
+        with self.assertBudget(budget):
+            response = self.client.get("/admin/users/user/")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(DATABASE_SHARDS=["default"])
+    def test_admin_weight_changelist_sharded(self):
+        admin = User.objects.create_superuser("admin@example.com", "admin password")
+        self.client.force_login(admin)
+        response = self.client.get("/admin/users/weightmodel/")
+        self.assertRedirects(response, "/admin/")
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Allergen.objects.bulk_create(Allergen(name="allergen %d" % i) for i in range(10))
+
+    def test_deep_pages_seek(self):
+        queryset = Allergen.objects.order_by("-pk")
+        paginator = EstimatedCountPaginator(queryset, 3)
+        paginator.seek_from_offset = 3
+        # The count, the page's first key and the page.
+        with self.assertNumQueries(3):
+            rows = list(paginator.page(3).object_list)
+        self.assertEqual(rows, list(queryset[6:9]))
+        self.assertEqual(list(paginator.page(4).object_list), list(queryset[9:]))
+
+    def test_other_orderings_use_offsets(self):
+        paginator = EstimatedCountPaginator(Allergen.objects.order_by("name"), 3)
+        paginator.seek_from_offset = 0
+        self.assertIsNone(paginator.seek_order())
+        self.assertEqual(len(paginator.page(2).object_list), 3)
+
+    @skipUnless(connection.vendor == "postgresql", "planner statistics are PostgreSQL's")
+    def test_estimated_count(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE users_allergen")
+        paginator = EstimatedCountPaginator(Allergen.objects.order_by("pk"), 3)
+        paginator.estimate_above = 1
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 10)
+        filtered = EstimatedCountPaginator(Allergen.objects.filter(pk__gt=0), 3)
+        self.assertEqual(filtered.count, 10)
+
+
+class BudgetTests(BudgetTestCase):
+    def test_describe(self):
+        self.assertEqual(
+            describe('SELECT "users_user"."id" FROM "users_user" WHERE "users_user"."id" = %s'),
+            "SELECT users_user",
+        )
+        self.assertEqual(
+            describe('INSERT OR IGNORE INTO "users_user_allergens" ("user_id") VALUES (%s)'),
+            "INSERT users_user_allergens",
+        )
+        self.assertEqual(describe("DELETE FROM api_throttle WHERE expires_at < %s"), "DELETE api_throttle")
+
+    def test_exceeded_budget_shows_sql_diff(self):
+        with self.assertRaises(AssertionError) as raised:
+            with self.assertBudget(["SELECT users_user"]):
+                list(User.objects.all())
+                User.objects.filter(pk=1).exists()
+        message = str(raised.exception)
+        self.assertIn("--- budget (1 queries)\n+++ issued (2 queries)", message)
+        self.assertIn("+SELECT users_user", message)
+        self.assertIn("Issued SQL:\n1. SELECT ", message)
+        self.assertIn("\n2. SELECT ", message)
+
+    def test_predictor_call_budget(self):
+        with self.assertRaises(AssertionError):
+            with self.assertBudget([]):
+                predictor._post({"cycle_day": 1})
+
+
+@override_settings(PASSWORD_HASH_WORKERS=1)
+class PasswordPoolTests(SimpleTestCase):
+    def tearDown(self):
+        passwords.shutdown_pool()
+
+    def test_hashes_in_worker_process(self):
+        encoded = passwords.make_password("secret")
+        self.assertTrue(hashers.check_password("secret", encoded))
+        self.assertEqual(passwords.check_password("secret", encoded), (True, False))
+        self.assertEqual(passwords.check_password("wrong", encoded), (False, False))
+
+    def test_rehash_of_outdated_hash(self):
+        hasher = hashers.PBKDF2PasswordHasher()
+        encoded = hasher.encode("secret", hasher.salt(), iterations=1000)
+        self.assertEqual(passwords.check_password("secret", encoded), (True, True))
+
+
+class LoginFailureTests(TestCase):
+    def test_counts_in_table_within_window(self):
+        passwords.record_login_failure(7)
+        passwords.record_login_failure(7)
+        self.assertEqual(passwords.login_failures(7), 2)
+        LoginFailure.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(passwords.login_failures(7), 0)
+        passwords.record_login_failure(7)
+        self.assertEqual(passwords.login_failures(7), 1)
+        passwords.clear_login_failures(7)
+        self.assertFalse(LoginFailure.objects.exists())
+
+    @override_settings(
+        CACHES={"failures": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        LOGIN_FAILURE_CACHE="failures",
+    )
+    def test_counts_in_cache(self):
+        with self.assertNumQueries(0):
+            passwords.record_login_failure(7)
+            passwords.record_login_failure(7)
+            self.assertEqual(passwords.login_failures(7), 2)
+            passwords.clear_login_failures(7)
+            self.assertEqual(passwords.login_failures(7), 0)
+
+
+class FakeConnection:
+    closed = False
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def test_stale_connections_are_reaped(self):
+        pool = ConnectionPool(
+            FakeConnection, min_size=1, max_size=5, max_idle=60, health_check_interval=120
+        )
+        connections = [pool.getconn() for _ in range(3)]
+        for conn in connections:
+            pool.putconn(conn)
+        # The most recently returned connection keeps being reused; the
+        # others go stale at the bottom of the stack.
+        now = time.monotonic()
+        with mock.patch("api.db.pool.time.monotonic", return_value=now + 50):
+            pool.putconn(pool.getconn())
+        with mock.patch("api.db.pool.time.monotonic", return_value=now + 61):
+            pool.putconn(pool.getconn())
+        self.assertEqual(pool.snapshot()["size"], 1)
+        self.assertEqual([conn.closed for conn in connections], [True, True, False])
+
+    def test_stats_are_exported(self):
+        pool = ConnectionPool(FakeConnection, max_size=2)
+        pool.putconn(pool.getconn())
+        with mock.patch("api.metrics.pool_stats", return_value={"default": pool.snapshot()}):
+            text = render(registry.collect())
+        self.assertIn('db_pool_checkouts_total{database="default"} 1', text)
+        self.assertIn('db_pool_connections{database="default",state="idle"} 1', text)
+
+
+
+SHARDS = ["shard0", "shard1", "shard2"]
+
+
+class ShardingTests(TestCase):
+    def test_jump_hash_is_stable(self):
+        # Pinned: a change here moves users to other shards.
+        self.assertEqual(
+            [jump_hash(key, 10) for key in (0, 1, 2, 3, 12345, 2**40)], [0, 6, 6, 8, 1, 9]
+        )
+        self.assertEqual({jump_hash(key, 1) for key in range(100)}, {0})
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        for buckets in range(1, 8):
+            moved = 0
+            for key in range(1000):
+                before, after = jump_hash(key, buckets), jump_hash(key, buckets + 1)
+                if before != after:
+                    self.assertEqual(after, buckets)
+                    moved += 1
+            self.assertLess(moved, 2 * 1000 / (buckets + 1))
+
+    def test_unsharded_routes_to_default(self):
+        self.assertEqual(shard_for_user(7), "default")
+        self.assertIsNone(WeightModel.objects.filter(user_id=7)._db)
+
+    def test_measurement_keys_have_no_constraints(self):
+        # Sharding can be enabled on a migrated database without a schema
+        # change, so no settings decide these.
+        for model, name in (
+            (User, "height"), (User, "weight"), (WeightModel, "user"),
+            (HeightModel, "user"), (CycleModel, "user"),
+        ):
+            self.assertFalse(model._meta.get_field(name).db_constraint, (model, name))
+
+    @override_settings(DATABASE_SHARDS=SHARDS)
+    def test_queries_route_by_user(self):
+        for user_id in range(20):
+            shard = SHARDS[jump_hash(user_id, len(SHARDS))]
+            self.assertEqual(shard_for_user(user_id), shard)
+            self.assertEqual(WeightModel.objects.filter(user_id=user_id).db, shard)
+            self.assertEqual(WeightModel.objects.filter(user__pk=user_id).db, shard)
+        self.assertEqual(shard_for_user(None), "default")
+        # Excluding a user says nothing about where the rows are.
+        self.assertIsNone(WeightModel.objects.exclude(user_id=1)._db)
+
+    @override_settings(DATABASE_SHARDS=SHARDS)
+    def test_router_uses_instance_user(self):
+        router = ShardRouter()
+        weight = WeightModel(user_id=5, weight=80)
+        self.assertEqual(router.db_for_write(WeightModel, instance=weight), shard_for_user(5))
+        self.assertIsNone(router.db_for_read(WeightModel))
+        weight._state.db = shard_for_user(5)
+        self.assertEqual(router.db_for_read(User, instance=weight), "default")
+
+    @override_settings(DATABASE_SHARDS=SHARDS)
+    def test_bulk_create_groups_by_shard(self):
+        calls = []
+
+        def bulk_create(queryset, objs, *args, **kwargs):
+            calls.append((queryset.db, [obj.user_id for obj in objs]))
+            return objs
+
+        rows = [WeightModel(user_id=user_id, weight=80) for user_id in range(12)]
+        with mock.patch.object(models.QuerySet, "bulk_create", bulk_create):
+            created = WeightModel.objects.bulk_create(rows)
+        self.assertCountEqual(created, rows)
+        self.assertEqual(len(calls), len({shard_for_user(obj.user_id) for obj in rows}))
+        for alias, user_ids in calls:
+            self.assertEqual({shard_for_user(user_id) for user_id in user_ids}, {alias})
+
+    def test_rebalance_requires_shards(self):
+        with self.assertRaises(CommandError):
+            call_command("rebalance_shards")
+
+    @override_settings(DATABASE_SHARDS=["default"])
+    def test_rebalance_reports_misplaced_rows(self):
+        user = User.objects.create(
+            username="shard@example.com", email="shard@example.com", gender=User.MAN,
+            goal=User.MAINTENANCE, activity_level=User.MODERATE, target_weight=75,
+        )
+        for value in (81, 80):
+            WeightModel.objects.create(user=user, weight=value)
+        out = StringIO()
+        with mock.patch(
+            "api.management.commands.rebalance_shards.shard_for_user", return_value="shard1"
+        ):
+            call_command("rebalance_shards", "--dry-run", "--user", str(user.pk), stdout=out)
+        self.assertIn(
+            "users.weightmodel: user %s has 2 rows on default, belongs on shard1" % user.pk,
+            out.getvalue(),
+        )
+        self.assertNotIn("heightmodel", out.getvalue())
+        self.assertEqual(WeightModel.objects.filter(user=user).count(), 2)
+
+
+@override_settings(PROFILER_ENABLED=True)
+class ProfilerMiddlewareTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(
+            username="staff@example.com", email="staff@example.com", is_staff=True,
+            gender=User.MAN, goal=User.MAINTENANCE, activity_level=User.MODERATE,
+            target_weight=75,
+        )
+        cls.token = Token.objects.create(user=cls.user)
+
+    def get_staff_user(self, key):
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION="Token %s" % key)
+        return ProfilerMiddleware(lambda request: None).get_staff_user(request)
+
+    def test_staff_token(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_staff_user(self.token.key), self.user)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn("cycle_record_json", queries[0]["sql"])
+        self.assertNotIn("password", queries[0]["sql"])
+
+    def test_expired_token(self):
+        created = timezone.now() - timedelta(seconds=settings.TOKEN_TTL_SECONDS + 1)
+        Token.objects.filter(pk=self.token.pk).update(created=created)
+        self.assertIsNone(self.get_staff_user(self.token.key))
+
+    def test_other_tokens(self):
+        self.assertIsNone(self.get_staff_user("missing"))
+        User.objects.filter(pk=self.user.pk).update(is_staff=False)
+        self.assertIsNone(self.get_staff_user(self.token.key))
+
+
+class FixedThrottle(SlidingWindowRateThrottle):
+    rate = "10/min"
+
+    def get_cache_key(self, request, view):
+        return "throttle_test"
+
+
+class FakeThrottleBackend:
+    def __init__(self, previous, current):
+        self.counts = previous, current
+
+    def hit(self, key, bucket, duration):
+        return self.counts
+
+
+class ThrottleTests(SimpleTestCase):
+    def allow(self, previous, current, elapsed):
+        throttle = FixedThrottle()
+        throttle.timer = lambda: 600 + elapsed
+        with mock.patch(
+            "api.throttling.get_backend",
+            return_value=FakeThrottleBackend(previous, current),
+        ):
+            return throttle, throttle.allow_request(None, None)
+
+    def test_previous_window_is_weighted_by_overlap(self):
+        # A quarter of the window has passed: 3/4 of the previous count.
+        throttle, allowed = self.allow(8, 4, elapsed=15)
+        self.assertEqual(throttle.estimate(), 10)
+        self.assertTrue(allowed)
+        throttle, allowed = self.allow(8, 5, elapsed=15)
+        self.assertFalse(allowed)
+        # 9 - 5 hits are left once the previous window weighs 4: at 30s.
+        self.assertEqual(throttle.wait(), 15)
+        throttle, allowed = self.allow(8, 5, elapsed=45)
+        self.assertEqual(throttle.estimate(), 7)
+        self.assertTrue(allowed)
+
+    def test_full_current_window_waits_into_the_next(self):
+        throttle, allowed = self.allow(0, 12, elapsed=30)
+        self.assertFalse(allowed)
+        self.assertEqual(throttle.wait(), 30 + 60 * (1 - 9 / 12))
+
+    def test_rates_are_read_from_current_settings(self):
+        with without_throttling(), mock.patch("api.throttling.get_backend") as get_backend:
+            self.assertTrue(UserRateThrottle().allow_request(mock.Mock(), None))
+        get_backend.assert_not_called()
+        rates = settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]
+        self.assertEqual(UserRateThrottle().rate, rates["user"])
+
+    def test_sql_backend_is_abstract(self):
+        with self.assertRaises(TypeError):
+            SQLThrottleBackend()
+
+    def test_cache_backend_refuses_file_cache(self):
+        file_cache = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": tempfile.gettempdir(),
+            }
+        }
+        with override_settings(CACHES=file_cache):
+            with self.assertRaises(ImproperlyConfigured):
+                CacheThrottleBackend()
+
+    def test_sqlite_backend_counts_and_purges(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/throttle.sqlite3"
+            with override_settings(THROTTLE_SQLITE_PATH=path):
+                backend = SQLiteThrottleBackend()
+            bucket = int(time.time() // 60)
+            self.assertEqual(backend.hit("a", bucket - 1, 60), (0, 1))
+            self.assertEqual(backend.hit("a", bucket, 60), (1, 1))
+            self.assertEqual(backend.hit("a", bucket, 60), (1, 2))
+            # Expires at (bucket + 2) * duration, long past.
+            backend.hit("b", 1, 60)
+            with mock.patch("api.throttling.PURGE_EVERY", 5):
+                backend.hit("a", bucket, 60)
+            rows = backend.connection().execute(
+                "SELECT throttle_key, bucket FROM api_throttle ORDER BY throttle_key, bucket"
+            ).fetchall()
+            backend.connection().close()
+        self.assertEqual(rows, [("a", bucket - 1), ("a", bucket)])
+
+
+class CacheNamespaceTests(SimpleTestCase):
+    def test_waits_for_other_process_without_stripe_lock(self):
+        namespace = cache.CacheNamespace("wait-test", local_timeout=0, lock_timeout=1)
+        full_key = namespace.make_key("key")
+        # Another process is computing the value.
+        namespace.shared.add(full_key + ":lock", 1, timeout=1)
+        held = []
+
+        def wait_for(key):
+            held.append(any(lock.locked() for lock in cache._compute_locks))
+            namespace.shared.set(key, "theirs", 60)
+            return "theirs"
+
+        try:
+            with mock.patch.object(namespace, "_wait_for", wait_for):
+                value = namespace.get_or_set("key", lambda: "ours")
+        finally:
+            namespace.shared.delete(full_key)
+            namespace.shared.delete(full_key + ":lock")
+        self.assertEqual(value, "theirs")
+        self.assertEqual(held, [False])
+        self.assertEqual(namespace.stats["computes"], 0)
+
+
+def make_record(msg="hello %s", args=("world",), level=logging.INFO, **extra):
+    record = logging.makeLogRecord(
+        {"name": "test", "msg": msg, "args": args, "levelno": level,
+         "levelname": logging.getLevelName(level)}
+    )
+    record.__dict__.update(extra)
+    return record
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LoggingTests(SimpleTestCase):
+    def test_json_formatter(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record(user_id=5, _private=1)
+            record.exc_info = sys.exc_info()
+        data = json.loads(JsonFormatter().format(record))
+        self.assertEqual(data["message"], "hello world")
+        self.assertEqual(data["level"], "INFO")
+        self.assertEqual(data["logger"], "test")
+        self.assertEqual(data["user_id"], 5)
+        self.assertNotIn("_private", data)
+        self.assertIn("ValueError: boom", data["exc_info"])
+
+    def test_sampling_filter(self):
+        sample = SamplingFilter(rate=0.25, level="WARNING")
+        with mock.patch("api.logging.random.random", return_value=0.5):
+            self.assertFalse(sample.filter(make_record()))
+            self.assertTrue(sample.filter(make_record(level=logging.WARNING)))
+        with mock.patch("api.logging.random.random", return_value=0.1):
+            self.assertTrue(sample.filter(make_record()))
+        self.assertTrue(SamplingFilter(rate=1).filter(make_record()))
+
+    def test_rate_limit_filter(self):
+        limit = RateLimitFilter(rate=2, per=1.0)
+        with mock.patch("api.logging.time.monotonic", return_value=100):
+            results = [limit.filter(make_record()) for _ in range(4)]
+            # Other templates have their own bucket.
+            self.assertTrue(limit.filter(make_record(msg="other")))
+        self.assertEqual(results, [True, True, False, False])
+        with mock.patch("api.logging.time.monotonic", return_value=100.5):
+            record = make_record()
+            self.assertTrue(limit.filter(record))
+            self.assertFalse(limit.filter(make_record()))
+        self.assertEqual(record.suppressed, 2)
+
+    def test_queue_handler_writes_to_targets(self):
+        handler = QueueHandler(queue_size=10)
+        target = ListHandler()
+        # Queued until the targets are set.
+        handler.handle(make_record())
+        handler.set_handlers([target])
+        handler.handle(make_record(args=("again",)))
+        handler.close()
+        self.assertEqual(
+            [record.getMessage() for record in target.records],
+            ["hello world", "hello again"],
+        )
+
+    def test_queue_handler_drops_when_full(self):
+        handler = QueueHandler(queue_size=1)
+        for _ in range(3):
+            handler.handle(make_record())
+        self.assertEqual(handler.dropped, 2)
+        handler.close()
+
+    def test_root_logger_is_wired(self):
+        queues = [h for h in logging.getLogger().handlers if isinstance(h, QueueHandler)]
+        self.assertTrue(queues)
+        for handler in queues:
+            self.assertIsInstance(handler.handlers[0].formatter, JsonFormatter)
+
+
+class MetricsDirectoryTests(SimpleTestCase):
+    def write(self, directory, pid, totals):
+        metrics.write_totals("%s/%d.json" % (directory, pid), totals)
+
+    def test_exited_workers_are_folded_without_gauges(self):
+        view = (("view", "profile"),)
+        pool = (("database", "default"), ("state", "idle"))
+        worker = {
+            ("db_queries_total", view): 3,
+            ("http_response_size_bytes", view): [1, 0, 0, 0, 0, 0, 120.0],
+            ("db_pool_connections", pool): 2,
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            self.write(directory, 101, worker)
+            self.write(directory, 102, worker)
+            metrics.fold_exited(directory, 101)
+            metrics.fold_exited(directory, 102)
+            metrics.fold_exited(directory, 103)
+            self.write(directory, 104, worker)
+            self.assertEqual(sorted(os.listdir(directory)), [".lock", "104.json", "exited.json"])
+            exited = metrics.read_totals(directory + "/exited.json")
+            with override_settings(METRICS_DIR=directory), mock.patch.object(
+                registry, "collect", return_value={}
+            ):
+                totals = metrics.collect_all()
+        self.assertEqual(
+            exited,
+            {
+                ("db_queries_total", view): 6,
+                ("http_response_size_bytes", view): [2, 0, 0, 0, 0, 0, 240.0],
+            },
+        )
+        self.assertEqual(totals[("db_queries_total", view)], 9)
+        # Only the live worker's gauge is reported.
+        self.assertEqual(totals[("db_pool_connections", pool)], 2)
@@ -0,0 +1,217 @@
+"""
+Sliding-window rate throttles with a pluggable counter store.
+
+DRF's SimpleRateThrottle keeps a list of request timestamps per client in the
+cache and rewrites it on every request. Here each client costs two integers:
+the hit count of the current fixed window and of the previous one. The
+previous window's count is weighted by how much of it still overlaps the
+sliding window, which approximates a true sliding log closely for any
+steady request rate.
+
+The store is chosen with the THROTTLE_BACKEND setting:
+
+- ``CacheThrottleBackend`` counts with ``cache.incr`` in the Django cache,
+  which must be Redis (the file cache's ``incr`` is not atomic).
+- ``SQLiteThrottleBackend`` keeps the counters in a WAL-mode SQLite file
+  shared by every worker on the node.
+- ``DatabaseThrottleBackend`` keeps them in the ``api_throttle`` table
+  (UNLOGGED on PostgreSQL), shared by every node.
+"""
+import abc
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils.module_loading import import_string
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+UPSERT_SQL = (
+    "INSERT INTO api_throttle (throttle_key, bucket, hits, expires_at) "
+    "VALUES (%s, %s, 1, %s) "
+    "ON CONFLICT (throttle_key, bucket) DO UPDATE SET hits = api_throttle.hits + 1 "
+    "RETURNING hits, "
+    "(SELECT previous.hits FROM api_throttle previous "
+    "WHERE previous.throttle_key = %s AND previous.bucket = %s)"
+)
+PURGE_SQL = "DELETE FROM api_throttle WHERE expires_at < %s"
+
+# Expired windows are deleted once every this many hits per process.
+PURGE_EVERY = 1000
+
+
+def create_table_sql(unlogged=False):
+    return (
+        "CREATE %sTABLE IF NOT EXISTS api_throttle ("
+        "throttle_key varchar(255) NOT NULL, "
+        "bucket bigint NOT NULL, "
+        "hits integer NOT NULL, "
+        "expires_at double precision NOT NULL, "
+        "PRIMARY KEY (throttle_key, bucket))" % ("UNLOGGED " if unlogged else "")
+    )
+
+
+class CacheThrottleBackend:
+    def __init__(self):
+        self.cache = caches[settings.THROTTLE_CACHE]
+        if isinstance(self.cache, FileBasedCache):
+            raise ImproperlyConfigured(
+                "CacheThrottleBackend needs an atomic incr(); set REDIS_URL or "
+                "use another THROTTLE_BACKEND"
+            )
+
+    def hit(self, key, bucket, duration):
+        """Counts a hit in ``bucket``; returns (previous, current) hit counts."""
+        current_key = "%s:%d:%d" % (key, duration, bucket)
+        previous_key = "%s:%d:%d" % (key, duration, bucket - 1)
+        # Each bucket is read for two windows: as current, then as previous.
+        self.cache.add(current_key, 0, timeout=2 * duration)
+        try:
+            current = self.cache.incr(current_key)
+        except ValueError:
+            # Evicted between add() and incr().
+            self.cache.set(current_key, 1, timeout=2 * duration)
+            current = 1
+        return self.cache.get(previous_key, 0), current
+
+
+class SQLThrottleBackend(abc.ABC):
+    """Counts hits with a single upsert that also returns the previous window."""
+
+    def __init__(self):
+        self.hits = 0
+
+    @abc.abstractmethod
+    def execute(self, sql, params):
+        """Runs ``sql`` (``%s`` placeholders) and returns its first row."""
+
+    def hit(self, key, bucket, duration):
+        now = time.time()
+        self.hits += 1
+        if self.hits % PURGE_EVERY == 0:
+            self.execute(PURGE_SQL, [now])
+        current, previous = self.execute(
+            UPSERT_SQL, [key, bucket, (bucket + 2) * duration, key, bucket - 1]
+        )
+        return previous or 0, current
+
+
+class SQLiteThrottleBackend(SQLThrottleBackend):
+    def __init__(self):
+        super().__init__()
+        self.path = settings.THROTTLE_SQLITE_PATH
+        self.local = threading.local()
+
+    def connection(self):
+        # One connection per thread and process (never reused across fork()).
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(create_table_sql())
+            self.local.connection, self.local.pid = connection, pid
+        return self.local.connection
+
+    def execute(self, sql, params):
+        return self.connection().execute(sql.replace("%s", "?"), params).fetchone()
+
+
+class DatabaseThrottleBackend(SQLThrottleBackend):
+    """Uses the ``api_throttle`` table created by ``api`` migration 0001."""
+
+    def __init__(self):
+        super().__init__()
+        self.alias = settings.THROTTLE_DATABASE
+
+    def execute(self, sql, params):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+
+
+@lru_cache(maxsize=None)
+def load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    return load_backend(settings.THROTTLE_BACKEND)
+
+
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    SimpleRateThrottle with a sliding-window counter instead of a timestamp
+    list. Rejected requests are counted too, so a client that keeps sending
+    over its rate stays throttled until it slows down.
+    """
+
+    @property
+    def THROTTLE_RATES(self):
+        # SimpleRateThrottle binds the rates when it is imported; reading them
+        # here lets settings overrides (tests, benchmarks) reach the throttles.
+        return api_settings.DEFAULT_THROTTLE_RATES
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        bucket = int(self.now // self.duration)
+        self.elapsed = self.now - bucket * self.duration
+        self.previous, self.current = get_backend().hit(self.key, bucket, self.duration)
+        return self.estimate() <= self.num_requests
+
+    def estimate(self):
+        overlap = 1 - self.elapsed / self.duration
+        return self.previous * overlap + self.current
+
+    def wait(self):
+        budget = self.num_requests - 1
+        if self.current > budget:
+            # Nothing frees up before this window becomes the previous one.
+            return self.duration - self.elapsed + self.duration * (
+                1 - budget / self.current
+            )
+        if not self.previous:
+            return None
+        freed_at = self.duration * (1 - (budget - self.current) / self.previous)
+        return max(0.0, freed_at - self.elapsed)
+
+
+class UserRateThrottle(SlidingWindowRateThrottle):
+    """Drop-in replacement for rest_framework.throttling.UserRateThrottle."""
+
+    scope = "user"
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {"scope": self.scope, "ident": ident}
+
+
+class AnonRateThrottle(SlidingWindowRateThrottle):
+    """Drop-in replacement for rest_framework.throttling.AnonRateThrottle."""
+
+    scope = "anon"
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return None
+        return self.cache_format % {
+            "scope": self.scope,
+            "ident": self.get_ident(request),
+        }
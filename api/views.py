@@ -1,3 +1,117 @@
-from django.shortcuts import render
+import ipaddress
+import mimetypes
+import os
+from functools import lru_cache
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotModified,
+)
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+
+from api import metrics
+from api.staticfiles import ENCODINGS
+
+# Hashed names change whenever the content does.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=300"
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+@require_safe
+def serve_static(request, path):
+    """
+    Serves collected static files when there is no nginx in front of the app
+    (SERVE_STATIC=1): precompressed siblings are picked from Accept-Encoding
+    and hashed names get far-future immutable caching.
+    """
+    try:
+        fullpath = staticfiles_storage.path(path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+
+    served_path, encoding = fullpath, None
+    accepted = accepted_encodings(request)
+    for candidate, suffix in ENCODINGS.items():
+        if candidate in accepted and os.path.isfile(fullpath + suffix):
+            served_path, encoding = fullpath + suffix, candidate
+            break
+
+    stat = os.stat(served_path)
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        content_type, _ = mimetypes.guess_type(fullpath)
+        response = FileResponse(
+            open(served_path, "rb"),
+            content_type=content_type or "application/octet-stream",
+        )
+        # FileResponse names the .gz/.br sibling here; browsers don't need it.
+        del response.headers["Content-Disposition"]
+        response.headers["Last-Modified"] = http_date(stat.st_mtime)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+
+    hashed_names = staticfiles_storage.hashed_files.values()
+    response.headers["Cache-Control"] = (
+        IMMUTABLE_CACHE_CONTROL if path in hashed_names else DEFAULT_CACHE_CONTROL
+    )
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+@lru_cache(maxsize=None)
+def allowed_networks(networks):
+    return [ipaddress.ip_network(network) for network in networks]
+
+
+def metrics_allowed(request):
+    """Is the client in METRICS_ALLOWED_NETWORKS or holding METRICS_TOKEN."""
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and constant_time_compare(
+            token.strip(), settings.METRICS_TOKEN
+        ):
+            return True
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    return any(
+        address in network
+        for network in allowed_networks(tuple(settings.METRICS_ALLOWED_NETWORKS))
+    )
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint with the totals of all workers. nginx does not
+    expose it; scrape the web containers directly.
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        metrics.render(metrics.collect_all()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
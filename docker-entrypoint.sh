@@ -1,51 +1,29 @@
 #!/bin/bash
 
 # Docker entrypoint script for Django Fitness Application
-# This script will run migrations, collect static files, and start the server
+# This script prepares the database and static files, then starts the server
 
 set -e
 
-# Function to check if PostgreSQL is ready
-postgres_ready() {
-  python << END
-import sys
-import psycopg2
-try:
-    conn = psycopg2.connect(
-        dbname="${DB_NAME}",
-        user="${DB_USER}",
-        password="${DB_PASSWORD}",
-        host="${DB_HOST}",
-        port="${DB_PORT}",
-    )
-except psycopg2.OperationalError:
-    sys.exit(1)
-sys.exit(0)
-END
-}
-
-# Wait for PostgreSQL to be ready
-until postgres_ready; do
-  echo "PostgreSQL is unavailable - waiting..."
-  sleep 2
-done
-echo "PostgreSQL is up - continuing..."
-
-# Collect static files
-echo "Collecting static files..."
-python manage.py collectstatic --noinput
-
-# Apply database migrations
-echo "Applying database migrations..."
-python manage.py migrate
-
-# Create superuser if DJANGO_SUPERUSER_* environment variables are set
-if [ -n "$DJANGO_SUPERUSER_USERNAME" ] && [ -n "$DJANGO_SUPERUSER_PASSWORD" ] && [ -n "$DJANGO_SUPERUSER_EMAIL" ]; then
-  echo "Creating superuser..."
-  python manage.py createsuperuser --noinput
-fi
+# Wait for the databases, apply pending migrations, collect static files if
+# they changed and create the DJANGO_SUPERUSER_* account, in one process.
+python manage.py startup
 
 # Start server
-echo "Starting server..."
-# exec gunicorn fitness_django.wsgi:application --bind 0.0.0.0:8000
-exec python manage.py runserver 0.0.0.0:8004
+# SERVER_MODE=dev (default) runs Django's development server on 8004.
+# SERVER_MODE=gunicorn serves on 8000 with the settings module named by
+# GUNICORN_CONFIG (workers, worker class, recycling: see that module).
+SERVER_MODE="${SERVER_MODE:-dev}"
+echo "Starting server (${SERVER_MODE})..."
+case "$SERVER_MODE" in
+  gunicorn)
+    exec gunicorn -c "${GUNICORN_CONFIG:-python:fitness_django.gunicorn_conf}"
+    ;;
+  dev)
+    exec python manage.py runserver 0.0.0.0:8004
+    ;;
+  *)
+    echo "Unknown SERVER_MODE: ${SERVER_MODE} (expected dev or gunicorn)" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,99 @@
+"""
+Gunicorn settings for production, used by docker-entrypoint.sh when
+SERVER_MODE=gunicorn (``gunicorn -c python:fitness_django.gunicorn_conf``).
+
+GUNICORN_WORKER_CLASS picks the worker model:
+- ``gthread`` (default): WSGI app, (CPUs + 1) processes with
+  GUNICORN_THREADS threads each.
+- ``uvicorn``: ASGI app served by uvicorn workers, one process per CPU; the
+  async views wait on the predictor without holding threads.
+- ``sync``: one request per process, 2 * CPUs + 1 processes.
+"""
+import os
+import shutil
+
+
+def cpu_count():
+    # Respects the container's CPU set, unlike multiprocessing.cpu_count().
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+WORKER_CLASSES = {
+    "gthread": "gthread",
+    "sync": "sync",
+    "uvicorn": "uvicorn.workers.UvicornWorker",
+}
+
+worker_type = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+if worker_type not in WORKER_CLASSES:
+    raise RuntimeError(
+        "GUNICORN_WORKER_CLASS must be one of %s" % ", ".join(WORKER_CLASSES)
+    )
+
+worker_class = WORKER_CLASSES[worker_type]
+wsgi_app = (
+    "fitness_django.asgi:application"
+    if worker_type == "uvicorn"
+    else "fitness_django.wsgi:application"
+)
+
+default_workers = {
+    "gthread": cpu_count() + 1,
+    "sync": cpu_count() * 2 + 1,
+    "uvicorn": cpu_count(),
+}[worker_type]
+workers = int(os.environ.get("GUNICORN_WORKERS", "0")) or default_workers
+threads = int(os.environ.get("GUNICORN_THREADS", "4")) if worker_type == "gthread" else 1
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Recycle workers to bound memory growth; jitter avoids restarting all at once.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+# Import Django once in the master so workers share its memory pages.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Workers write their metrics here so /metrics can add them all up.
+os.environ.setdefault("METRICS_DIR", "/tmp/fitness_metrics")
+
+# Each worker process gets its own password hashing pool (api.passwords), so
+# the default splits the CPUs between the workers. A sync worker waits for
+# its hash either way and hashes on its own thread.
+os.environ.setdefault(
+    "PASSWORD_HASH_WORKERS",
+    "0" if worker_type == "sync" else str(max(1, cpu_count() // workers)),
+)
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    # Totals of a previous server run would be added to this one's.
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["METRICS_DIR"], exist_ok=True)
+
+
+def pre_fork(server, worker):
+    # Close anything opened in the master during preload so that workers
+    # never share a database socket with it.
+    from django.db import connections
+
+    connections.close_all()
+
+
+def child_exit(server, worker):
+    # Folds the worker's metrics into METRICS_DIR/exited.json, so the
+    # directory does not grow by one file per recycled worker.
+    from api.metrics import fold_exited
+
+    fold_exited(os.environ["METRICS_DIR"], worker.pid)
@@ -1,7 +1,10 @@
 # Django settings for fitness_django project with Docker support.
 import os
+import tempfile
 from pathlib import Path
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -36,16 +39,23 @@ INSTALLED_APPS = [
     "api",
 ]
 
+# The api.middleware.API* classes skip themselves for token-authenticated
+# (or cookie-less) requests under API_PATH_PREFIXES; the admin gets them all.
 MIDDLEWARE = [
+    "api.middleware.MetricsMiddleware",
+    "api.middleware.QueryCheckMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
+    "api.middleware.APISessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
-    "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware",
-    "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "api.middleware.APIAuthenticationMiddleware",
+    "api.middleware.APIMessageMiddleware",
+    "api.middleware.APIXFrameOptionsMiddleware",
+    "api.middleware.ReplicaRoutingMiddleware",
+    "api.middleware.ProfilerMiddleware",
 ]
+API_PATH_PREFIXES = ["/api/"]
 
 ROOT_URLCONF = "fitness_django.urls"
 
@@ -70,18 +80,84 @@ WSGI_APPLICATION = "fitness_django.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Connection reuse (both opt-in):
+# - DB_CONN_MAX_AGE > 0 keeps a persistent connection per thread, checked with
+#   a cheap ping before each request when DB_CONN_HEALTH_CHECKS=1.
+# - DB_POOL=1 uses the pooled engine: connections are handed back to a shared
+#   per-process pool at the end of every request instead of being closed.
+DB_POOL = os.environ.get("DB_POOL", "0") == "1"
+
 # PostgreSQL configuration for Docker
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": (
+            "api.db.backends.postgresql_pool"
+            if DB_POOL
+            else "django.db.backends.postgresql"
+        ),
         "NAME": os.environ.get("DB_NAME", "fitness_db"),
         "USER": os.environ.get("DB_USER", "postgres"),
         "PASSWORD": os.environ.get("DB_PASSWORD", "your_password"),
         "HOST": os.environ.get("DB_HOST", "db"),  # Use 'db' as hostname in Docker
         "PORT": os.environ.get("DB_PORT", "5432"),
+        "CONN_MAX_AGE": int(os.environ.get("DB_CONN_MAX_AGE", "0")),
+        "CONN_HEALTH_CHECKS": os.environ.get("DB_CONN_HEALTH_CHECKS", "1") == "1",
+        "POOL": {
+            "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", "2")),
+            "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", "10")),
+            "timeout": float(os.environ.get("DB_POOL_TIMEOUT", "5")),
+            "max_idle": float(os.environ.get("DB_POOL_MAX_IDLE", "300")),
+            "health_check_interval": float(
+                os.environ.get("DB_POOL_HEALTH_CHECK_INTERVAL", "30")
+            ),
+        },
     }
 }
 
+# Read replicas: DB_REPLICA_HOSTS="host1:5432,host2" adds one alias per host
+# with the primary's credentials. Reads of views marked ``replica_reads`` and
+# admin changelists go to a random replica; a caller stays on the primary for
+# DB_REPLICA_PIN_SECONDS after a write.
+DATABASE_REPLICAS = []
+for _index, _replica in enumerate(
+    filter(None, os.environ.get("DB_REPLICA_HOSTS", "").split(",")), start=1
+):
+    _host, _, _port = _replica.strip().partition(":")
+    DATABASES["replica_%d" % _index] = {
+        **DATABASES["default"],
+        "HOST": _host,
+        "PORT": _port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append("replica_%d" % _index)
+
+DATABASE_PIN_SECONDS = int(os.environ.get("DB_REPLICA_PIN_SECONDS", "5"))
+
+# Shards: DB_SHARD_HOSTS="host1:5432/fitness_0,host2/fitness_1" spreads the
+# SHARDED_MODELS rows over these databases by user id. Every shard must be
+# migrated (``migrate --database shard_N``); adding one needs a
+# ``rebalance_shards`` run.
+DATABASE_SHARDS = []
+for _index, _shard in enumerate(
+    filter(None, os.environ.get("DB_SHARD_HOSTS", "").split(","))
+):
+    _address, _, _name = _shard.strip().partition("/")
+    _host, _, _port = _address.partition(":")
+    DATABASES["shard_%d" % _index] = {
+        **DATABASES["default"],
+        "HOST": _host,
+        "PORT": _port or DATABASES["default"]["PORT"],
+        "NAME": _name or DATABASES["default"]["NAME"],
+    }
+    DATABASE_SHARDS.append("shard_%d" % _index)
+
+SHARDED_MODELS = ["users.heightmodel", "users.weightmodel", "users.cyclemodel"]
+
+DATABASE_ROUTERS = [
+    "api.db.routers.ShardRouter",
+    "api.db.routers.PrimaryReplicaRouter",
+]
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -117,6 +193,20 @@ USE_TZ = True
 STATIC_URL = "/static/"
 STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 
+# collectstatic writes content-hashed names plus .gz (and .br when the
+# brotli package is installed) siblings, so assets can be cached forever.
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "api.staticfiles.CompressedManifestStaticFilesStorage",
+    },
+}
+
+# Serve STATIC_ROOT from Django itself, for deployments without nginx.
+SERVE_STATIC = int(os.environ.get("SERVE_STATIC", "0")) == 1
+
 # Media files
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
@@ -128,50 +218,186 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # CORS settings
 CORS_ALLOW_ALL_ORIGINS = True
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")
 
 # REST Framework settings
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
-        "rest_framework.authentication.SessionAuthentication",
+        "users.authentication.TokenAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
     "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.UserRateThrottle",
+        "api.throttling.UserRateThrottle",
     ],
     "DEFAULT_THROTTLE_RATES": {
-        "user": "100/hour",
+        "user": os.environ.get("THROTTLE_USER_RATE", "100/hour"),
     },
 }
 
+# Shared cache behind the in-process tier of api.cache; docker-compose runs
+# Redis for it. Without Redis a file cache still shares entries between the
+# workers of a node, but it lists its directory on every write and its incr()
+# is not atomic: keep CACHE_MAX_ENTRIES small and keep counters (throttling,
+# failed logins) out of it.
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.environ.get(
+                "CACHE_DIR", os.path.join(tempfile.gettempdir(), "fitness_django_cache")
+            ),
+            "OPTIONS": {
+                "MAX_ENTRIES": int(os.environ.get("CACHE_MAX_ENTRIES", "1000")),
+            },
+        }
+    }
+
+# In-process cache tier (api.cache): entries per namespace and the seconds an
+# entry or namespace version is trusted before the shared cache is asked again.
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get("CACHE_LOCAL_MAX_ENTRIES", "1000"))
+CACHE_LOCAL_TIMEOUT = float(os.environ.get("CACHE_LOCAL_TIMEOUT", "5"))
+
+# Where api.throttling keeps its sliding-window counters: the api_throttle
+# table (shared by every node), a SQLite file (shared by the workers of one
+# node) or the Django cache (Redis only).
+THROTTLE_BACKEND = os.environ.get(
+    "THROTTLE_BACKEND", "api.throttling.DatabaseThrottleBackend"
+)
+THROTTLE_DATABASE = "default"
+THROTTLE_CACHE = "default"
+THROTTLE_SQLITE_PATH = os.environ.get(
+    "THROTTLE_SQLITE_PATH", os.path.join(tempfile.gettempdir(), "fitness_throttle.sqlite3")
+)
+
 AUTHENTICATION_BACKENDS = ["django.contrib.auth.backends.ModelBackend"]
 
+# API tokens (users.authentication) expire TOKEN_TTL_SECONDS after their last
+# renewal (0 never expires them); a token in use is renewed at most once per
+# TOKEN_RENEW_AFTER_SECONDS.
+TOKEN_TTL_SECONDS = int(os.environ.get("TOKEN_TTL_SECONDS", "2592000"))
+TOKEN_RENEW_AFTER_SECONDS = int(os.environ.get("TOKEN_RENEW_AFTER_SECONDS", "86400"))
+
+# Password hashing processes per server process (api.passwords); 0 hashes on
+# the request thread. gunicorn_conf sizes it per host for gunicorn workers.
+# Logins to an account are refused without hashing after LOGIN_MAX_FAILURES
+# failures within LOGIN_FAILURE_WINDOW_SECONDS. The failures are counted in
+# LOGIN_FAILURE_CACHE (Redis, whose incr is atomic) or else in the
+# api_loginfailure table.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+LOGIN_MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", "10"))
+LOGIN_FAILURE_WINDOW_SECONDS = int(os.environ.get("LOGIN_FAILURE_WINDOW_SECONDS", "900"))
+LOGIN_FAILURE_CACHE = "default" if REDIS_URL else None
+
 # ML Model settings
 ML_MODEL_DIR = os.path.join(BASE_DIR, "ml_model")
 
+# Cycle phase prediction service
+CYCLE_PREDICTOR_URL = os.environ.get(
+    "CYCLE_PREDICTOR_URL", "http://host.docker.internal:8000/phase/predict"
+)
+CYCLE_PREDICTOR_TIMEOUT = float(os.environ.get("CYCLE_PREDICTOR_TIMEOUT", "10"))
+CYCLE_PREDICTOR_MAX_CONNECTIONS = int(
+    os.environ.get("CYCLE_PREDICTOR_MAX_CONNECTIONS", "100")
+)
+# Predictions are cached per input payload (0 disables).
+CYCLE_PREDICTION_CACHE_SECONDS = int(
+    os.environ.get("CYCLE_PREDICTION_CACHE_SECONDS", "86400")
+)
+
+# Request metrics (api.metrics, served on /metrics). With METRICS_DIR set,
+# every process writes its totals there at most every METRICS_FLUSH_SECONDS
+# so that /metrics can add up all gunicorn workers.
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "5"))
+# /metrics answers clients in METRICS_ALLOWED_NETWORKS (loopback and private
+# addresses, where the scraper runs next to the containers) and requests
+# with "Authorization: Bearer <METRICS_TOKEN>"; everyone else gets 403.
+METRICS_ALLOWED_NETWORKS = [
+    network.strip()
+    for network in os.environ.get(
+        "METRICS_ALLOWED_NETWORKS",
+        "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16",
+    ).split(",")
+    if network.strip()
+]
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") or None
+
+# N+1 and slow query detection per request (api.db.querycheck): "off",
+# "log" (warnings) or "raise" (the request fails, meant for development).
+QUERY_CHECK = os.environ.get("QUERY_CHECK", "off")
+QUERY_CHECK_REPEAT_THRESHOLD = int(os.environ.get("QUERY_CHECK_REPEAT_THRESHOLD", "3"))
+QUERY_CHECK_SLOW_MS = float(os.environ.get("QUERY_CHECK_SLOW_MS", "100"))
+
+# Idempotency-Key support of the write endpoints (api.idempotency): how long
+# a stored response is replayed, and how long a retry waits for the first
+# request with its key to finish.
+IDEMPOTENCY_KEY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_KEY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", "10"))
+
+# On-demand request profiling (api.middleware.ProfilerMiddleware, browsable
+# in the admin). Staff users send ``X-Profile: cprofile|sample``;
+# PROFILER_SAMPLE_RATE of the other requests are sampled. Nothing runs
+# unless PROFILER_ENABLED is set.
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILER_VIEW_MODULES = ["users.views"]
+PROFILER_SAMPLE_RATE = float(os.environ.get("PROFILER_SAMPLE_RATE", "0"))
+PROFILER_SAMPLE_INTERVAL = float(os.environ.get("PROFILER_SAMPLE_INTERVAL", "0.005"))
+PROFILER_DIR = os.environ.get(
+    "PROFILER_DIR", os.path.join(tempfile.gettempdir(), "fitness_profiles")
+)
+PROFILER_MAX_FILES = int(os.environ.get("PROFILER_MAX_FILES", "200"))
+
 # Logging configuration
+# Records go through a bounded queue to a background listener thread, so
+# request threads never block on log I/O. The listener writes to the console
+# (api.logging.install_queue_targets, called by ApiConfig.ready());
+# LOG_FORMAT=text switches it from JSON lines to the plain format.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
-    "formatters": {
-        "verbose": {
-            "format": "{levelname} {asctime} {module} {message}",
-            "style": "{",
+    "filters": {
+        # Keeps LOG_SAMPLE_RATE of the INFO records, all warnings and errors.
+        "sample": {
+            "()": "api.logging.SamplingFilter",
+            "rate": float(os.environ.get("LOG_SAMPLE_RATE", "1.0")),
+            "level": "WARNING",
+        },
+        # At most LOG_RATE_LIMIT records per second and message.
+        "rate_limit": {
+            "()": "api.logging.RateLimitFilter",
+            "rate": int(os.environ.get("LOG_RATE_LIMIT", "20")),
+            "per": 1.0,
         },
     },
     "handlers": {
-        "console": {
-            "level": "INFO",
-            "class": "logging.StreamHandler",
-            "formatter": "verbose",
+        "queue": {
+            "()": "api.logging.QueueHandler",
+            "queue_size": 10000,
         },
     },
     "root": {
-        "handlers": ["console"],
+        "handlers": ["queue"],
         "level": "INFO",
     },
+    "loggers": {
+        # httpx logs every predictor request at INFO.
+        "httpx": {"level": "WARNING"},
+        "django.request": {"filters": ["rate_limit"]},
+        "users.views": {"filters": ["sample", "rate_limit"]},
+        "users.models": {"filters": ["rate_limit"]},
+        "api.middleware": {"filters": ["rate_limit"]},
+    },
 }
 
 SECURE_SSL_REDIRECT = False
@@ -190,7 +416,4 @@ SECURE_SSL_REDIRECT = False
 SESSION_COOKIE_SECURE = False
 CSRF_COOKIE_SECURE = False
 
-SITE_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 AUTH_USER_MODEL = "users.User"
-STATIC_ROOT = os.path.join(SITE_ROOT, "static")
-STATIC_ROOT = "static/"
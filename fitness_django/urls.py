@@ -1,6 +1,13 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path, include, re_path
 from django.contrib import admin
 from rest_framework.routers import DefaultRouter
+from api.views import metrics_view, serve_static
+from users.async_views import (
+    AsyncLoginUserView,
+    AsyncPredictCyclePhaseView,
+    AsyncProfileInfoView,
+)
 from users.views import (
     CreateUpdateUserView,
     LoginUserView,
@@ -8,7 +15,8 @@ from users.views import (
     WeightHistoryView,
     LogoutUserView,
     UpdateUserView,
-    PredictCyclePhaseView
+    PredictCyclePhaseView,
+    BulkUpsertUsersView,
 )
 
 # Create a router for ViewSets
@@ -17,6 +25,7 @@ router = DefaultRouter()
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
 
     # User create API endpoint
     path("api/users/create/", CreateUpdateUserView.as_view(), name="users-create"),
@@ -25,5 +34,16 @@ urlpatterns = [
     path("api/users/login/", LoginUserView.as_view(), name="users-login"),
     path("api/users/logout/", LogoutUserView.as_view(), name="users-logout"),
     path("api/users/update/", UpdateUserView.as_view(), name="users-update"),
-    path("api/users/predict_cycle_phase/", PredictCyclePhaseView.as_view(), name="predict-cycle-phase")
+    path("api/users/predict_cycle_phase/", PredictCyclePhaseView.as_view(), name="predict-cycle-phase"),
+    path("api/users/bulk_upsert/", BulkUpsertUsersView.as_view(), name="users-bulk-upsert"),
+
+    # Async versions for ASGI deployments
+    path("api/users/async/profile/", AsyncProfileInfoView.as_view(), name="async-profile-info-view"),
+    path("api/users/async/login/", AsyncLoginUserView.as_view(), name="async-users-login"),
+    path("api/users/async/predict_cycle_phase/", AsyncPredictCyclePhaseView.as_view(), name="async-predict-cycle-phase"),
 ]
+
+if settings.SERVE_STATIC:
+    urlpatterns += [
+        re_path(r"^%s(?P<path>.+)$" % settings.STATIC_URL.lstrip("/"), serve_static),
+    ]
@@ -1,20 +1,45 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.http import HttpResponseRedirect
+from django.urls import reverse
+from django.db.models.functions import Lower
 from fitness_django.settings import AUTH_USER_MODEL
+from api.pagination import EstimatedCountPaginator
 from users.models import User, WeightModel, Allergen
 from rest_framework.authtoken.models import Token
 
 
 class UserAdmin(admin.ModelAdmin):
-    list_display = ("pk", "email", "username")
-    list_filter = ("updated_at",)
+    list_display = ("pk", "email", "username", "created_at")
+    # Indexed; updated_at is rewritten on every login.
+    date_hierarchy = "created_at"
+    # Substring matches use the users_user_*_trgm indexes on PostgreSQL.
+    search_fields = ["email", "username"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     class Meta:
         model = User
 
 
 class WeightAdmin(admin.ModelAdmin):
-    list_display = ("pk", "weight")
-    list_filter = ("updated_at",)
+    list_display = ("pk", "weight", "user", "updated_at")
+    list_select_related = ("user",)
+    date_hierarchy = "updated_at"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def changelist_view(self, request, extra_context=None):
+        # With DATABASE_SHARDS the weights live on the users' shards and a
+        # list of "default" would only show rows not yet rebalanced.
+        if settings.DATABASE_SHARDS:
+            self.message_user(
+                request,
+                "The weight list is not available while weights are sharded.",
+                messages.WARNING,
+            )
+            return HttpResponseRedirect(reverse("admin:index"))
+        return super().changelist_view(request, extra_context)
 
     class Meta:
         model = WeightModel
@@ -26,7 +51,24 @@ class AllergenAdmin(admin.ModelAdmin):
         model = Allergen
 
 class FilterTokenAdmin(admin.ModelAdmin):
-    search_fields = ["user__email", "user__full_name"]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # Exact matches only, so that a search is an index lookup: by key, or by
+    # email through users_user_email_lower_uniq.
+    search_fields = ["=key", "=user__email"]
+    search_help_text = "Exact token key or user email."
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        if "@" in term:
+            queryset = queryset.alias(user_email=Lower("user__email")).filter(
+                user_email=term.lower()
+            )
+        else:
+            queryset = queryset.filter(key=term)
+        return queryset, False
 
 
 admin.site.register(User, UserAdmin)
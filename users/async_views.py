@@ -0,0 +1,216 @@
+"""
+Async versions of the profile, login and cycle prediction endpoints.
+
+They return the same payloads as their APIView counterparts in
+``users.views`` but use the async ORM and the async predictor client, so a
+request waiting on the predictor holds no worker thread when served over
+ASGI (e.g. gunicorn with uvicorn workers).
+"""
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.views import View
+from rest_framework.authtoken.models import Token
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.db.replicas import pin_to_primary
+from api.passwords import (
+    acheck_password,
+    amake_password,
+    clear_login_failures,
+    login_failures,
+    record_login_failure,
+)
+from users.authentication import (
+    aload_sharded_relations,
+    alogin_token,
+    arenew_token,
+    local_relations,
+    token_expired,
+    token_queryset,
+    token_renewal_due,
+)
+from users.models import User
+from users.views import PROFILE_FIELD_GETTERS, PROFILE_USER_FIELDS, get_profile_fields
+
+
+def api_response(data, status=200, **kwargs):
+    # DRF's encoder keeps dates and decimals identical to the sync views.
+    return JsonResponse(data, status=status, safe=False, encoder=JSONEncoder, **kwargs)
+
+
+async def abuild_profile_data(user, fields):
+    """build_profile_data for a user with its height and weight loaded."""
+    data = {}
+    for name in fields:
+        if name == "allergens":
+            data[name] = [allergen.name async for allergen in user.allergens.all()]
+        else:
+            data[name] = PROFILE_FIELD_GETTERS[name](user)
+    return data
+
+
+class AsyncAPIView(View):
+    """
+    Minimal async counterpart of APIView: JSON in and out, Token
+    authentication and the configured throttles.
+    """
+
+    authentication_required = True
+    # User columns and relations loaded with the token, as on the sync
+    # views (see users.authentication).
+    user_fields = ()
+    user_select_related = ()
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Like DRF views these are token/anonymous APIs without CSRF.
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.user, request.auth = await self.authenticate(request)
+        if self.authentication_required and request.auth is None:
+            return api_response(
+                {"detail": "Authentication credentials were not provided."},
+                status=401,
+                headers={"WWW-Authenticate": "Token"},
+            )
+        wait = await sync_to_async(self.check_throttles)(request)
+        if wait is not None:
+            return api_response(
+                {"detail": "Request was throttled."},
+                status=429,
+                headers={"Retry-After": str(int(wait))},
+            )
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def authenticate(self, request):
+        anonymous = AnonymousUser()
+        keyword, _, key = request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+        if keyword != "Token" or not key.strip():
+            return anonymous, None
+        try:
+            token = await token_queryset(self.user_fields, self.user_select_related).aget(
+                key=key.strip()
+            )
+        except Token.DoesNotExist:
+            return anonymous, None
+        if not token.user.is_active:
+            return anonymous, None
+        now = timezone.now()
+        if token_expired(token, now):
+            return anonymous, None
+        if token_renewal_due(token, now):
+            await arenew_token(token, now)
+        await aload_sharded_relations(token.user, self.user_select_related)
+        return token.user, token
+
+    def check_throttles(self, request):
+        for path in settings.REST_FRAMEWORK.get("DEFAULT_THROTTLE_CLASSES", []):
+            throttle = import_string(path)()
+            if not throttle.allow_request(request, self):
+                return throttle.wait() or 0
+        return None
+
+    def get_data(self, request):
+        if request.content_type == "application/json":
+            return json.loads(request.body or b"{}")
+        return request.POST
+
+
+class AsyncProfileInfoView(AsyncAPIView):
+    replica_reads = True
+    user_fields = PROFILE_USER_FIELDS
+    user_select_related = ("height", "weight")
+
+    async def post(self, request):
+        user = request.user
+        try:
+            fields = get_profile_fields(request)
+        except ValueError as e:
+            return api_response(str(e), status=400)
+
+        if "menstrualPhase" in fields:
+            await user.apredict_cycle_phase()
+
+        return api_response(
+            {
+                "status": "Success",
+                "message": "Success",
+                "data": await abuild_profile_data(user, fields),
+            }
+        )
+
+
+class AsyncLoginUserView(AsyncAPIView):
+    authentication_required = False
+
+    async def post(self, request):
+        try:
+            data = self.get_data(request)
+            fields = get_profile_fields(request)
+        except ValueError as e:
+            return api_response(str(e), status=400)
+
+        email = data.get("email")
+        target_user = (
+            await User.objects.select_related(*local_relations(("height", "weight")))
+            .filter(email=email)
+            .afirst()
+        )
+        if target_user is None:
+            return api_response("No user", status=404)
+
+        # Rejected before the password is hashed.
+        failures = await sync_to_async(login_failures)(target_user.pk)
+        if failures >= settings.LOGIN_MAX_FAILURES:
+            return api_response(
+                "Too many failed logins",
+                status=429,
+                headers={"Retry-After": str(settings.LOGIN_FAILURE_WINDOW_SECONDS)},
+            )
+        if not target_user.is_active:
+            return api_response("invalid login", status=200)
+
+        password = data.get("password")
+        correct, rehash = await acheck_password(password, target_user.password)
+        if not correct:
+            await sync_to_async(record_login_failure)(target_user.pk)
+            return api_response("invalid login", status=200)
+        if failures:
+            await sync_to_async(clear_login_failures)(target_user.pk)
+        if rehash:
+            target_user.password = await amake_password(password)
+            await target_user.asave(update_fields=["password"])
+
+        token, new_key = await alogin_token(target_user)
+        if new_key:
+            await sync_to_async(pin_to_primary)(token.key)
+
+        await aload_sharded_relations(target_user, ("height", "weight"))
+        if target_user.gender == User.WOMAN and "menstrualPhase" in fields:
+            await target_user.apredict_cycle_phase()
+
+        return api_response(
+            {
+                "token": token.key,
+                "data": await abuild_profile_data(target_user, fields),
+            }
+        )
+
+
+class AsyncPredictCyclePhaseView(AsyncAPIView):
+    user_fields = PROFILE_USER_FIELDS
+    user_select_related = ("height", "weight")
+
+    async def post(self, request):
+        user = request.user
+        await user.apredict_cycle_phase()
+        return api_response(user.cycle_record_json)
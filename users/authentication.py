@@ -0,0 +1,168 @@
+"""
+Token authentication that loads only the user columns a view reads.
+
+DRF's TokenAuthentication loads the token's user with every column, including
+the ``cycle_record_json`` document and the password hash, on every request.
+``TokenAuthentication`` here loads AUTH_USER_FIELDS (enough for permissions,
+throttling and logging) plus what the view declares::
+
+    class ProfileInfoView(APIView):
+        authentication_classes = [TokenAuthentication]
+        user_fields = PROFILE_USER_FIELDS
+        user_select_related = ("height", "weight")
+
+``user_fields = None`` loads every column. A column left out is loaded with a
+query of its own on first access, and ``save()`` without ``update_fields``
+writes only the loaded columns (plus any assigned since).
+
+Tokens expire TOKEN_TTL_SECONDS after their ``created`` time, which slides:
+a token used more than TOKEN_RENEW_AFTER_SECONDS after it was last renewed
+gets ``created`` moved to now, so an active client keeps its token and an
+idle one loses it. Login reuses a valid token and replaces an expired one's
+key in place; ``purge_expired_tokens`` deletes the expired rows.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import authentication, exceptions
+from rest_framework.authtoken.models import Token
+
+from api.db.sharding import is_sharded, shard_for_user
+from users.models import User
+
+AUTH_USER_FIELDS = ("id", "is_active", "is_staff", "is_superuser")
+
+
+def local_relations(select_related):
+    """The user relations of ``select_related`` that can be joined to the user."""
+    # Sharded rows live in another database than the user.
+    if not settings.DATABASE_SHARDS:
+        return tuple(select_related)
+    return tuple(
+        name for name in select_related
+        if not is_sharded(User._meta.get_field(name).related_model)
+    )
+
+
+async def aload_sharded_relations(user, select_related):
+    """
+    Loads the relations of ``select_related`` that local_relations() left out
+    from the user's shard, since lazy loads are not allowed in async code.
+    """
+    if not settings.DATABASE_SHARDS:
+        return
+    alias = shard_for_user(user.pk)
+    for name in select_related:
+        field = User._meta.get_field(name)
+        if not is_sharded(field.related_model) or field.is_cached(user):
+            continue
+        value = getattr(user, field.attname)
+        related = None
+        if value is not None:
+            related = await field.related_model._base_manager.using(alias).filter(
+                pk=value
+            ).afirst()
+        field.set_cached_value(user, related)
+
+
+def token_queryset(user_fields=(), select_related=()):
+    """
+    Tokens with their user loaded with AUTH_USER_FIELDS and ``user_fields``
+    (every column for None) and the ``select_related`` relations of the user
+    joined in (those on shards are left to lazy loading).
+    """
+    select_related = local_relations(select_related)
+    queryset = Token.objects.select_related(
+        "user", *("user__" + name for name in select_related)
+    )
+    if user_fields is None:
+        return queryset
+    fields = dict.fromkeys((*AUTH_USER_FIELDS, *user_fields, *select_related))
+    return queryset.only("key", "created", "user", *("user__" + name for name in fields))
+
+
+def token_expired(token, now):
+    return bool(settings.TOKEN_TTL_SECONDS) and token.created <= now - timedelta(
+        seconds=settings.TOKEN_TTL_SECONDS
+    )
+
+
+def token_renewal_due(token, now):
+    return bool(settings.TOKEN_TTL_SECONDS) and token.created <= now - timedelta(
+        seconds=settings.TOKEN_RENEW_AFTER_SECONDS
+    )
+
+
+def renew_token(token, now):
+    token.created = now
+    Token.objects.filter(key=token.key).update(created=now)
+
+
+async def arenew_token(token, now):
+    token.created = now
+    await Token.objects.filter(key=token.key).aupdate(created=now)
+
+
+def login_token(user):
+    """
+    The user's token for a login: the current one while it is valid (renewed
+    if due), otherwise a new key. Returns (token, whether the key is new).
+    """
+    now = timezone.now()
+    token = Token.objects.filter(user=user).first()
+    if token is not None and not token_expired(token, now):
+        if token_renewal_due(token, now):
+            renew_token(token, now)
+        return token, False
+    if token is not None:
+        # One UPDATE instead of a DELETE and an INSERT.
+        key = Token.generate_key()
+        if Token.objects.filter(key=token.key).update(key=key, created=now):
+            token.key, token.created = key, now
+            return token, True
+    return Token.objects.create(user=user), True
+
+
+async def alogin_token(user):
+    now = timezone.now()
+    token = await Token.objects.filter(user=user).afirst()
+    if token is not None and not token_expired(token, now):
+        if token_renewal_due(token, now):
+            await arenew_token(token, now)
+        return token, False
+    if token is not None:
+        key = Token.generate_key()
+        if await Token.objects.filter(key=token.key).aupdate(key=key, created=now):
+            token.key, token.created = key, now
+            return token, True
+    return await Token.objects.acreate(user=user), True
+
+
+class TokenAuthentication(authentication.TokenAuthentication):
+    user_fields = ()
+    user_select_related = ()
+
+    def authenticate(self, request):
+        view = (request.parser_context or {}).get("view")
+        self.user_fields = getattr(view, "user_fields", ())
+        self.user_select_related = getattr(view, "user_select_related", ())
+        return super().authenticate(request)
+
+    def authenticate_credentials(self, key):
+        try:
+            token = token_queryset(self.user_fields, self.user_select_related).get(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+
+        now = timezone.now()
+        if token_expired(token, now):
+            raise exceptions.AuthenticationFailed(_("Token has expired."))
+        if token_renewal_due(token, now):
+            renew_token(token, now)
+
+        return (token.user, token)
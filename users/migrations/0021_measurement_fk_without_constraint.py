@@ -0,0 +1,40 @@
+# Generated by Django 4.2.1 on 2026-10-19 16:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0020_alter_user_menstrual_phase'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cyclemodel',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='heightmodel',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='height',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='Height', to='users.heightmodel', verbose_name='Height'),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='weight',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='Weight', to='users.weightmodel', verbose_name='Weight'),
+        ),
+        migrations.AlterField(
+            model_name='weightmodel',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
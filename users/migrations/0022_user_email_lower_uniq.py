@@ -0,0 +1,75 @@
+# Generated by Django 4.2.1 on 2026-10-19 17:20
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.functions.text
+
+from api.db.indexes import create_index, drop_index
+
+INDEX_NAME = 'users_user_email_lower_uniq'
+
+
+def check_email_duplicates(apps, schema_editor):
+    """
+    Stops before the index is built when emails differ only in case, naming
+    the accounts so they can be merged or renamed first.
+    """
+    User = apps.get_model('users', 'User')
+    duplicates = list(
+        User.objects.using(schema_editor.connection.alias)
+        .values(email_lower=django.db.models.functions.text.Lower('email'))
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by('email_lower')
+        .values_list('email_lower', flat=True)
+    )
+    if not duplicates:
+        return
+    lines = []
+    for email in duplicates[:20]:
+        ids = (
+            User.objects.using(schema_editor.connection.alias)
+            .filter(email__iexact=email)
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+        lines.append('  %s: user ids %s' % (email, ', '.join(map(str, ids))))
+    if len(duplicates) > 20:
+        lines.append('  ... and %d more' % (len(duplicates) - 20))
+    raise RuntimeError(
+        '%d emails are used by several users that differ only in case. Merge '
+        'or rename these accounts, then migrate again:\n%s'
+        % (len(duplicates), '\n'.join(lines))
+    )
+
+
+def create_email_index(apps, schema_editor):
+    create_index(schema_editor, INDEX_NAME, 'users_user', 'LOWER(email)', unique=True)
+
+
+def drop_email_index(apps, schema_editor):
+    drop_index(schema_editor, INDEX_NAME)
+
+
+class Migration(migrations.Migration):
+    # CREATE UNIQUE INDEX CONCURRENTLY cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('users', '0021_measurement_fk_without_constraint'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_email_duplicates, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='user',
+                    constraint=models.UniqueConstraint(django.db.models.functions.text.Lower('email'), name=INDEX_NAME),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_email_index, drop_email_index),
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.2.1 on 2026-10-19 17:31
+
+from django.db import migrations, models
+
+from api.db.indexes import create_index, drop_index
+
+# (table, expression, method) by index name. The date indexes back
+# User.created_at and WeightModel.updated_at db_index=True; the admin search
+# filters with UPPER(column) LIKE '%term%', which the trigram indexes on the
+# same expressions serve (PostgreSQL only).
+INDEXES = {
+    "users_user_created_at_idx": ("users_user", "created_at", None),
+    "users_weightmodel_updated_at_idx": ("users_weightmodel", "updated_at", None),
+}
+TRIGRAM_INDEXES = {
+    "users_user_email_trgm": ("users_user", "UPPER(email) gin_trgm_ops", "gin"),
+    "users_user_username_trgm": ("users_user", "UPPER(username) gin_trgm_ops", "gin"),
+}
+
+
+def trigram_indexes(schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return {}
+    return TRIGRAM_INDEXES
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, (table, expression, method) in {
+        **INDEXES, **trigram_indexes(schema_editor)
+    }.items():
+        create_index(schema_editor, name, table, expression, method)
+
+
+def drop_indexes(apps, schema_editor):
+    for name in {**INDEXES, **trigram_indexes(schema_editor)}:
+        drop_index(schema_editor, name)
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run in a transaction.
+    atomic = False
+
+    dependencies = [
+        ('users', '0022_user_email_lower_uniq'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='user',
+                    name='created_at',
+                    field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Added'),
+                ),
+                migrations.AlterField(
+                    model_name='weightmodel',
+                    name='updated_at',
+                    field=models.DateTimeField(auto_now=True, db_index=True, verbose_name='Changed'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_indexes, drop_indexes),
+            ],
+        ),
+    ]
@@ -1,33 +1,56 @@
 import datetime
-import requests
+import logging
 
-from django.db import models
+from django.db import NotSupportedError, connections, models, router, transaction
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.contrib.auth.base_user import BaseUserManager
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AbstractUser, PermissionsMixin, User
 from django.conf import settings
+from django.utils import timezone
+
+from api.cache import cache_namespace
+from api.db.sharding import ShardedManager, shard_for_user
+from users import predictor
+
+logger = logging.getLogger(__name__)
 
 
 class HeightModel(models.Model):
     user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        # Rows may live on a different database than their user when sharded.
+        db_constraint=False,
     )
     height = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name="Height", null=True, blank=True
     )
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Changed")
 
+    objects = ShardedManager()
+
     def __str__(self):
         return str(self.height)
 
 
 class WeightModel(models.Model):
     user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        # Rows may live on a different database than their user when sharded.
+        db_constraint=False,
     )
     weight = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name="Weight", null=True, blank=True
     )
-    updated_at = models.DateTimeField(auto_now=True, verbose_name="Changed")
+    updated_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name="Changed")
+
+    objects = ShardedManager()
 
     def __str__(self):
         return str(self.weight)
@@ -35,10 +58,19 @@ class WeightModel(models.Model):
 
 class CycleModel(models.Model):
     user = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        # Rows may live on a different database than their user when sharded.
+        db_constraint=False,
     )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Added")
 
+    objects = ShardedManager()
+
+
+allergen_cache = cache_namespace("allergens", timeout=3600)
+
 
 class Allergen(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -46,6 +78,62 @@ class Allergen(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def ids_by_name(cls):
+        """Cached {name: id} map of all allergens."""
+        return allergen_cache.get_or_set(
+            "ids_by_name", lambda: dict(cls.objects.values_list("name", "pk"))
+        )
+
+
+@receiver(post_save, sender=Allergen)
+@receiver(post_delete, sender=Allergen)
+def invalidate_allergen_cache(sender, **kwargs):
+    allergen_cache.invalidate()
+
+
+def compute_metrics(height, weight, birth_date, gender, user_id=None):
+    """
+    Age, BMI and BFP stored on a user with these measurements (height in cm,
+    weight in kg, either may be None).
+    """
+    # Initialize BMI and BFP as None by default
+    bmi = bfp = None
+
+    # Ensure weight and height exist before calculating BMI
+    if weight is not None and height is not None and float(height) > 0:
+        try:
+            weight_value = float(weight)
+            height_value = float(height)
+            # Convert height to meters by dividing by 100
+            height_m = float(height_value) / 100
+            bmi = round(weight_value / (height_m**2), 2)
+        except (ValueError, TypeError):
+            # If weight or height can't be converted to float
+            logger.exception("Could not compute the BMI of user %s", user_id)
+
+    # Calculate age from birth_date
+    if birth_date:
+        today = datetime.date.today()
+        if isinstance(birth_date, datetime.datetime):
+            birth_date = birth_date.date()
+        age = (
+            today.year
+            - birth_date.year
+            - ((today.month, today.day) < (birth_date.month, birth_date.day))
+        )
+    else:
+        age = None
+
+    # Calculate BFP using BMI + age + gender
+    if bmi is not None and age is not None:
+        if gender == User.MAN:
+            bfp = round((1.20 * bmi) + (0.23 * age) - 16.2, 1)
+        elif gender == User.WOMAN:
+            bfp = round((1.20 * bmi) + (0.23 * age) - 5.4, 1)
+
+    return age, bmi, bfp
+
 
 class UserManager(BaseUserManager):
     use_in_migrations = True
@@ -99,6 +187,175 @@ class UserManager(BaseUserManager):
             obj.save()
         return obj, created
 
+    def reserve_pk(self):
+        """
+        A primary key taken from the table's sequence, so that rows pointing
+        at a new user can be written before it (PostgreSQL), or None.
+        """
+        connection = connections[router.db_for_write(self.model)]
+        if connection.vendor != "postgresql":
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s))",
+                [self.model._meta.db_table, self.model._meta.pk.column],
+            )
+            return cursor.fetchone()[0]
+
+    # Columns bulk_upsert() overwrites on existing users. The email keeps its
+    # case, the password and the flags are left alone.
+    UPSERT_FIELDS = [
+        "username", "birth_date", "gender", "target_weight", "goal",
+        "activity_level", "cycle_length", "cycle_day", "last_period_date",
+        "age", "bmi", "bfp", "updated_at",
+    ]
+    # Columns only written when the user is created.
+    UPSERT_INSERT_ONLY = [
+        "password", "is_superuser", "is_staff", "is_active", "first_name",
+        "last_name", "cycle_record_json", "date_joined", "created_at",
+    ]
+    UPSERT_DEFAULTS = {"gender": 2, "target_weight": 70, "goal": 1, "activity_level": 1}
+
+    def bulk_upsert(self, rows, batch_size=1000):
+        """
+        Inserts or updates users by case-insensitive email with one
+        ``INSERT ... ON CONFLICT (lower(email))`` per ``batch_size`` rows.
+        PostgreSQL only.
+
+        Each row is a dict of user fields and optional ``height`` and
+        ``weight`` values, which are added as new measurements. Rows are
+        complete records: missing fields get the registration defaults and
+        ``username`` defaults to the email. New users get an unusable
+        password. Returns ``[(user_id, created)]`` in the order of ``rows``.
+        """
+        keys = [row["email"].lower() for row in rows]
+        seen = set()
+        duplicates = sorted({key for key in keys if key in seen or seen.add(key)})
+        if duplicates:
+            raise ValueError("Duplicate emails: " + ", ".join(duplicates))
+        connection = connections[self.db]
+        if connection.vendor != "postgresql":
+            raise NotSupportedError("bulk_upsert() needs PostgreSQL.")
+
+        # Current measurements of existing users, for the metrics of rows
+        # that leave one of them out.
+        existing = {
+            key: (pk, height_id, weight_id)
+            for key, pk, height_id, weight_id in self.annotate(email_lower=Lower("email"))
+            .filter(
+                email_lower__in=[
+                    key for key, row in zip(keys, rows)
+                    if row.get("height") is None or row.get("weight") is None
+                ]
+            )
+            .values_list("email_lower", "pk", "height_id", "weight_id")
+        }
+        heights = measurement_values(HeightModel, "height", existing.values(), 1)
+        weights = measurement_values(WeightModel, "weight", existing.values(), 2)
+
+        now = timezone.now()
+        constants = {
+            "password": make_password(None),
+            "is_superuser": False,
+            "is_staff": False,
+            "is_active": True,
+            "first_name": "",
+            "last_name": "",
+            "cycle_record_json": {},
+            "date_joined": now,
+            "created_at": now,
+        }
+        records = []
+        for key, row in zip(keys, rows):
+            record = {**self.UPSERT_DEFAULTS, **row, **constants, "updated_at": now}
+            record.setdefault("username", row["email"])
+            pk, height_id, weight_id = existing.get(key, (None, None, None))
+            height = row.get("height")
+            weight = row.get("weight")
+            record["age"], record["bmi"], record["bfp"] = compute_metrics(
+                heights.get(height_id) if height is None else height,
+                weights.get(weight_id) if weight is None else weight,
+                record.get("birth_date"),
+                record["gender"],
+                user_id=pk,
+            )
+            records.append(record)
+
+        results = []
+        with transaction.atomic(using=self.db):
+            for start in range(0, len(records), batch_size):
+                results += self._upsert_batch(connection, records[start:start + batch_size])
+            self._add_measurements(rows, keys, results, existing, batch_size)
+        return results
+
+    def _upsert_batch(self, connection, records):
+        quote = connection.ops.quote_name
+        fields = [
+            self.model._meta.get_field(name)
+            for name in ["email", *self.UPSERT_INSERT_ONLY, *self.UPSERT_FIELDS]
+        ]
+        table = quote(self.model._meta.db_table)
+        email = quote(self.model._meta.get_field("email").column)
+        sql = (
+            "INSERT INTO %s (%s) VALUES %s ON CONFLICT ((LOWER(%s))) DO UPDATE SET %s "
+            "RETURNING %s, LOWER(%s), (xmax = 0)"
+        ) % (
+            table,
+            ", ".join(quote(field.column) for field in fields),
+            ", ".join(["(%s)" % ", ".join(["%s"] * len(fields))] * len(records)),
+            email,
+            ", ".join(
+                "%s = EXCLUDED.%s" % (quote(field.column), quote(field.column))
+                for field in fields
+                if field.name in self.UPSERT_FIELDS
+            ),
+            quote(self.model._meta.pk.column),
+            email,
+        )
+        params = [
+            field.get_db_prep_save(record.get(field.name), connection)
+            for record in records
+            for field in fields
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            # xmax is 0 on a freshly inserted row version.
+            by_key = {key: (pk, created) for pk, key, created in cursor.fetchall()}
+        return [by_key[record["email"].lower()] for record in records]
+
+    def _add_measurements(self, rows, keys, results, existing, batch_size):
+        heights, weights, users = [], [], {}
+        for key, row, (pk, created) in zip(keys, rows, results):
+            if row.get("height") is not None:
+                heights.append(HeightModel(user_id=pk, height=row["height"]))
+            if row.get("weight") is not None:
+                weights.append(WeightModel(user_id=pk, weight=row["weight"]))
+            if row.get("height") is not None or row.get("weight") is not None:
+                _, height_id, weight_id = existing.get(key, (pk, None, None))
+                users[pk] = self.model(pk=pk, height_id=height_id, weight_id=weight_id)
+        for measurement in HeightModel.objects.bulk_create(heights, batch_size=batch_size):
+            users[measurement.user_id].height_id = measurement.pk
+        for measurement in WeightModel.objects.bulk_create(weights, batch_size=batch_size):
+            users[measurement.user_id].weight_id = measurement.pk
+        self.bulk_update(users.values(), ["height", "weight"], batch_size=batch_size)
+
+
+def measurement_values(model, field, users, index):
+    """
+    {measurement id: value} for the ``users[i][index]`` measurement ids of
+    ``users`` (tuples starting with the user id), read from each user's shard.
+    """
+    ids_by_alias = {}
+    for user in users:
+        if user[index] is not None:
+            ids_by_alias.setdefault(shard_for_user(user[0]), []).append(user[index])
+    values = {}
+    for alias, ids in ids_by_alias.items():
+        values.update(
+            model._base_manager.using(alias).filter(pk__in=ids).values_list("pk", field)
+        )
+    return values
+
 
 class User(AbstractUser, PermissionsMixin):
     # Constants
@@ -149,6 +406,7 @@ class User(AbstractUser, PermissionsMixin):
         verbose_name="Height",
         null=True,
         blank=True,
+        db_constraint=False,
     )
     weight = models.ForeignKey(
         WeightModel,
@@ -157,6 +415,7 @@ class User(AbstractUser, PermissionsMixin):
         verbose_name="Weight",
         null=True,
         blank=True,
+        db_constraint=False,
     )
     target_weight = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name="Target weight"
@@ -188,7 +447,7 @@ class User(AbstractUser, PermissionsMixin):
     bmi = models.FloatField(null=True, blank=True, verbose_name="Body mass index")
     bfp = models.FloatField(null=True, blank=True, verbose_name="Body Fat Percentage")
 
-    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Added")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Added")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Changed")
 
     USERNAME_FIELD = "email"
@@ -196,95 +455,93 @@ class User(AbstractUser, PermissionsMixin):
 
     objects = UserManager()
 
+    class Meta(AbstractUser.Meta):
+        constraints = [
+            # Emails are compared case-insensitively (see UserManager.get());
+            # bulk_upsert() relies on this index for ON CONFLICT.
+            models.UniqueConstraint(Lower("email"), name="users_user_email_lower_uniq"),
+        ]
+
     def save(self, *args, **kwargs):
-        # Initialize BMI and BFP as None by default
-        self.bmi = None
-        self.bfp = None
+        weight = self.weight.weight if self.weight else None
+        height = self.height.height if self.height else None
+        self.age, self.bmi, self.bfp = compute_metrics(
+            height,
+            weight,
+            self.birth_date,
+            self.gender,
+            user_id=self.pk,
+        )
+        super().save(*args, **kwargs)
 
-        # Ensure weight and height exist before calculating BMI
-        if self.weight and self.height and float(self.height.height) > 0:
+    def cycle_prediction_payload(self):
+        return {
+            "age": int(self.age) if self.age else 0,
+            "height_cm": float(self.height.height) if self.height else 0,
+            "weight_kg": float(self.weight.weight) if self.weight else 0,
+            "bmi": float(self.bmi) if self.bmi else 0,
+            "bfp": float(self.bfp) if self.bfp else 0,
+            "cycle_day": int(self.cycle_day) if self.cycle_day else 0,
+            "cycle_length": int(self.cycle_length) if self.cycle_length else 0,
+        }
+
+    def apply_cycle_prediction(self, response):
+        """
+        Stores a predictor response (requests or httpx) on the instance.
+        Returns the result and the fields to save.
+        """
+        # Handle success
+        if response.status_code == 200:
             try:
-                weight_value = float(self.weight.weight)
-                height_value = float(self.height.height)
-                # Convert height to meters by dividing by 100
-                height_m = float(height_value) / 100
-                self.bmi = round(weight_value / (height_m**2), 2)
-            except (ValueError, TypeError):
-                print("TRACEBACK!!!")
-                import traceback
-
-                print(traceback.print_exc)
-                pass  # If weight or height can't be converted to float
-
-        # Calculate age from birth_date
-        if self.birth_date:
-            today = datetime.date.today()
-            birth_date = self.birth_date.date()  # convert datetime to date if needed
-            self.age = (
-                today.year
-                - birth_date.year
-                - ((today.month, today.day) < (birth_date.month, birth_date.day))
-            )
-        else:
-            self.age = None
-
-        # Calculate BFP using BMI + age + gender
-        if self.bmi is not None and self.age is not None:
-            if self.gender == self.MAN:
-                self.bfp = round((1.20 * self.bmi) + (0.23 * self.age) - 16.2, 1)
-            elif self.gender == self.WOMAN:
-                self.bfp = round((1.20 * self.bmi) + (0.23 * self.age) - 5.4, 1)
-
-        super().save(*args, **kwargs)
+                result = response.json()
+                predicted_phase = result.get("predicted_phase", str())
+                if predicted_phase:
+                    self.menstrual_phase = predicted_phase
+                self.cycle_record_json = result
+                return result, ["cycle_record_json", "menstrual_phase"]
+            except ValueError:
+                # Invalid JSON returned
+                self.cycle_record_json = {"error": "Invalid response format"}
+                return None, ["cycle_record_json"]
+        # Save error response
+        try:
+            error_data = response.json()
+        except ValueError:
+            error_data = {"error": "Unknown server error"}
+        self.cycle_record_json = {"error": error_data}
+        return error_data, ["cycle_record_json"]
 
     def predict_cycle_phase(self):
         """
         Sends a POST request to /phase-predict to get predicted menstrual phase.
         Saves the result to `cycle_record_json`.
         """
-        
-        # Prepare input data
         try:
-            payload = {
-                "age": int(self.age) if self.age else 0,
-                "height_cm": float(self.height.height) if self.height else 0,
-                "weight_kg": float(self.weight.weight) if self.weight else 0,
-                "bmi": float(self.bmi) if self.bmi else 0,
-                "bfp": float(self.bfp) if self.bfp else 0,
-                "cycle_day": int(self.cycle_day) if self.cycle_day else 0,
-                "cycle_length": int(self.cycle_length) if self.cycle_length else 0,
-            }
-            # Send POST request
-            url = "http://host.docker.internal:8000/phase/predict"
-            response = requests.post(url, json=payload)
-
-            # Handle success
-            if response.status_code == 200:
-                try:
-                    result = response.json()
-                    predicted_phase = result.get("predicted_phase", str())
-                    if predicted_phase:
-                        self.menstrual_phase = predicted_phase
-                    self.cycle_record_json = result
-                    self.save(update_fields=["cycle_record_json", "menstrual_phase"])
-                    return result
-                except ValueError:
-                    # Invalid JSON returned
-                    self.cycle_record_json = {"error": "Invalid response format"}
-                    self.save(update_fields=["cycle_record_json"])
-                    return None
-            else:
-                # Save error response
-                try:
-                    error_data = response.json()
-                except ValueError:
-                    error_data = {"error": "Unknown server error"}
-                self.cycle_record_json = {"error": error_data}
-                self.save(update_fields=["cycle_record_json"])
-                return error_data
-
+            response = predictor.predict(self.cycle_prediction_payload())
+            result, update_fields = self.apply_cycle_prediction(response)
         except Exception as e:
             # General error fallback
+            logger.warning(
+                "Cycle phase prediction failed for user %s", self.pk, exc_info=True
+            )
+            self.cycle_record_json = {"error": str(e)}
+            result, update_fields = {"error": str(e)}, ["cycle_record_json"]
+        self.save(update_fields=update_fields)
+        return result
+
+    async def apredict_cycle_phase(self):
+        """
+        Async version of predict_cycle_phase. Height and weight must already
+        be loaded (select_related) since lazy loads are not allowed here.
+        """
+        try:
+            response = await predictor.apredict(self.cycle_prediction_payload())
+            result, update_fields = self.apply_cycle_prediction(response)
+        except Exception as e:
+            logger.warning(
+                "Cycle phase prediction failed for user %s", self.pk, exc_info=True
+            )
             self.cycle_record_json = {"error": str(e)}
-            self.save(update_fields=["cycle_record_json"])
-            return {"error": str(e)}
+            result, update_fields = {"error": str(e)}, ["cycle_record_json"]
+        await self.asave(update_fields=update_fields)
+        return result
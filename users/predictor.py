@@ -0,0 +1,150 @@
+"""
+Clients for the cycle phase prediction service.
+
+Both clients keep connections to the predictor alive: ``predict`` shares one
+pooled ``requests.Session`` per process and ``apredict`` one
+``httpx.AsyncClient`` per event loop, so a slow predictor costs an open socket
+and, for the async views, no worker thread.
+
+Successful predictions are cached per payload for
+CYCLE_PREDICTION_CACHE_SECONDS; a cache hit is returned as a
+``CachedPrediction`` that answers like a 200 response.
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from api.cache import cache_namespace
+from api.metrics import observe_predictor_call
+
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=settings.CYCLE_PREDICTOR_MAX_CONNECTIONS,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=settings.CYCLE_PREDICTOR_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.CYCLE_PREDICTOR_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.CYCLE_PREDICTOR_MAX_CONNECTIONS,
+            ),
+        )
+    return client
+
+
+prediction_cache = cache_namespace(
+    "predictions", timeout=settings.CYCLE_PREDICTION_CACHE_SECONDS
+)
+
+
+class CachedPrediction:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def prediction_key(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def cacheable_data(response):
+    if response.status_code != 200:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        return None
+
+
+def predict(payload):
+    if not settings.CYCLE_PREDICTION_CACHE_SECONDS:
+        return _post(payload)
+
+    response = None
+
+    def fetch():
+        nonlocal response
+        response = _post(payload)
+        return cacheable_data(response)
+
+    # Concurrent requests with the same payload share one predictor call.
+    data = prediction_cache.get_or_set(prediction_key(payload), fetch)
+    if data is not None:
+        return CachedPrediction(data)
+    return response if response is not None else _post(payload)
+
+
+async def apredict(payload):
+    if not settings.CYCLE_PREDICTION_CACHE_SECONDS:
+        return await _apost(payload)
+
+    key = prediction_key(payload)
+    data = await sync_to_async(prediction_cache.get)(key)
+    if data is not None:
+        return CachedPrediction(data)
+    response = await _apost(payload)
+    data = cacheable_data(response)
+    if data is not None:
+        await sync_to_async(prediction_cache.set)(key, data)
+    return response
+
+
+def _post(payload):
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = get_session().post(
+            settings.CYCLE_PREDICTOR_URL,
+            json=payload,
+            timeout=settings.CYCLE_PREDICTOR_TIMEOUT,
+        )
+        status = str(response.status_code)
+        return response
+    finally:
+        observe_predictor_call(status, time.perf_counter() - started)
+
+
+async def _apost(payload):
+    started = time.perf_counter()
+    status = "error"
+    try:
+        response = await get_async_client().post(
+            settings.CYCLE_PREDICTOR_URL, json=payload
+        )
+        status = str(response.status_code)
+        return response
+    finally:
+        observe_predictor_call(status, time.perf_counter() - started)
@@ -1,3 +1,611 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.auth import hashers
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+
+from api.idempotency import claim, fingerprint, idempotent, record_key
+from api.passwords import login_failures
+from api.models import IdempotencyRecord
+from api.testing import BudgetTestCase
+from users.models import Allergen, HeightModel, User, WeightModel
+from users.authentication import token_queryset
+from users.views import PROFILE_USER_FIELDS, UpdateUserView
+
+PASSWORD = "correct horse battery"
+
+
+def create_user():
+    for name in ("nuts", "milk"):
+        Allergen.objects.create(name=name)
+    user = User(
+        username="anna",
+        email="anna@example.com",
+        gender=User.WOMAN,
+        target_weight=60,
+        goal=User.WEIGHT_LOSS,
+        activity_level=User.MODERATE,
+        cycle_day=5,
+        cycle_length=28,
+    )
+    user.set_password(PASSWORD)
+    user.save()
+    user.height = HeightModel.objects.create(user=user, height=170)
+    user.weight = WeightModel.objects.create(user=user, weight=65)
+    user.save()
+    user.allergens.add(*Allergen.objects.all())
+    return user, Token.objects.create(user=user)
+
+
+def auth(token):
+    return {"headers": {"Authorization": "Token %s" % token.key}}
+
+
+class UserEndpointBudgetTests(BudgetTestCase):
+    """
+    Query and predictor call budgets of the user endpoints. When a change
+    legitimately adds or removes a query, update the budget with it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.token = create_user()
+
+    def post(self, path, data=None, **extra):
+        return self.client.post(
+            path, json.dumps(data or {}), content_type="application/json", **extra
+        )
+
+    def test_create(self):
+        body = {
+            "username": "maria",
+            "password": PASSWORD,
+            "email": "maria@example.com",
+            "birthDate": "1995-04-01",
+            "gender": "female",
+            "height": 165,
+            "weight": 58,
+            "allergens": ["nuts", "milk"],
+            "cycleDay": 3,
+            "cycleLength": 28,
+        }
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_allergen",
+            # Without a sequence to reserve the id from (SQLite), the user is
+            # inserted first and updated once its measurements exist.
+            "INSERT users_user",
+            "INSERT users_heightmodel",
+            "INSERT users_weightmodel",
+            "UPDATE users_user",
+            "INSERT users_user_allergens",
+            "INSERT authtoken_token",
+            # The prediction runs once the registration is committed (here:
+            # when the captured callbacks run, after the response is built).
+            "UPDATE users_user",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.post("/api/users/create/", body)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["allergens"], ["nuts", "milk"])
+
+    def test_create_unknown_allergen(self):
+        body = {
+            "username": "maria",
+            "password": PASSWORD,
+            "email": "maria@example.com",
+            "allergens": ["nuts", "gluten"],
+        }
+        budget = ["INSERT api_throttle", "SELECT users_allergen", "SELECT users_allergen"]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/create/", body)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.filter(email="maria@example.com").exists())
+
+    def test_create_is_atomic(self):
+        body = {"username": "maria", "password": PASSWORD, "email": "maria@example.com"}
+        with mock.patch.object(Token.objects, "create", side_effect=IntegrityError):
+            response = self.post("/api/users/create/", body)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.filter(email="maria@example.com").exists())
+        self.assertFalse(HeightModel.objects.exclude(user=self.user).exists())
+
+    def test_create_without_prediction(self):
+        body = {
+            "username": "max",
+            "password": PASSWORD,
+            "email": "max@example.com",
+            "birthDate": "1990-01-01",
+            "gender": "male",
+        }
+        budget = [
+            "INSERT api_throttle",
+            "INSERT users_user",
+            "INSERT users_heightmodel",
+            "INSERT users_weightmodel",
+            "UPDATE users_user",
+            "INSERT authtoken_token",
+        ]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/create/?fields=username,bmi", body)
+        self.assertEqual(response.status_code, 200)
+
+    def test_login(self):
+        body = {"email": "anna@example.com", "password": PASSWORD}
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_user",
+            "SELECT api_loginfailure",
+            "SELECT authtoken_token",
+            # The prediction; the login itself leaves the user row alone.
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = self.post("/api/users/login/", body)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("token", response.json())
+
+    def test_login_wrong_password(self):
+        body = {"email": "anna@example.com", "password": "wrong"}
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_user",
+            "SELECT api_loginfailure",
+            "INSERT api_loginfailure",
+        ]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/login/", body)
+        self.assertEqual(response.content, b'"invalid login"')
+
+    @override_settings(LOGIN_MAX_FAILURES=2)
+    def test_login_locked_after_failures(self):
+        wrong = {"email": "anna@example.com", "password": "wrong"}
+        for _ in range(2):
+            self.assertEqual(self.post("/api/users/login/", wrong).status_code, 200)
+        body = {"email": "anna@example.com", "password": PASSWORD}
+        budget = ["INSERT api_throttle", "SELECT users_user", "SELECT api_loginfailure"]
+        with mock.patch("users.views.check_password") as check_password:
+            with self.assertBudget(budget):
+                response = self.post("/api/users/login/", body)
+        self.assertEqual(response.status_code, 429)
+        check_password.assert_not_called()
+
+    def test_login_clears_failures(self):
+        wrong = {"email": "anna@example.com", "password": "wrong"}
+        self.post("/api/users/login/", wrong)
+        body = {"email": "anna@example.com", "password": PASSWORD}
+        self.assertIn("token", self.post("/api/users/login/", body).json())
+        self.assertEqual(login_failures(self.user.pk), 0)
+
+    def test_login_unknown_email(self):
+        body = {"email": "nobody@example.com", "password": PASSWORD}
+        with self.assertBudget(["INSERT api_throttle", "SELECT users_user"]):
+            response = self.post("/api/users/login/", body)
+        self.assertEqual(response.status_code, 404)
+
+    def test_profile(self):
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = self.post("/api/users/profile/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["menstrualPhase"], "follicular")
+
+    def test_profile_prediction_is_cached(self):
+        self.post("/api/users/profile/", **auth(self.token))
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=0):
+            response = self.post("/api/users/profile/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+
+    def test_profile_fields(self):
+        with self.assertBudget(["SELECT authtoken_token", "INSERT api_throttle"]):
+            response = self.post(
+                "/api/users/profile/?fields=username,bmi", **auth(self.token)
+            )
+        self.assertEqual(set(response.json()["data"]), {"username", "bmi"})
+
+    def test_authentication_loads_slim_user(self):
+        budget = ["SELECT authtoken_token", "INSERT api_throttle", "SELECT users_weightmodel"]
+        with self.assertBudget(budget) as checker:
+            response = self.post("/api/users/weights/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+        sql = checker.queries[0][1]
+        self.assertIn('"users_user"."is_active"', sql)
+        self.assertNotIn("cycle_record_json", sql)
+        self.assertNotIn("password", sql)
+
+    @override_settings(DATABASE_SHARDS=["default"])
+    def test_authentication_skips_sharded_joins(self):
+        sql = str(token_queryset(PROFILE_USER_FIELDS, ("height", "weight")).query)
+        self.assertNotIn("users_heightmodel", sql)
+        self.assertIn('"users_user"."height_id"', sql)
+
+    def test_profile_unauthenticated(self):
+        with self.assertBudget([]):
+            response = self.post("/api/users/profile/")
+        self.assertEqual(response.status_code, 401)
+
+    def test_weights(self):
+        budget = ["SELECT authtoken_token", "INSERT api_throttle", "SELECT users_weightmodel"]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/weights/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout(self):
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "SELECT authtoken_token",
+            "DELETE authtoken_token",
+        ]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/logout/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+
+    def test_update(self):
+        body = {"targetWeight": 58, "allergens": ["nuts"], "weight": 64, "password": PASSWORD}
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "SELECT users_allergen",
+            "INSERT users_user_allergens",
+            "INSERT users_heightmodel",
+            "INSERT users_weightmodel",
+            "UPDATE users_user",
+        ]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/update/", body, **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_unknown_allergen(self):
+        body = {"allergens": ["gluten"], "weight": 64, "password": PASSWORD}
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "SELECT users_allergen",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget):
+            response = self.post("/api/users/update/", body, **auth(self.token))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WeightModel.objects.filter(user=self.user, weight=64).exists())
+
+    def test_update_without_password_keeps_it(self):
+        with mock.patch("users.views.make_password") as make_password:
+            response = self.post("/api/users/update/", {"weight": 64}, **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+        make_password.assert_not_called()
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password(PASSWORD))
+
+    def test_predict_cycle_phase(self):
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "UPDATE users_user",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = self.post("/api/users/predict_cycle_phase/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_profile(self):
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = await self.async_client.post(
+                "/api/users/async/profile/", **auth(self.token)
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_authentication_loads_profile_columns(self):
+        with self.assertBudget(["SELECT authtoken_token", "INSERT api_throttle"]) as checker:
+            response = await self.async_client.post(
+                "/api/users/async/profile/?fields=username", **auth(self.token)
+            )
+        self.assertEqual(response.status_code, 200)
+        sql = checker.queries[0][1]
+        self.assertIn('"users_user"."bmi"', sql)
+        self.assertNotIn("cycle_record_json", sql)
+        self.assertNotIn("password", sql)
+
+    @override_settings(DATABASE_SHARDS=["default"])
+    async def test_async_profile_sharded(self):
+        # Height and weight come from the user's shard, not a join.
+        budget = [
+            "SELECT authtoken_token",
+            "SELECT users_heightmodel",
+            "SELECT users_weightmodel",
+            "INSERT api_throttle",
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = await self.async_client.post(
+                "/api/users/async/profile/", **auth(self.token)
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["height"], 170)
+
+    async def test_async_predict_cycle_phase(self):
+        budget = ["SELECT authtoken_token", "INSERT api_throttle", "UPDATE users_user"]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = await self.async_client.post(
+                "/api/users/async/predict_cycle_phase/", **auth(self.token)
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_login(self):
+        body = {"email": "anna@example.com", "password": PASSWORD}
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_user",
+            "SELECT api_loginfailure",
+            "SELECT authtoken_token",
+            "UPDATE users_user",
+            "SELECT users_allergen",
+        ]
+        with self.assertBudget(budget, predictor_calls=1):
+            response = await self.async_client.post(
+                "/api/users/async/login/", json.dumps(body), content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 200)
+
+
+class TokenLifecycleTests(BudgetTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.token = create_user()
+
+    def age_token(self, seconds):
+        created = timezone.now() - timedelta(seconds=seconds)
+        Token.objects.filter(pk=self.token.pk).update(created=created)
+
+    def login(self):
+        body = {"email": "anna@example.com", "password": PASSWORD}
+        return self.client.post(
+            "/api/users/login/?fields=username", json.dumps(body),
+            content_type="application/json",
+        )
+
+    def test_login_reuses_valid_token(self):
+        self.assertEqual(self.login().json()["token"], self.token.key)
+
+    @override_settings(PASSWORD_HASHERS=[
+        "django.contrib.auth.hashers.MD5PasswordHasher",
+        "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+    ])
+    def test_login_saves_rehashed_password_only(self):
+        hasher = hashers.PBKDF2PasswordHasher()
+        encoded = hasher.encode(PASSWORD, hasher.salt(), iterations=1000)
+        User.objects.filter(pk=self.user.pk).update(password=encoded)
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_user",
+            "SELECT api_loginfailure",
+            "UPDATE users_user",
+            "SELECT authtoken_token",
+        ]
+        with self.assertBudget(budget):
+            self.assertEqual(self.login().json()["token"], self.token.key)
+        self.assertTrue(User.objects.get(pk=self.user.pk).password.startswith("md5$"))
+
+    @override_settings(TOKEN_TTL_SECONDS=3600)
+    def test_login_replaces_expired_token(self):
+        self.age_token(3600)
+        budget = [
+            "INSERT api_throttle",
+            "SELECT users_user",
+            "SELECT api_loginfailure",
+            "SELECT authtoken_token",
+            "UPDATE authtoken_token",
+        ]
+        with self.assertBudget(budget):
+            key = self.login().json()["token"]
+        self.assertNotEqual(key, self.token.key)
+        self.assertEqual(Token.objects.get(user=self.user).key, key)
+
+    @override_settings(TOKEN_TTL_SECONDS=3600)
+    def test_expired_token_is_rejected(self):
+        self.age_token(3600)
+        with self.assertBudget(["SELECT authtoken_token"]):
+            response = self.client.post("/api/users/weights/", **auth(self.token))
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(TOKEN_TTL_SECONDS=3600, TOKEN_RENEW_AFTER_SECONDS=60)
+    def test_token_in_use_is_renewed(self):
+        self.age_token(600)
+        budget = [
+            "SELECT authtoken_token",
+            "UPDATE authtoken_token",
+            "INSERT api_throttle",
+            "SELECT users_weightmodel",
+        ]
+        with self.assertBudget(budget):
+            response = self.client.post("/api/users/weights/", **auth(self.token))
+        self.assertEqual(response.status_code, 200)
+        self.token.refresh_from_db()
+        self.assertLess(timezone.now() - self.token.created, timedelta(seconds=60))
+
+    @override_settings(TOKEN_TTL_SECONDS=3600)
+    def test_purge_expired_tokens(self):
+        self.age_token(3600)
+        other = User.objects.create(
+            username="olga", email="olga@example.com", gender=User.WOMAN,
+            target_weight=60, goal=User.MAINTENANCE, activity_level=User.LIGHT,
+        )
+        kept = Token.objects.create(user=other)
+        call_command("purge_expired_tokens", chunk_size=1, stdout=StringIO())
+        self.assertEqual(list(Token.objects.values_list("key", flat=True)), [kept.key])
+
+    def test_admin_search(self):
+        admin = User.objects.create_superuser("admin@example.com", "admin password")
+        self.client.force_login(admin)
+        for term, count in (("ANNA@example.com", 1), (self.token.key, 1), ("anna", 0)):
+            response = self.client.get("/admin/authtoken/token/", {"q": term})
+            self.assertEqual(response.context["cl"].result_count, count, term)
+
+
+class IdempotencyTests(BudgetTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.token = create_user()
+
+    def update(self, body, key="retry-1"):
+        headers = {**auth(self.token)["headers"], "Idempotency-Key": key}
+        return self.client.post(
+            "/api/users/update/", json.dumps(body), content_type="application/json",
+            headers=headers,
+        )
+
+    def test_replay(self):
+        body = {"weight": 64, "password": PASSWORD}
+        self.assertEqual(self.update(body).status_code, 200)
+        budget = [
+            "SELECT authtoken_token",
+            "INSERT api_throttle",
+            "INSERT api_idempotencyrecord",
+            "SELECT api_idempotencyrecord",
+        ]
+        with self.assertBudget(budget):
+            response = self.update(body)
+        self.assertEqual(response.json(), {"status": "success"})
+        self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(WeightModel.objects.filter(user=self.user).count(), 2)
+
+    def test_key_reused_for_other_request(self):
+        self.update({"weight": 64, "password": PASSWORD})
+        response = self.update({"weight": 63, "password": PASSWORD})
+        self.assertEqual(response.status_code, 422)
+
+    @override_settings(IDEMPOTENCY_WAIT_SECONDS=0)
+    def test_in_progress(self):
+        body = {"weight": 64, "password": PASSWORD}
+        request = mock.Mock(user=self.user, data=body)
+        self.assertTrue(claim(record_key(UpdateUserView(), request, "retry-1"), fingerprint(request)))
+        response = self.update(body)
+        self.assertEqual(response.status_code, 409)
+
+    def test_server_error_is_not_stored(self):
+        unavailable = idempotent(lambda view, request: Response("Unavailable", status=503))
+        body = {"weight": 64, "password": PASSWORD}
+        with mock.patch.object(UpdateUserView, "post", unavailable):
+            self.assertEqual(self.update(body).status_code, 503)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+        self.assertEqual(self.update(body).status_code, 200)
+
+    def test_exception_is_not_stored(self):
+        def fail(view, request):
+            raise RuntimeError("handler failed")
+
+        body = {"weight": 64, "password": PASSWORD}
+        with mock.patch.object(UpdateUserView, "post", idempotent(fail)):
+            with self.assertRaises(RuntimeError):
+                self.update(body)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class BulkUpsertTests(BudgetTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.token = create_user()
+        cls.staff = User.objects.create(
+            username="staff", email="staff@example.com", is_staff=True,
+            gender=User.MAN, target_weight=80, goal=User.MAINTENANCE,
+            activity_level=User.MODERATE,
+        )
+        cls.staff_token = Token.objects.create(user=cls.staff)
+
+    def upsert(self, users, token):
+        return self.client.post(
+            "/api/users/bulk_upsert/", json.dumps({"users": users}),
+            content_type="application/json", **auth(token),
+        )
+
+    def test_requires_staff(self):
+        response = self.upsert([{"email": "new@example.com"}], self.token)
+        self.assertEqual(response.status_code, 403)
+
+    def test_rejects_duplicate_emails(self):
+        users = [{"email": "new@example.com"}, {"email": "NEW@example.com"}]
+        response = self.upsert(users, self.staff_token)
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_invalid_measurements(self):
+        for value in ("tall", -180, 0, 12345.678, True, [1]):
+            users = [
+                {"email": "ok@example.com"},
+                {"email": "new@example.com", "height": value},
+            ]
+            response = self.upsert(users, self.staff_token)
+            self.assertEqual(response.status_code, 400, value)
+            self.assertIn("at index 1: height", response.json())
+        users = [{"email": "new@example.com", "targetWeight": "x"}]
+        response = self.upsert(users, self.staff_token)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("at index 0: targetWeight", response.json())
+
+    def test_email_index_is_case_insensitive(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create(
+                username="Anna2", email="ANNA@example.com", gender=User.WOMAN,
+                target_weight=60, goal=User.MAINTENANCE, activity_level=User.MODERATE,
+            )
+
+    def test_email_index_migration_reports_duplicates(self):
+        check = import_module(
+            "users.migrations.0022_user_email_lower_uniq"
+        ).check_email_duplicates
+        # Only the editor's connection is used.
+        editor = mock.Mock(connection=connection)
+        check(apps, editor)
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX users_user_email_lower_uniq")
+        User.objects.create(
+            username="Anna2", email="ANNA@example.com", gender=User.WOMAN,
+            target_weight=60, goal=User.MAINTENANCE, activity_level=User.MODERATE,
+        )
+        with self.assertRaisesMessage(RuntimeError, "anna@example.com: user ids"):
+            check(apps, editor)
+
+    @skipUnless(connection.vendor == "postgresql", "ON CONFLICT (lower(email))")
+    def test_upsert(self):
+        users = [
+            {"email": "ANNA@example.com", "weight": 61, "birthDate": "1990-05-01"},
+            {"email": "new@example.com", "gender": "male", "height": 180, "weight": 90},
+        ]
+        response = self.upsert(users, self.staff_token)
+        self.assertEqual(
+            [row["status"] for row in response.json()["users"]], ["updated", "created"]
+        )
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, "anna@example.com")
+        self.assertEqual(float(self.user.weight.weight), 61)
+        self.assertEqual(self.user.bmi, round(61 / 1.7**2, 2))
+        new = User.objects.get(email="new@example.com")
+        self.assertEqual(new.bmi, round(90 / 1.8**2, 2))
+        self.assertFalse(new.has_usable_password())
@@ -1,11 +1,25 @@
+import logging
 from datetime import datetime
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.db.utils import IntegrityError
-from django.contrib.auth import get_user_model, authenticate
+from django.conf import settings
 from rest_framework.views import APIView
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
+from api.db.replicas import pin_to_primary
+from api.idempotency import idempotent
+from api.passwords import (
+    check_password,
+    clear_login_failures,
+    login_failures,
+    make_password,
+    record_login_failure,
+)
+from api.db.sharding import shard_for_user
+from users.authentication import TokenAuthentication, local_relations, login_token
 from users.models import User
 from users.models import HeightModel, WeightModel, Allergen
 
@@ -26,15 +40,105 @@ activity_levels_2 = {
 goals = {1: "weightLoss", 2: "weightGain", 3: "maintenance"}
 goals_2 = {"loseWeight": 1, "gainWeight": 2, "maintain": 3}
 
+# Users accepted per bulk upsert request.
+BULK_UPSERT_MAX_ROWS = 5000
+
+# Only user ids and field names are logged, never request bodies or emails.
+logger = logging.getLogger(__name__)
+
+# Profile response fields. Each getter only touches what its field needs, so
+# a ``?fields=`` subset skips the allergen query and the height/weight lookups
+# of the omitted fields.
+PROFILE_FIELD_GETTERS = {
+    "username": lambda user: user.username,
+    "gender": lambda user: "male" if user.gender == 1 else "female",
+    "email": lambda user: user.email,
+    "birthDate": lambda user: user.birth_date,
+    "weight": lambda user: user.weight.weight if user.weight_id else None,
+    "height": lambda user: user.height.height if user.height_id else None,
+    "activityLevel": lambda user: activity_levels.get(user.activity_level, "sedentary"),
+    "targetWeight": lambda user: user.target_weight,
+    "goal": lambda user: goals.get(user.goal, "loseWeight"),
+    "menstrualCycles": lambda user: [],
+    "menstrualPhase": lambda user: user.menstrual_phase,
+    "cycleDay": lambda user: user.cycle_day,
+    "cycleLength": lambda user: user.cycle_length,
+    "lastPeriodDate": lambda user: user.last_period_date,
+    "age": lambda user: user.age,
+    "bmi": lambda user: user.bmi,
+    "bfp": lambda user: user.bfp,
+    "allergens": lambda user: [allergen.name for allergen in user.allergens.all()],
+}
+PROFILE_FIELDS = tuple(PROFILE_FIELD_GETTERS)
+
+# User columns read by the profile getters and by a cycle prediction (which
+# saves the user and so recomputes the stored metrics).
+PROFILE_USER_FIELDS = (
+    "username", "email", "gender", "birth_date", "height", "weight",
+    "activity_level", "target_weight", "goal", "menstrual_phase", "cycle_day",
+    "cycle_length", "last_period_date", "age", "bmi", "bfp",
+)
+
+
+def get_profile_fields(request):
+    """
+    Returns the profile fields selected with ``?fields=a,b`` in canonical order,
+    or all of them. Raises ValueError on unknown field names.
+    """
+    raw = request.GET.get("fields")
+    if not raw:
+        return PROFILE_FIELDS
+    requested = {name.strip() for name in raw.split(",") if name.strip()}
+    unknown = requested.difference(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+    return tuple(name for name in PROFILE_FIELDS if name in requested)
+
+
+def get_allergen_ids(names):
+    """Allergen ids for ``names``; raises Allergen.DoesNotExist on unknown names."""
+    if not names:
+        return []
+    ids_by_name = Allergen.ids_by_name()
+    missing = set(names).difference(ids_by_name)
+    if missing:
+        # Names missing from the cached map may have been added since.
+        ids_by_name = {
+            **ids_by_name,
+            **dict(Allergen.objects.filter(name__in=missing).values_list("name", "pk")),
+        }
+        unknown = missing.difference(ids_by_name)
+        if unknown:
+            raise Allergen.DoesNotExist("Unknown allergens: " + ", ".join(sorted(unknown)))
+    return [ids_by_name[name] for name in dict.fromkeys(names)]
+
+
+def build_profile_data(user, fields=PROFILE_FIELDS):
+    return {name: PROFILE_FIELD_GETTERS[name](user) for name in fields}
+
+
+def delete_sharded_measurements(rows):
+    """Deletes measurements that were committed on a shard on their own."""
+    if not settings.DATABASE_SHARDS:
+        return
+    for row in rows:
+        type(row)._base_manager.using(row._state.db).filter(pk=row.pk).delete()
+
 
 class CreateUpdateUserView(APIView):
     """Create user"""
 
     permission_classes = [AllowAny]  # Allow public access to model information
 
+    @idempotent
     def post(self, request):
         data = request.data
-        print("CreateUpdateUserView. data: ", data)
+        logger.info("Create user request with fields %s", sorted(data))
+
+        try:
+            fields = get_profile_fields(request)
+        except ValueError as e:
+            return Response(str(e), status=400)
 
         username = data.get("username")
         password = data.get("password")
@@ -42,6 +146,8 @@ class CreateUpdateUserView(APIView):
 
         if birth_date:
             birth_date_dt = datetime.fromisoformat(birth_date)
+        else:
+            birth_date_dt = None
 
         email = data.get("email")
 
@@ -71,83 +177,77 @@ class CreateUpdateUserView(APIView):
             last_period_date_dt = None
 
         try:
-            User.objects.create(
-                username=username,
-                birth_date=birth_date_dt,
-                email=email,
-                gender=gender,
-                target_weight=target_weight,
-                goal=goal,
-                activity_level=activity_levels_2.get(data.get("activityLevel"), 1),
-                cycle_length=cycle_length,
-                cycle_day=cycle_day,
-                last_period_date=last_period_date_dt,
-            )
+            allergen_ids = get_allergen_ids(data.get("allergens", []))
+        except Allergen.DoesNotExist as e:
+            return Response(str(e), status=400)
+
+        user = User(
+            username=username,
+            birth_date=birth_date_dt,
+            email=email,
+            gender=gender,
+            target_weight=target_weight,
+            goal=goal,
+            activity_level=activity_levels_2.get(data.get("activityLevel"), 1),
+            cycle_length=cycle_length,
+            cycle_day=cycle_day,
+            last_period_date=last_period_date_dt,
+        )
+        # Hash before the transaction opens; it is the slowest step.
+        user.password = make_password(password)
+
+        # Everything is created or nothing: a user without measurements or a
+        # token could not log in properly. With a reserved id (PostgreSQL)
+        # the measurements are written first and the user once, complete;
+        # otherwise the user row is inserted and then given its measurements.
+        # Measurements on a shard commit on their own and are deleted again
+        # when the registration fails.
+        user.pk = User.objects.reserve_pk()
+        measurements = []
+        try:
+            with transaction.atomic():
+                if user.pk is None:
+                    user.save()
+                shard = shard_for_user(user.pk)
+                with transaction.atomic(using=shard, savepoint=False):
+                    user.height = HeightModel.objects.create(
+                        user_id=user.pk, height=data.get("height", 175)
+                    )
+                    measurements.append(user.height)
+                    user.weight = WeightModel.objects.create(
+                        user_id=user.pk, weight=data.get("weight", 80)
+                    )
+                    measurements.append(user.weight)
+                if user._state.adding:
+                    # Also fills in the metrics, which need the measurements.
+                    user.save(force_insert=True)
+                else:
+                    user.save(update_fields=["height", "weight", "age", "bmi", "bfp"])
+                if allergen_ids:
+                    User.allergens.through.objects.bulk_create(
+                        User.allergens.through(user=user, allergen_id=allergen_id)
+                        for allergen_id in allergen_ids
+                    )
+                token = Token.objects.create(user=user)
+                if user.gender == User.WOMAN and "menstrualPhase" in fields:
+                    # Not while holding the transaction open on the predictor.
+                    transaction.on_commit(user.predict_cycle_phase)
         except IntegrityError:
-            print("users create error exception traceback")
-            import traceback
-
-            print(traceback.print_exc())
+            delete_sharded_measurements(measurements)
+            # The database error text contains the conflicting email.
+            logger.warning("Create user failed with an integrity error")
             return Response("Integrity error", status=400)
+        except Exception:
+            delete_sharded_measurements(measurements)
+            raise
 
-        user = None
-        for val in get_user_model().objects.all():
-            if val.email == email:
-                user = val
-                break
+        pin_to_primary(token.key)
 
-        allergens = data.get("allergens", [])
-        if allergens:
-            for allergen in allergens:
-                allergen_value = Allergen.objects.get(name=allergen)
-                user.allergens.add(allergen_value)
-
-        height = data.get("height", 175)
-        height = HeightModel(height=height, user=user)
-        height.save()
-
-        weight = data.get("weight", 80)
-        weight = WeightModel(weight=weight, user=user)
-        weight.save()
-
-        user.weight = weight
-        user.height = height
-        user.set_password(password)
-        user.save()
-
-        if user.gender == User.WOMAN:
-            user.predict_cycle_phase()
-
-        token = Token.objects.create(user=user)
-
-        return Response(
-            {
-                "token": token.key,
-                "data": {
-                    "username": user.username,
-                    "gender": "male" if user.gender == 1 else "female",
-                    "email": user.email,
-                    "birthDate": user.birth_date,
-                    "weight": weight.weight,
-                    "height": height.height,
-                    "activityLevel": activity_levels.get(
-                        user.activity_level, "sedentary"
-                    ),
-                    "targetWeight": user.target_weight,
-                    "goal": goals.get(user.goal, "loseWeight"),
-                    "menstrualCycles": [],
-                    "menstrualPhase": user.menstrual_phase,
-                    "cycleDay": user.cycle_day,
-                    "cycleLength": user.cycle_length,
-                    "lastPeriodDate": user.last_period_date,
-                    "age": user.age,
-                    "bmi": user.bmi,
-                    "bfp": user.bfp,
-                    "allergens": [allergen.name for allergen in user.allergens.all()],
-                },
-            },
-            status=200,
-        )
+        profile = build_profile_data(user, [name for name in fields if name != "allergens"])
+        if "allergens" in fields:
+            # The names were just resolved; no need to read them back.
+            profile["allergens"] = list(dict.fromkeys(data.get("allergens") or []))
+        return Response({"token": token.key, "data": profile}, status=200)
 
 
 class LoginUserView(APIView):
@@ -157,63 +257,59 @@ class LoginUserView(APIView):
 
     def post(self, request):
         data = request.data
-        print("LoginUserView. data: ", data)
+
+        try:
+            fields = get_profile_fields(request)
+        except ValueError as e:
+            return Response(str(e), status=400)
 
         email = data.get("email")
-        users = get_user_model().objects.all()
-        for user in users:
-            if user.email == email:
-                target_user = user
-                break
-        else:
+        target_user = (
+            User.objects.select_related(*local_relations(("height", "weight")))
+            .filter(email=email)
+            .first()
+        )
+        if target_user is None:
+            logger.info("Login for an unknown email")
             return Response("No user", status=404)
 
-        user = authenticate(
-            request=request,
-            username=email,
-            password=data.get("password"),
-        )
-        if user is None:
+        # Rejected before the password is hashed.
+        failures = login_failures(target_user.pk)
+        if failures >= settings.LOGIN_MAX_FAILURES:
+            logger.info("Login for locked user %s", target_user.pk)
+            return Response(
+                "Too many failed logins",
+                status=429,
+                headers={"Retry-After": str(settings.LOGIN_FAILURE_WINDOW_SECONDS)},
+            )
+        if not target_user.is_active:
             return Response("invalid login", status=200)
 
-        old_token = Token.objects.filter(user=target_user)
-        if old_token:
-            old_token.delete()
-
-        token = Token.objects.create(user=target_user)
-        target_user.save()
-
-        if target_user.gender == User.WOMAN:
+        password = data.get("password")
+        correct, rehash = check_password(password, target_user.password)
+        if not correct:
+            record_login_failure(target_user.pk)
+            logger.info("Failed login for user %s", target_user.pk)
+            return Response("invalid login", status=200)
+        if failures:
+            clear_login_failures(target_user.pk)
+        if rehash:
+            target_user.password = make_password(password)
+            target_user.save(update_fields=["password"])
+
+        token, new_key = login_token(target_user)
+        if new_key:
+            # The new token is not on the replicas yet.
+            pin_to_primary(token.key)
+        logger.info("User %s logged in", target_user.pk)
+
+        if target_user.gender == User.WOMAN and "menstrualPhase" in fields:
             target_user.predict_cycle_phase()
 
-        weight = target_user.weight
-        height = target_user.height
-
         return Response(
             {
                 "token": token.key,
-                "data": {
-                    "username": target_user.username,
-                    "gender": "male" if target_user.gender == 1 else "female",
-                    "email": target_user.email,
-                    "birthDate": target_user.birth_date,
-                    "weight": weight.weight,
-                    "height": height.height,
-                    "activityLevel": activity_levels.get(
-                        target_user.activity_level, "sedentary"
-                    ),
-                    "targetWeight": target_user.target_weight,
-                    "goal": goals.get(target_user.goal, "loseWeight"),
-                    "menstrualCycles": [],
-                    "menstrualPhase": target_user.menstrual_phase,
-                    "cycleDay": target_user.cycle_day,
-                    "cycleLength": target_user.cycle_length,
-                    "lastPeriodDate": target_user.last_period_date,
-                    "age": target_user.age,
-                    "bmi": target_user.bmi,
-                    "bfp": target_user.bfp,
-                    "allergens": [allergen.name for allergen in user.allergens.all()],
-                },
+                "data": build_profile_data(target_user, fields),
             },
             status=200,
         )
@@ -222,38 +318,28 @@ class LoginUserView(APIView):
 class ProfileInfoView(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    replica_reads = True
+    user_fields = PROFILE_USER_FIELDS
+    user_select_related = ("height", "weight")
 
     def post(self, request):
         user = request.user
-        print("ProfileInfoView. user: ", request.user)
+        logger.info("Profile requested by user %s", user.pk)
 
-        user.predict_cycle_phase()
+        try:
+            fields = get_profile_fields(request)
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+        if "menstrualPhase" in fields:
+            user.predict_cycle_phase()
+        if "allergens" in fields:
+            prefetch_related_objects([user], "allergens")
 
-        weight = user.weight
-        height = user.height
         result = {
             "status": "Success",
             "message": "Success",
-            "data": {
-                "username": user.username,
-                "gender": "male" if user.gender == 1 else "female",
-                "email": user.email,
-                "birthDate": user.birth_date,
-                "weight": weight.weight,
-                "height": height.height,
-                "activityLevel": activity_levels.get(user.activity_level, "sedentary"),
-                "targetWeight": user.target_weight,
-                "goal": goals.get(user.goal, "loseWeight"),
-                "menstrualCycles": [],
-                "menstrualPhase": user.menstrual_phase,
-                "cycleDay": user.cycle_day,
-                "cycleLength": user.cycle_length,
-                "lastPeriodDate": user.last_period_date,
-                "age": user.age,
-                "bmi": user.bmi,
-                "bfp": user.bfp,
-                "allergens": [allergen.name for allergen in user.allergens.all()],
-            },
+            "data": build_profile_data(user, fields),
         }
 
         return Response(result, status=200)
@@ -262,10 +348,11 @@ class ProfileInfoView(APIView):
 class WeightHistoryView(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    replica_reads = True
 
     def post(self, request, *args, **kwargs):
         user = request.user
-        print("WeightHistoryView. user: ", user)
+        logger.info("Weight history requested by user %s", user.pk)
         weights = WeightModel.objects.filter(user=user)
         weights_list = [
             {str(weight.weight): weight.updated_at.strftime("%Y-%m-%d")}
@@ -280,7 +367,7 @@ class LogoutUserView(APIView):
 
     def post(self, request):
         user = request.user
-        print("LogoutUserView: ", request.user)
+        logger.info("User %s logged out", user.pk)
         old_token = Token.objects.filter(user=user)
         if old_token:
             old_token.delete()
@@ -290,13 +377,22 @@ class LogoutUserView(APIView):
 class UpdateUserView(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    # Saves the whole user.
+    user_fields = None
 
+    @idempotent
     def post(self, request):
         user = request.user
         data = request.data
 
-        print("UpdateUserView. user: ", user)
-        print("UpdateUserView. data: ", data)
+        logger.info("Update of user %s with fields %s", user.pk, sorted(data))
+
+        # Checked before anything is written.
+        allergens = data.get("allergens", [])
+        try:
+            allergen_ids = get_allergen_ids(allergens)
+        except Allergen.DoesNotExist as e:
+            return Response(str(e), status=400)
 
         if data.get("username"):
             user.username = data.get("username")
@@ -354,11 +450,8 @@ class UpdateUserView(APIView):
         if last_period_date_dt:
             user.last_period_date = last_period_date_dt
 
-        allergens = data.get("allergens", [])
-        if allergens:
-            for allergen in allergens:
-                allergen_value = Allergen.objects.get(name=allergen)
-                user.allergens.add(allergen_value)
+        if allergen_ids:
+            user.allergens.add(*allergen_ids)
 
         height = data.get("height", 175)
         if height:
@@ -373,9 +466,12 @@ class UpdateUserView(APIView):
         user.weight = weight
         user.height = height
 
+        # Without a new password the stored hash is kept and nothing is hashed.
         password = data.get("password")
-        user.set_password(password)
+        if password:
+            user.password = make_password(password)
         user.save()
+        pin_to_primary(request.auth.key)
 
         return Response({"status": "success"}, status=200)
 
@@ -383,10 +479,109 @@ class UpdateUserView(APIView):
 class PredictCyclePhaseView(APIView):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
+    user_fields = PROFILE_USER_FIELDS
+    user_select_related = ("height", "weight")
 
     def post(self, request):
         user = request.user
-        print("PredictCyclePhaseView. user: ", user)
+        logger.info("Cycle phase prediction requested by user %s", user.pk)
         user.predict_cycle_phase()
         result = user.cycle_record_json
         return Response(result, status=200)
+
+
+def parse_measurement(name, field, value):
+    """
+    ``value`` of the request field ``name`` as a Decimal that the model
+    DecimalField ``field`` can store. Raises ValueError when it cannot or
+    when it is not positive.
+    """
+    if isinstance(value, bool):
+        raise ValueError("%s must be a number" % name)
+    try:
+        value = field.clean(value, None)
+    except ValidationError as e:
+        raise ValueError("%s: %s" % (name, " ".join(e.messages))) from None
+    if value is None or value <= 0:
+        raise ValueError("%s must be positive" % name)
+    return value
+
+
+def parse_upsert_row(data):
+    """UserManager.bulk_upsert() row for one user of a bulk upsert request."""
+    row = {
+        "email": data["email"],
+        "gender": User.MAN if data.get("gender") == "male" else User.WOMAN,
+        "goal": goals_2.get(data.get("goal", ""), 1),
+        "activity_level": activity_levels_2.get(data.get("activityLevel"), 1),
+        "target_weight": parse_measurement(
+            "targetWeight", User._meta.get_field("target_weight"),
+            data.get("targetWeight", 70),
+        ),
+        "height": None,
+        "weight": None,
+    }
+    for name, model in (("height", HeightModel), ("weight", WeightModel)):
+        if data.get(name) is not None:
+            row[name] = parse_measurement(name, model._meta.get_field(name), data[name])
+    if not isinstance(row["email"], str) or "@" not in row["email"]:
+        raise ValueError("invalid email")
+    if data.get("username"):
+        row["username"] = data["username"]
+    for name, field in (("birthDate", "birth_date"), ("lastPeriodDate", "last_period_date")):
+        if data.get(name):
+            row[field] = datetime.fromisoformat(data[name].replace("Z", "+00:00"))
+    for name, field in (("cycleDay", "cycle_day"), ("cycleLength", "cycle_length")):
+        if data.get(name):
+            row[field] = int(data[name])
+    return row
+
+
+class BulkUpsertUsersView(APIView):
+    """
+    Creates or updates users by email in one request, for partner
+    onboarding. Staff only. Body: ``{"users": [{"email": ..., ...}]}`` with
+    the fields of the create endpoint except the password.
+    """
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        rows = request.data.get("users") if isinstance(request.data, dict) else None
+        if not isinstance(rows, list) or not rows:
+            return Response("Expected a non-empty users list", status=400)
+        if len(rows) > BULK_UPSERT_MAX_ROWS:
+            return Response(
+                "At most %d users per request" % BULK_UPSERT_MAX_ROWS, status=400
+            )
+
+        parsed = []
+        for index, data in enumerate(rows):
+            try:
+                parsed.append(parse_upsert_row(data))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                return Response("Invalid user at index %d: %s" % (index, e), status=400)
+
+        logger.info("Bulk upsert of %d users by user %s", len(parsed), request.user.pk)
+        try:
+            results = User.objects.bulk_upsert(parsed)
+        except ValueError as e:
+            return Response(str(e), status=400)
+        except IntegrityError:
+            logger.warning("Bulk upsert failed with an integrity error")
+            return Response("Integrity error", status=400)
+
+        return Response(
+            {
+                "users": [
+                    {
+                        "email": row["email"],
+                        "id": pk,
+                        "status": "created" if created else "updated",
+                    }
+                    for row, (pk, created) in zip(parsed, results)
+                ]
+            },
+            status=200,
+        )